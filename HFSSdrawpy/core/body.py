@@ -4,13 +4,18 @@ import numpy as np
 
 from ..utils import Vector, \
                    parse_entry, \
-                   check_name, \
-                   find_last_list, \
-                   find_penultimate_list, \
-                   find_corresponding_list, \
+                   MoveStack, \
+                   IndexedList, \
+                   GridIndex, \
+                   ori2angle, \
+                   rotation_cos_sin, \
+                   _NUMBERS, \
                    val, \
+                   val_array, \
                    equal_float, \
-                   way
+                   equal_float_array, \
+                   way, \
+                   with_variables
 from .entity import Entity
 from .modeler import Modeler
 from ..path_finding.path_finder import Path
@@ -18,65 +23,52 @@ from .port import Port
 
 from ..parameters import DEFAULT, PORT, MASK, MESH
 
+@with_variables
 class BodyMover():
 
     def __init__(self, body):
 
         self.body = body
+        self.variables = body.variables
         self.id = np.random.rand()
 
     def __enter__(self):
         #1 We need to keep track of the entities created during the execution of a function
-        if self.body.entities_to_move is None:
-            self.body.entities_to_move = []
-        else:
-            find_last_list(self.body.entities_to_move).append([])
-
-        if self.body.ports_to_move is None:
-            self.body.ports_to_move = []
-        else:
-            find_last_list(self.body.ports_to_move).append([])
+        self.body.entities_to_move.push()
+        self.body.ports_to_move.push()
 
     def __exit__(self, *exc):
 
         #4 We move the entity that were created by the last function
-        list_entities_new = find_last_list(self.body.entities_to_move)
-        list_ports_new = find_last_list(self.body.ports_to_move)
+        list_entities_new = list(self.body.entities_to_move.current())
+        list_ports_new = list(self.body.ports_to_move.current())
         pos, angle = self.body.cursors[-1]
 
-        #5 We move the entities_to_move with the right operation
+        #5 We move the entities_to_move with the right operation, the move
+        # of the entities is only recorded and applied at the end
         if len(list_entities_new) > 0:
-            self.body.rotate(list_entities_new, angle=angle)
-            self.body.translate(list_entities_new, vector=[pos[0], pos[1], pos[2]])
+            self.body.defer_move(list_entities_new, angle, pos)
 
         if len(list_ports_new) > 0:
             Port.rotate_ports(list_ports_new, angle)
             Port.translate_ports(list_ports_new, vector=[
                                  pos[0], pos[1], pos[2]])
 
-        #6 We empty a part of the 'to_move' lists
-        penultimate_entity_list = find_penultimate_list(self.body.entities_to_move)
-        if penultimate_entity_list:
-            a = penultimate_entity_list.pop(-1)
-            for entity in a:
-                penultimate_entity_list.append(entity)
-        else:
-            self.body.entities_to_move = None
-
-        penultimate_port_list = find_penultimate_list(self.body.ports_to_move)
-        if penultimate_port_list:
-            a = penultimate_port_list.pop(-1)
-            for entity in a:
-                penultimate_port_list.append(entity)
-        else:
-            self.body.ports_to_move = None
+        #6 The moved objects join the enclosing block
+        frame = self.body.entities_to_move.pop()
+        self.body.ports_to_move.pop()
+        if not self.body.entities_to_move:
+            # outermost block
+            self.body.apply_moves()
+            if self.body.pm.flush_on_exit:
+                self.body.flush(list(frame))
 
         self.body.cursors.pop(-1)
         return False
 
+@with_variables
 class Body(Modeler):
 
-    dict_instances = {}
     def __init__(self, pm=None, name=None, rel_coor=None, ref_name='Global'): #network
         # Note: for now coordinate systems are not reactualized at each run
         if rel_coor is None:
@@ -95,11 +87,22 @@ class Body(Modeler):
         self.ref_name = ref_name
         self.interface = pm.interface
         self.mode = pm.mode # 'hfss' or 'gds'
-        self.dict_instances[name] = self
-        self.entities = {DEFAULT:[]}  # entities sorted by layer
+        self.symbolic = pm.symbolic
+        self.variables = pm.variables
+        # registries shared with the Modeler
+        self.body_instances = pm.body_instances
+        self.entity_instances = pm.entity_instances
+        self.entity_names = pm.entity_names
+        self.port_instances = pm.port_instances
+        self.port_names = pm.port_names
+        self.body_instances[name] = self
+        self.entities = {DEFAULT:IndexedList()}  # entities sorted by layer
         self.cursors = [] # tuple to escape list parsing
-        self.ports_to_move = None
-        self.entities_to_move = None
+        self.ports_to_move = MoveStack()
+        self.entities_to_move = MoveStack()
+        self.pending_moves = {}  # entity -> (angle, vector) not yet applied
+        self.spatial_index = {}  # layer -> GridIndex of the entities
+        self.stale_boxes = {}  # entities whose bounding box changed
 
         pm.bodies.append(self)
 
@@ -110,6 +113,150 @@ class Body(Modeler):
         self.cursors.append((pos, ori))
         return BodyMover(self)
 
+    ### Deferred moves
+    # Entities created in nested `with body(pos, ori):` blocks are not moved
+    # through the interface at each block exit: the rotations and
+    # translations are composed per entity and applied once, grouped by
+    # identical transform, when the outermost block exits or before the
+    # geometry of the entities is used (booleans, fillets, copies, export).
+
+    def defer_move(self, entities, ori, pos):
+        # composes the pending move of entities with a rotation of ori around
+        # the origin followed by a translation of pos
+        angle = ori2angle(ori)
+        cos, sin = rotation_cos_sin(angle)
+        for entity in entities:
+            old_angle, (x, y, z) = self.pending_moves.get(entity,
+                                                          (0, (0, 0, 0)))
+            self.pending_moves[entity] = ((old_angle+angle) % 360,
+                                          (cos*x-sin*y+pos[0],
+                                           sin*x+cos*y+pos[1],
+                                           z+pos[2]))
+
+    def apply_moves(self):
+        if not self.pending_moves:
+            return
+        pending_moves, self.pending_moves = self.pending_moves, {}
+        self.invalidate_boxes(pending_moves)
+        groups = {}
+        for entity, move in pending_moves.items():
+            groups.setdefault(move, []).append(entity)
+        # the moves are expressed in the coordinate system of the body, which
+        # may not be the active one when they are applied late
+        previous = self.interface.get_coor_sys()
+        self.interface.set_coor_sys(self.name)
+        try:
+            for (angle, vector), entities in groups.items():
+                if angle != 0:
+                    for entity in entities:
+                        entity.record('rotate', angle)
+                    self.interface.rotate(entities, angle)
+                if not all(isinstance(coor, _NUMBERS) and coor == 0
+                           for coor in vector):
+                    vector = list(vector)
+                    for entity in entities:
+                        entity.record('translate', vector)
+                    if self.mode == 'gds' and self.symbolic:
+                        vector = val(vector)
+                    self.interface.translate(entities, vector)
+        finally:
+            if previous is not None:
+                self.interface.set_coor_sys(previous)
+
+    def flush(self, entities=None):
+        """
+        gds streaming mode only, see Modeler.stream_gds: writes entities, all
+        the entities of the body if None, at the end of its gds file and
+        releases their memory. The flushed entities stay in the layers of the
+        body but cannot be used anymore. The ports of the body are kept.
+        """
+        if self.mode != 'gds':
+            return
+        self.apply_moves()
+        if entities is None:
+            self.interface.flush(self.name)
+            entities = [entity for layer_entities in self.entities.values()
+                        for entity in layer_entities if not entity.flushed]
+        else:
+            for entity in entities:
+                entity.check_flushed()
+            self.interface.flush(self.name, entities)
+        for entity in entities:
+            entity.release()
+            entity.flushed = True
+
+    ### Spatial index
+    # The bounding boxes of the entities are indexed by layer. Creating,
+    # moving or modifying an entity only marks its box as stale, the boxes
+    # are computed by the interface when the index is queried.
+
+    def invalidate_boxes(self, entities):
+        for entity in entities:
+            self.stale_boxes[entity] = None
+
+    def update_index(self):
+        self.apply_moves()
+        stale_boxes, self.stale_boxes = self.stale_boxes, {}
+        entities = [entity for entity in stale_boxes
+                    if self.entity_instances.get(entity.name) is entity]
+        if not entities:
+            return
+        bboxes = self.interface.get_bounding_boxes(entities)
+        for entity, bbox in zip(entities, bboxes):
+            index = self.spatial_index.setdefault(entity.layer, GridIndex())
+            if bbox is None:
+                if entity in index:
+                    index.remove(entity)
+            else:
+                index.insert(entity, bbox)
+
+    def unindex(self, entity):
+        self.stale_boxes.pop(entity, None)
+        index = self.spatial_index.get(entity.layer)
+        if index is not None and entity in index:
+            index.remove(entity)
+
+    def query(self, layer, bbox):
+        """
+        Returns the entities of layer whose bounding box intersects bbox, in
+        creation order.
+
+        Inputs:
+        -------
+        layer: layer of the entities
+        bbox: [[xmin, ymin], [xmax, ymax]], in the coordinates of the body
+
+        The entities created in an open `with body(...)` block are indexed at
+        their position in the block.
+        """
+        self.update_index()
+        (xmin, ymin), (xmax, ymax) = (val(parse_entry(coor))
+                                      for coor in bbox)
+        index = self.spatial_index.get(layer)
+        if index is None:
+            return []
+        return index.query(((xmin, ymin), (xmax, ymax)))
+
+    def nearest(self, point, layer=None):
+        """
+        Returns the entity whose bounding box is the closest to point, looking
+        in layer or in all layers if layer is None. Returns None if there is
+        no entity.
+        """
+        self.update_index()
+        point = [val(coor) for coor in parse_entry(point)[:2]]
+        if layer is None:
+            indices = self.spatial_index.values()
+        else:
+            indices = [self.spatial_index.get(layer, GridIndex())]
+        best_entity, best_distance = None, None
+        for index in indices:
+            result = index.nearest(point)
+            if result is not None and (best_distance is None
+                                       or result[1] < best_distance):
+                best_entity, best_distance = result
+        return best_entity
+
     # def __enter__(self):
     #     print("enter(")
     #     #1 We need to keep track of the entities created during the execution of a function
@@ -173,6 +320,14 @@ class Body(Modeler):
             return func(*args, **kwargs)
         return updated
 
+    def drawn(self, entity, method, *args, **kwargs):
+        # starts the history of an entity drawn by the gds interface method
+        # with args, which are evaluated again when a variable changes, see
+        # Modeler.set_variable
+        if self.mode == 'gds' and self.symbolic:
+            entity.history = ((method, args, kwargs),)
+        return entity
+
     ### Basic drawings
 
     @set_body
@@ -191,7 +346,7 @@ class Body(Modeler):
         box: Corresponding 3D Model Entity
         """
         pos, size = parse_entry(pos, size)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         self.interface.box(pos, size, **kwargs)
         return Entity(3, self, **kwargs)
@@ -218,7 +373,7 @@ class Body(Modeler):
     @set_body
     def cylinder(self, pos, radius, height, axis, segments = 0, name='cylinder_0', **kwargs):
         pos, radius, height = parse_entry(pos, radius, height)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         self.interface.cylinder(pos, radius, height, axis, segments, **kwargs)
         return Entity(3, self, **kwargs)
@@ -226,7 +381,7 @@ class Body(Modeler):
     @set_body
     def cone(self, pos, radius1,radius2, height, axis, name='cone_0', **kwargs):
         pos, radius1, radius2, height = parse_entry(pos, radius1, radius2, height)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         self.interface.cone(pos, radius1, radius2, height, axis, **kwargs)
         return Entity(3, self, **kwargs)
@@ -234,7 +389,7 @@ class Body(Modeler):
     @set_body
     def sphere(self, pos, radius, name='sphere_0', **kwargs):
         pos, radius = parse_entry(pos, radius)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         self.interface.sphere(pos, radius, **kwargs)
         return Entity(3, self, **kwargs)
@@ -242,7 +397,7 @@ class Body(Modeler):
     @set_body
     def torus(self, pos, majorradius, minorradius, axis, name='torus_0', **kwargs):
         pos, majorradius, minorradius = parse_entry(pos, majorradius, minorradius)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         self.interface.torus(pos, majorradius, minorradius, axis, **kwargs)
         return Entity(3, self, **kwargs)
@@ -250,59 +405,98 @@ class Body(Modeler):
     @set_body
     def disk(self, pos, radius, axis, name='disk_0', **kwargs):
         pos, radius = parse_entry(pos, radius)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
-        if self.mode=='gds':
+        drawing = (pos, radius)
+        if self.mode=='gds' and self.symbolic:
             pos = val(pos)
             radius = val(radius)
         self.interface.disk(pos, radius, axis, **kwargs)
-        return Entity(2, self, **kwargs)
+        return self.drawn(Entity(2, self, **kwargs), 'disk', *drawing,
+                          axis=axis, **kwargs)
 
     @set_body
     def polyline(self, points, closed=True, name='polyline_0', **kwargs):
-        points = parse_entry(points)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
-        i = 0
-        while i < len(points[:-1]):
-            points_equal = [equal_float(val(p0),val(p1))
-                            for p0, p1 in zip(points[i], points[i+1])]
-            if all(points_equal):
-                points.pop(i)
-                print('Warning: Delete two coinciding points on a polyline2D')
-            else:
-                i+=1
+        drawing = list(points)
         if self.mode=='gds':
-            points = val(points)
+            points = val_array(points)
+            coinciding = np.all(equal_float_array(points[:-1], points[1:]),
+                                axis=1)
+            for ii in range(np.count_nonzero(coinciding)):
+                print('Warning: Delete two coinciding points on a polyline2D')
+            points = points[np.append(~coinciding, True)]
+        else:
+            points = parse_entry(points)
+            i = 0
+            while i < len(points[:-1]):
+                points_equal = [equal_float(val(p0),val(p1))
+                                for p0, p1 in zip(points[i], points[i+1])]
+                if all(points_equal):
+                    points.pop(i)
+                    print('Warning: Delete two coinciding points on a polyline2D')
+                else:
+                    i+=1
         self.interface.polyline(points, closed, **kwargs)
         dim = closed + 1
-        return Entity(dim, self, **kwargs)
+        return self.drawn(Entity(dim, self, **kwargs), 'polyline', drawing,
+                          closed=closed, **kwargs)
 
     @set_body
     def rect(self, pos, size, name='rect_0', **kwargs):
         pos, size = parse_entry(pos, size)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
-        if self.mode=='gds':
+        drawing = (pos, size)
+        if self.mode=='gds' and self.symbolic:
             pos = val(pos)
             size = val(size)
         self.interface.rect(pos, size, **kwargs)
-        return Entity(2, self, **kwargs)
+        return self.drawn(Entity(2, self, **kwargs), 'rect', *drawing,
+                          **kwargs)
 
     @set_body
     #####draw arrays of rectangles with dimension (colums x row) with spacing given by a list [x_spacing,y_spacing]
     def rect_array(self, pos, size, columns, rows, spacing, name='rect_array_0', **kwargs):
-        if self.mode=='gds':
-            pos, size, spacing = parse_entry(pos, size, spacing)
-            name = check_name(Entity, name)
-            kwargs['name'] = name
-            pos = val(pos)
-            size = val(size)
+        rect = self.rect(pos, size, name=name, **kwargs)
+        return self.array(rect, columns, rows, spacing)
+
+    def array(self, entity, columns, rows, spacing):
+        """
+        Replicates entity, e.g. a rect or the reference of a component, on a
+        grid of columns x rows copies spaced by spacing [x_spacing, y_spacing]
+        in the coordinates of the body, entity being the first copy.
+        entity becomes the whole array and is returned, as in unite.
+        In gds, the array is a single reference to a cell holding the
+        geometry of entity, so that its size does not depend on the number of
+        copies. Like the references of components, it cannot be used in
+        booleans. In hfss, entity is duplicated along a line and united.
+        """
+        if entity.body is not self:
+            raise ValueError('%s is not an entity of the body %s'%(entity,
+                                                                   self.name))
+        spacing = parse_entry(spacing)
+        if self.mode == 'gds' and self.symbolic:
             spacing = val(spacing)
-            self.interface.rect_array(pos, size, columns, rows, spacing, **kwargs)
-            return Entity(2, self, **kwargs)
-        else:
-            pass
+        self.apply_moves()
+        self.interface.set_coor_sys(self.name)
+        self.interface.array(entity, columns, rows, spacing)
+        self.invalidate_boxes([entity])
+        entity.history = None  # references are not redrawn
+        return entity
+
+    @set_body
+    def cell_reference(self, cell_name, name='reference_0', **kwargs):
+        """
+        gds only, places the component cell cell_name at the origin of the
+        current coordinates, see component. The reference is an entity moved
+        like the others, it cannot be used in booleans.
+        """
+        name = self.entity_names.allocate(name)
+        kwargs['name'] = name
+        self.interface.cell_reference(cell_name, **kwargs)
+        return Entity(2, self, **kwargs)
 
     @set_body
     def rect_center(self, pos, size, name='rect_0', **kwargs):
@@ -313,10 +507,11 @@ class Body(Modeler):
     @set_body
     def wirebond(self, pos, ori, ymax, ymin, name='wb_0', **kwargs):
         pos, ymax, ymin = parse_entry(pos, ymax, ymin)
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         if self.mode=='gds':
-            pos, ori, ymax, ymin = val(pos, ori, ymax, ymin)
+            if self.symbolic:
+                pos, ori, ymax, ymin = val(pos, ori, ymax, ymin)
             self.interface.wirebond(pos, ori, ymax, ymin, **kwargs)
             kwargs['name'] = name+'a'
             entity_a = Entity(2, self, **kwargs)
@@ -330,20 +525,16 @@ class Body(Modeler):
     @set_body
     def path(self, points, port, fillet, name='path_0', **kwargs):
         #fillet should be either 0 or larger than half of the port width
-        name = check_name(Entity, name)
+        name = self.entity_names.allocate(name)
         kwargs['name'] = name
         model_entities = []
         if self.mode == 'gds':
-            points = val(points)
-            fillet = val(fillet)
-            _port = port.val()
-
-            #TODO, this is a dirty fixe cause of Vector3D
-
-            # due to the 3D vector implementation
-            points_2D = []
-            for point in points:
-                points_2D.append([point[0], point[1]])
+            points_2D = val_array(points)[:, :2]
+            if self.symbolic:
+                fillet = val(fillet)
+                _port = port.val()
+            else:
+                _port = port
 
             if fillet==0:
                 names, layers = self.interface.path(points_2D, _port, fillet, name=name, corner="natural")
@@ -402,9 +593,10 @@ class Body(Modeler):
         def moved(*args, **kwargs):
             new_args = [args[0]]  # args[0] = chip, args[1] = name
             for i, argument in enumerate(args[1:]):
-                if isinstance(argument, str) and (argument in Port.dict_instances):
+                port_instances = args[0].port_instances
+                if isinstance(argument, str) and (argument in port_instances):
                     #  if argument is the sting representation of the port
-                    new_args.append(Port.dict_instances[argument])
+                    new_args.append(port_instances[argument])
                 elif isinstance(argument, Port):
                     #  it the argument is the port itself
                     new_args.append(argument)
@@ -474,7 +666,7 @@ class Body(Modeler):
         pos = [0, 0]
         ori = [1, 0]
 
-        name = check_name(Port, name)
+        name = self.port_names.allocate(name)
 
         if constraint_port:
             pos, ori = parse_entry(pos, ori)
@@ -568,14 +760,13 @@ class Body(Modeler):
         if do_not_beyong:
             raise ValueError('%s ports do not beyond to %s'%(do_not_beyong, self))
 
-        indent_level = find_corresponding_list(ports[0], self.ports_to_move)
+        indent_level = self.ports_to_move.frame_of.get(ports[0])
         if indent_level is not None:
-            if indent_level:  # the found list
-                for port in ports:
-                    if not port in indent_level:
-                        msg = 'Trying to connect ports from different \
-                                indentation levels: port %s'%(port.name)
-                        raise IndentationError(msg)
+            for port in ports:
+                if not port in indent_level:
+                    msg = 'Trying to connect ports from different \
+                            indentation levels: port %s'%(port.name)
+                    raise IndentationError(msg)
 
         # asserts neither in nor out port are constraint_ports
         if ports[0].constraint_port and ports[-1].constraint_port:
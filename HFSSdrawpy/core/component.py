@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Memoized library elements: an element drawn several times with the same
+arguments is drawn once in its own gds cell, and placed by references.
+"""
+
+from functools import wraps
+import hashlib
+from inspect import signature
+
+import numpy as np
+
+from .body import Body
+from .port import Port
+from ..utils import parse_entry, val, Vector, use_variables, ori2angle, \
+                    _NUMBERS
+
+# attributes of the Modeler read by library elements
+_FLAGS = ('is_overdev', 'is_litho', 'is_mask', 'overdev', 'gap_mask')
+
+def _canonical(value, func):
+    # hashable value of an argument of func, numbers and lengths are
+    # evaluated so that equal arguments give the same key
+    if isinstance(value, str):
+        value = parse_entry(value)
+        if isinstance(value, str):
+            return value  # a name or a unit other than a length
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_canonical(elt, func) for elt in value)
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, _NUMBERS):
+        return float(value)
+    try:
+        return float(val(value))
+    except (AttributeError, TypeError):
+        raise TypeError('the argument %r of the component %s cannot be '
+                        'hashed'%(value, func.__name__))
+
+def component(func):
+    """
+    Decorator memoizing a library element func(body, *args, **kwargs) that
+    returns a list of ports, such as example_elements.draw_connector.
+
+    In gds mode, the element is drawn once per distinct set of evaluated
+    arguments, in a component cell at the origin. Each call places a
+    reference to this cell in the body, moved as the entities of the current
+    `with body(...)` blocks, and returns copies of the ports of the element
+    named after the name argument. The entities of the element are not
+    created in the body: they cannot be used in booleans, e.g. a ground
+    plane cannot be subtracted by the gaps of a component.
+    The element should only depend on its arguments and on the mask and
+    overdev flags of the Modeler.
+
+    In hfss mode, the element is drawn at the first call in each body. The
+    next calls copy the entities of the first placement, bring the copies
+    back to the coordinates they were drawn in by undoing the moves of the
+    `with body(...)` blocks exited since, and return copies of the ports
+    recorded when the element was drawn. The entities of the first
+    placement should not be modified afterwards, the element is drawn again
+    if one of them was deleted.
+
+    Usage:
+        connector = component(elt.draw_connector)
+        with chip(['0.5mm', '0.5mm'], [1, 0]):
+            con1, = connector(chip, track, gap, '100um', name='con1')
+    """
+    parameters = signature(func).parameters
+    default_name = parameters['name'].default if 'name' in parameters \
+                   else None
+
+    @wraps(func)
+    def placed(body, *args, **kwargs):
+        with use_variables(body.variables):
+            return _place(func, default_name, body, args, kwargs)
+    return placed
+
+def _place(func, default_name, body, args, kwargs):
+    # places the component cell of func(body, *args, **kwargs), drawn at
+    # the first call, and returns the copies of its ports
+    pm = body.pm
+    name = kwargs.pop('name', default_name)
+    key = (func.__module__, func.__qualname__,
+           _canonical(args, func),
+           tuple((arg, _canonical(value, func))
+                 for arg, value in sorted(kwargs.items())),
+           tuple(_canonical(getattr(body, flag), func)
+                 for flag in _FLAGS))
+    if body.mode != 'gds':
+        return _place_copy(func, name, body, (body.name,)+key, args, kwargs)
+    if key not in pm.components:
+        cell_name = '%s_%s'%(func.__name__, hashlib.sha1(
+            repr(key).encode()).hexdigest()[:8])
+        pm.components[key] = (cell_name,
+                              _draw_component(pm, cell_name, func, args,
+                                              kwargs, default_name))
+    cell_name, ports = pm.components[key]
+
+    body.cell_reference(cell_name, name=name or cell_name)
+    copies = []
+    for port in ports:
+        port_name = port.name
+        if name is not None and port_name.startswith(cell_name):
+            port_name = name+port_name[len(cell_name):]
+        widths = port.widths if port.constraint_port else val(port.widths)
+        offsets = port.offsets if port.constraint_port \
+                  else val(port.offsets)
+        copies.append(Port(body, port_name, val(Vector(port.pos)),
+                           val(Vector(port.ori)),
+                           widths, port.subnames, port.layers, offsets,
+                           port.constraint_port))
+    return copies
+
+def _draw_component(pm, cell_name, func, args, kwargs, default_name):
+    # draws the element in the component cell and returns its ports
+    flush_on_exit, pm.flush_on_exit = pm.flush_on_exit, False
+    try:
+        cell_body = Body(pm, cell_name)
+        if default_name is not None:
+            kwargs = dict(kwargs, name=cell_name)
+        ports = func(cell_body, *args, **kwargs)
+        cell_body.apply_moves()
+    finally:
+        pm.flush_on_exit = flush_on_exit
+    if not all(isinstance(port, Port) for port in ports):
+        raise TypeError('the component %s should return a list of '
+                        'ports'%func.__name__)
+    # the cell is only placed by references
+    pm.bodies.remove(cell_body)
+    pm.body_instances.pop(cell_name)
+    pm.interface.make_component(cell_name)
+    return ports
+
+def _place_copy(func, name, body, key, args, kwargs):
+    # hfss mode: draws func(body, *args, **kwargs) at the first call, the
+    # next calls copy the entities of the first placement
+    pm = body.pm
+    placement = pm.components.get(key)
+    if placement is not None and all(
+            pm.entity_instances.get(entity.name) is entity
+            for entity in placement[2]):
+        return _copy_placement(body, name, placement)
+
+    if name is not None:
+        kwargs = dict(kwargs, name=name)
+    drawn = set(pm.entity_instances)
+    frames = list(body.cursors)
+    ports = func(body, *args, **kwargs)
+    entities = [entity for entity_name, entity in pm.entity_instances.items()
+                if entity_name not in drawn and entity.body is body]
+    # the ports are moved when the blocks exit, their current state is
+    # recorded in the coordinates they were drawn in
+    recorded_ports = [(port.name, Vector(port.pos), Vector(port.ori),
+                       port.widths, port.subnames, port.layers, port.offsets,
+                       port.constraint_port) for port in ports]
+    pm.components[key] = (name, frames, entities, recorded_ports)
+    return ports
+
+def _renamed(element_name, first_name, name):
+    # name of the copy of an element of the placement named first_name, the
+    # element names are built from the name argument e.g. '_con1_track'
+    if name is not None and first_name:
+        return element_name.replace(first_name, name, 1)
+    return element_name
+
+def _copy_placement(body, name, placement):
+    # copies the entities and ports of the first placement in the current
+    # coordinates of body
+    first_name, frames, entities, recorded_ports = placement
+    # blocks still open around the first placement, the entities drawn then
+    # have been moved by the other ones when they exited
+    common = 0
+    for frame, cursor in zip(frames, body.cursors):
+        if frame is not cursor:
+            break
+        common += 1
+
+    copies = []
+    for entity in entities:
+        copy = entity.copy(new_name=body.entity_names.allocate(
+            _renamed(entity.name, first_name, name)))
+        # created in the current block, as if it had been drawn
+        body.entities_to_move.remove(copy)
+        body.entities_to_move.add(copy)
+        copies.append(copy)
+    if copies:
+        # undo the moves of the exited blocks, the outermost one first
+        for pos, ori in frames[common:]:
+            body.interface.translate(copies, [-coor for coor in pos])
+            angle = ori2angle(ori)
+            if angle != 0:
+                body.interface.rotate(copies, -angle)
+        body.invalidate_boxes(copies)
+
+    return [Port(body, _renamed(port_name, first_name, name), pos, ori,
+                 widths, subnames, layers, offsets, constraint_port)
+            for port_name, pos, ori, widths, subnames, layers, offsets,
+            constraint_port in recorded_ports]
@@ -2,39 +2,44 @@ import numpy as np
 
 from ..parameters import DEFAULT
 
-from ..utils import Vector, parse_entry, check_name, find_last_list, \
-    add_to_corresponding_list, gen_name, val, general_remove
+from ..utils import Vector, parse_entry, gen_name, val, MoveStack, \
+                    IndexedList, with_variables
 
+@with_variables
 class Entity():
     # this should be the objects we are handling on the python interface
     # each method of this class should act in return in HFSS/GDS when possible
-    dict_instances = {}
+    # entities are registered by name in the Modeler of their body
 
     def __init__(self, dimension, body, nonmodel=False, layer=DEFAULT,
                  copy=None, name='entity_0', **kwargs):
-        name = check_name(self.__class__, name)
+        name = body.entity_names.allocate(name)
         self.name = name
         self.dimension = dimension
         self.body = body
         self.nonmodel = nonmodel
         self.layer = layer
+        self.flushed = False  # written in a gds stream, see Body.flush
 
-        Entity.dict_instances[name] = self
+        self.dict_instances[name] = self
         if layer in self.body.entities.keys():
             self.body.entities[layer].append(self)
         else:
-            self.body.entities[layer]=[self]
+            self.body.entities[layer] = IndexedList([self])
+
+        self.body.invalidate_boxes([self])
+        # drawing steps replayed when a variable changes, None if they are
+        # not recorded, see Modeler.set_variable
+        self.history = None if copy is None else copy.history
 
         if copy is None:
-            if self.body.entities_to_move is not None:
-                find_last_list(self.body.entities_to_move).append(self)
+            self.body.entities_to_move.add(self)
             self.is_boolean = False  # did it suffer a bool operation already ?
             self.is_fillet = False  # did it suffer a fillet operation already ?
         else:
             # copy is indeed the original object
             # the new object should be put in the same list indent
-            add_to_corresponding_list(copy, self.body.entities_to_move,
-                                      self)
+            self.body.entities_to_move.add_after(copy, self)
             self.is_boolean = copy.is_boolean
             self.is_fillet = copy.is_fillet
     def __str__(self):
@@ -45,32 +50,85 @@ class Entity():
 
     ### General methods
 
+    @property
+    def dict_instances(self):
+        return self.body.entity_instances
+
+    @property
+    def variables(self):
+        return self.body.variables
+
+    @property
+    def names(self):
+        return self.body.entity_names
+
     @staticmethod
-    def reset():
-        raise NotImplementedError()
-        # self.body.entities = {}
-        # Entity.dict_instances = {}
-        # Entity.instances_to_move = []
+    def reset(pm):
+        # forgets the entities of the Modeler pm
+        pm.entity_instances.clear()
+        pm.entity_names.reset(pm.entity_instances)
+        for body in pm.bodies:
+            body.entities = {DEFAULT:IndexedList()}
+            body.entities_to_move = MoveStack()
+            body.pending_moves = {}
+            body.spatial_index = {}
+            body.stale_boxes = {}
 
-    @classmethod
-    def print_instances(cls):
-        for instance_name in cls.dict_instances:
+    @staticmethod
+    def print_instances(pm):
+        for instance_name in pm.entity_instances:
             print(instance_name)
 
     ### Modifying methods
 
+    def record(self, method, *args, **kwargs):
+        # appends a step to the history of the entity, a call of the gds
+        # interface method whose arguments are evaluated at replay
+        if self.history is not None:
+            self.history += ((method, args, kwargs),)
+
+    def record_boolean(self, method, tool_entities, **kwargs):
+        # the histories of the tools are replayed with the entity, which
+        # cannot be redrawn if one of them cannot
+        histories = tuple(entity.history for entity in tool_entities)
+        if None in histories:
+            self.history = None
+        else:
+            self.record(method, histories, **kwargs)
+
+    def check_flushed(self):
+        if self.flushed:
+            raise ValueError('%s was flushed to its gds stream, it cannot be '
+                             'used anymore: use it before its outermost '
+                             '`with body(...)` block exits'%self.name)
+
+    def apply_moves(self):
+        # the deferred moves are applied before the geometry is used
+        self.check_flushed()
+        self.body.apply_moves()
+
     def delete(self):
         # deletes the Entity and its occurences throughout the code
         # it does not delete the entity Python object anymore
+        self.check_flushed()
+        self.release()
+        self.body.entities[self.layer].remove(self)
+
+    def release(self):
+        # forgets the entity in the interface and the body, except in the
+        # list of its layer
         self.body.interface.delete(self)
+        self.body.pending_moves.pop(self, None)
+        self.body.unindex(self)
         self.dict_instances.pop(self.name)
-        self.body.entities[self.layer].remove(self)
-        if self.body.entities_to_move is not None:
-            general_remove(self, self.body.entities_to_move)
+        self.names.release(self.name)
+        self.body.entities_to_move.remove(self)
 
     def copy(self, new_name=None):
-        generated_name = gen_name(self.name)
-        self.body.interface.copy(self)
+        self.apply_moves()
+        # name given by HFSS to a pasted object
+        generated_name = self.names.allocate(gen_name(self.name))
+        self.body.interface.copy(self, generated_name)
         copied = Entity(self.dimension, self.body,
                              nonmodel=self.nonmodel, layer=self.layer,
                              copy=self, name=generated_name)
@@ -79,12 +137,16 @@ class Entity():
         return copied
 
     def rename(self, new_name):
+        self.check_flushed()
         self.dict_instances.pop(self.name)
+        self.names.release(self.name)
         self.dict_instances[new_name] = self
         self.body.interface.rename(self, new_name)
         self.name = new_name
 
     def thicken_sheet(self, thickness, bothsides=False):
+        self.apply_moves()
+        self.body.invalidate_boxes([self])
         self.body.interface.thicken_sheet(self, thickness, bothsides=False)
 
     def assign_perfect_E(self, suffix='perfE'):
@@ -107,12 +169,14 @@ class Entity():
         return copy
 
     def find_vertex(self):
+        self.apply_moves()
         vertices = self.body.interface.get_vertices(self)
         return vertices
     
     def find_start_vertex(self):
         # finds the lowest vertex in Y in a polygon
         # if there are several, returns the lowest in X
+        self.apply_moves()
         vertices = self.body.interface.get_vertices(self)
         min_y = vertices[0][1]
         min_x = vertices[0][0]
@@ -147,12 +211,15 @@ class Entity():
     def fillet(self, radius, vertex_indices=None):
 
         assert (not self.is_fillet), 'Cannot fillet an already filleted entity'
+        self.apply_moves()
+        self.body.invalidate_boxes([self])
 
         if vertex_indices is None:
             # filleting all vertices
             msg = 'Should provide a single radius when filleting all vertices'
             assert not isinstance(radius, list), msg
-            if self.body.mode=='gds':
+            if self.body.mode=='gds' and self.body.symbolic:
+                self.record('fillet', radius)
                 radius = val(radius)
             self.body.interface.fillet(self, radius)
             self.is_fillet = True
@@ -193,7 +260,9 @@ class Entity():
         msg = 'Vertex index is present more than once in fillet'
         assert len(flat_indices)==len(set(flat_indices)), msg
         if self.body.mode=='gds':
-            radius = val(radius)
+            if self.body.symbolic:
+                self.record('fillet', radius, vertex_indices)
+                radius = val(radius)
             self.body.interface.fillet(self, radius, vertex_indices)
         else:
             # manipulate vertex_indices in a good way
@@ -336,6 +405,7 @@ class Entity():
 
         r, l, c = rlc
 
+        self.apply_moves()
         self.body.interface.assign_lumped_rlc(self, r, l, c, point_0,
                                               point_1, name="RLC")
 
@@ -348,21 +418,27 @@ class Entity():
     def translate(self, vector):
         self.body.translate(self, vector)
 
-    def subtract(self, tool_entities, keep_originals=False):
+    def subtract(self, tool_entities, keep_originals=False, tile_size=None,
+                 processes=None):
         """
         tool_entities: a list of Entity or a Entity
         keep_originals: Boolean, True : the tool entities still exist after
                         boolean operation
+        tile_size, processes: see Modeler.subtract
         """
         return self.body.subtract([self], tool_entities,
-                                  keep_originals=keep_originals)
+                                  keep_originals=keep_originals,
+                                  tile_size=tile_size, processes=processes)
 
-    def unite(self, tool_entities, keep_originals=False, new_name=None):
+    def unite(self, tool_entities, keep_originals=False, new_name=None,
+              tile_size=None, processes=None):
         """
         tool_entities: a list of Entity or a Entity
         if new_name (str) is provided, the tool_entities + self are kept and
         the union is named new_name
+        tile_size, processes: see Modeler.subtract
         """
         return self.body.unite(tool_entities, main=self,
                                keep_originals=keep_originals,
-                               new_name=new_name)
+                               new_name=new_name, tile_size=tile_size,
+                               processes=processes)
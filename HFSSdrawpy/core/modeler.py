@@ -5,17 +5,63 @@ Created on Thu Oct 31 14:14:51 2019
 @author: antho
 """
 
-from pint import UnitRegistry
+from functools import lru_cache
 import numpy as np
 import os
-from inspect import currentframe, getfile
-import sympy
+from inspect import currentframe
 
 from .entity import Entity
-from ..utils import variables, store_variable, parse_entry, val
+from .port import Port
+from ..expression import Symbol
+from ..utils import parse_entry, val, si_value, infer_variable_name, \
+                    NameAllocator, as_list, Variables, set_variables, \
+                    with_variables
 
-sympy.init_printing(use_latex=False)
+@lru_cache(maxsize=None)
+def _import_sympy():
+    # sympy is slow to import, done when the first sympy variable is created
+    import sympy
+    sympy.init_printing(use_latex=False)
+    return sympy
 
+def apply_moves(entities):
+    # applies the deferred moves of the bodies of entities before their
+    # geometry is used, flushed entities raise a ValueError
+    for entity in as_list(entities):
+        entity.apply_moves()
+
+def free_symbols(entry):
+    # variables used by entry, a value or nested lists of values
+    if isinstance(entry, (list, tuple, np.ndarray)):
+        symbols = set()
+        for elt in entry:
+            symbols |= free_symbols(elt)
+        return symbols
+    return set(getattr(entry, 'free_symbols', ()))
+
+def history_symbols(history, cache):
+    # variables used by the steps of a history, see Entity.record, cache
+    # maps the id of the histories already visited to their variables
+    key = id(history)
+    if key not in cache:
+        symbols = set()
+        for method, args, kwargs in history:
+            if method in ('subtract', 'unite'):
+                for tool_history in args[0]:
+                    symbols |= history_symbols(tool_history, cache)
+            else:
+                symbols |= free_symbols(args) | free_symbols(
+                    list(kwargs.values()))
+        cache[key] = symbols
+    return cache[key]
+
+def invalidate_boxes(entities):
+    # the geometry of entities changed, their bounding boxes are recomputed
+    # at the next query of the spatial index
+    for entity in entities:
+        entity.body.invalidate_boxes([entity])
+
+@with_variables
 class Modeler():
     """
     Modeler which defines basic operations and methods to perform on Entity and on the chosen interface.
@@ -28,6 +74,21 @@ class Modeler():
     Inputs:
     -------
     mode: string in "gds" or "hfss"
+    engine: string in "sympy" or "native", library used to build the
+            symbolic expressions of the variables. "native" uses the
+            lightweight expressions of HFSSdrawpy.expression, which are faster
+            to build and evaluate.
+    symbolic: if False, variables are plain floats and no symbolic expression
+              is ever built, which is the fastest option for gds production
+              runs. The drawing is the same as in symbolic mode.
+    precision: gds only, size in meters of the database unit. The vertices of
+               the gds geometry are snapped to this grid when created, so
+               that booleans and exports work on exact coordinates.
+
+    Each Modeler has its own variables: the values of a variable set in a
+    Modeler are used by its bodies, entities and ports only. Outside of their
+    methods, val evaluates the variables of the last Modeler created in the
+    thread.
     """
     is_overdev = False
     is_litho = False
@@ -35,12 +96,19 @@ class Modeler():
     gap_mask = parse_entry('20um')
     overdev = parse_entry('0um')
 
-    def __init__(self, mode):
+    def __init__(self, mode, engine='sympy', symbolic=True, precision=1e-9):
         """
         Creates a Modeler object based on the chosen interface.
         For now the interface cannot be changed during an execution, only at the beginning
         """
         self.mode = mode
+        # values of the variables and evaluations of the expressions
+        self.variables = Variables()
+        set_variables(self.variables)
+        if engine not in ['sympy', 'native']:
+            raise ValueError("engine should be either 'sympy' or 'native'")
+        self.engine = engine
+        self.symbolic = symbolic
         if mode == "hfss":
             from ..interfaces.hfss_modeler import get_desktop
             desktop = get_desktop()
@@ -54,43 +122,156 @@ class Modeler():
             self.interface = self.modeler
         elif mode=="gds":
             from ..interfaces import gds_modeler
-            self.interface = gds_modeler.GdsModeler()
+            self.interface = gds_modeler.GdsModeler(precision=precision)
         else:
             print('Mode should be either hfss or gds')
 
         #The list of bodies pointing to the current Modeler
         self.bodies = []
 
+        # objects of this design, by name
+        self.body_instances = {}
+        self.entity_instances = {}
+        self.port_instances = {}
+        self.entity_names = NameAllocator(self.entity_instances, 'Entity')
+        self.port_names = NameAllocator(self.port_instances, 'Port')
+        # bodies flushed at the exit of their outermost block, see stream_gds
+        self.flush_on_exit = False
+        # component cells and ports by element and arguments, see component
+        self.components = {}
+
     ### Utils methods
 
     def delete_all_objects(self, entities):
         for entity in entities:
             entity.delete()
 
+    def reset(self):
+        """
+        Forgets all the bodies, entities and ports of the Modeler and deletes
+        their geometry, so that a new design can be drawn with it.
+        Variables are kept, the cached evaluations are dropped.
+        """
+        self.variables.clear_caches()
+        Entity.reset(self)
+        Port.reset(self)
+        self.bodies = []
+        self.body_instances.clear()
+        self.components.clear()
+        if self.mode == 'hfss':
+            self.modeler.delete_all_objects()
+        elif self.mode == 'gds':
+            self.interface.reset()
+
     def set_variable(self, value, name=None):
         """
         name (str): name of the variable in HFSS e.g. 'chip_length'
         value (str, VarStr, float): value of the variable
                                     if str will try to analyse the unit
+                                    if an expression of other variables, the
+                                    variable follows their changes
+        Setting an existing variable again only re-evaluates the values that
+        depend on it: the variables defined from it and the symbolic port
+        positions and widths, which are evaluated again by val. HFSS updates
+        its parametric geometry itself, in gds the entities using the
+        variable are redrawn, see redraw. The cable lengths are computed once
+        and are not updated.
+        A variable cannot be defined from a variable which depends on it.
+        In non-symbolic mode, the SI value is returned as a float.
         """
+        if not self.symbolic and self.mode == 'gds':
+            return si_value(value)
         if name is None:
             # this auto-parsing is clearly a hack and not robust
             # but I find it convenient
-            f = currentframe().f_back#.f_back
-            filename = getfile(f)
-            code_line = open(filename).readlines()[f.f_lineno - 1]
-            name = code_line.split("=")[0].strip()
+            name = infer_variable_name(currentframe().f_back)
 
         if self.mode == 'hfss':
             self.design.set_variable(name, value)  # for HFSS
-        symbol = sympy.symbols(name)
-        store_variable(symbol, value)
+        if not self.symbolic:
+            return si_value(value)
+        if self.engine == 'native':
+            symbol = Symbol(name)
+        else:
+            symbol = _import_sympy().symbols(name)
+        previous = self.variables.values.get(symbol)
+        used = symbol in self.variables and self.variables.is_used(symbol)
+        self.variables.store(symbol, value)
+        if (self.mode == 'gds' and self.entity_instances
+                and previous is not None
+                and self.variables.values[symbol] != previous):
+            not_redrawn = self.redraw(self.variables.affected(symbol))
+            if not_redrawn and used:
+                print('Warning: %s changed after drawing, %d entities whose '
+                      'drawing is not recorded are not redrawn, e.g. %s'
+                      %(name, len(not_redrawn), not_redrawn[0]))
         return symbol
 
-    def generate_gds(self, folder, filename, max_points=0):
+    def redraw(self, symbols):
+        """
+        gds only, draws again the entities whose drawing used one of the
+        variables symbols, with their current values. Each entity records the
+        steps of its drawing: the primitive (rect, disk or polyline), moves,
+        fillets and booleans with the steps of their tools, which are
+        replayed by the interface.
+        Returns the names of the entities whose drawing is not recorded, e.g.
+        paths, wirebonds, references to cells and entities drawn in
+        non-symbolic mode, which are not redrawn.
+        """
+        not_redrawn = []
+        cache = {}
+        for entity in list(self.entity_instances.values()):
+            if entity.history is None:
+                not_redrawn.append(entity.name)
+            elif history_symbols(entity.history, cache) & symbols:
+                self.interface.redraw(entity, entity.history)
+                invalidate_boxes([entity])
+        return not_redrawn
+
+    def generate_gds(self, folder, filename, max_points=0, workers=1,
+                     hierarchical=False):
+        """
+        Writes each body in the file folder/filename_<body name>.gds, with
+        polygons fractured into pieces of at most max_points vertices.
+        workers: number of worker processes fracturing the polygons and
+                 writing the files (all the cpus if None), the files are the
+                 same as with a single process.
+        hierarchical: if True, writes the single library
+                      folder/filename.gds instead, whose top cell named
+                      filename places the cell of each body with a reference
+                      following its rel_coor and ref_name.
+        """
         file = os.path.join(folder, filename)
+        for body in self.bodies:
+            body.apply_moves()
         if self.mode=='gds':
-            self.interface.generate_gds(file, max_points)
+            self.interface.generate_gds(file, max_points, workers=workers,
+                                        hierarchical=hierarchical)
+
+    def stream_gds(self, folder, filename, max_points=0, flush_on_exit=False):
+        """
+        gds only, starts writing the bodies in the files
+        folder/filename_<body name>.gds as they are finished, to draw designs
+        that do not fit in memory. body.flush() writes the entities of a body
+        at the end of its file and releases them, and close_gds_stream writes
+        the remaining entities and finalizes the files.
+        flush_on_exit: if True, the entities created in the outermost
+                       `with body(...)` block of a body are flushed when it
+                       exits, the other entities of the body are kept.
+        Flushed entities stay in the layers of their body but any later use,
+        e.g. in booleans, raises a ValueError. The ports are kept.
+        """
+        if self.mode == 'gds':
+            self.interface.stream_gds(os.path.join(folder, filename),
+                                      max_points)
+            self.flush_on_exit = flush_on_exit
+
+    def close_gds_stream(self):
+        for body in self.bodies:
+            body.apply_moves()
+        if self.mode == 'gds':
+            self.interface.close_streams()
+            self.flush_on_exit = False
 
     def make_material(self, material_params, name):
         raise NotImplementedError()
@@ -100,13 +281,21 @@ class Modeler():
     def intersect(self, entities, keep_originals = False):
         raise NotImplementedError()
 
-    def unite(self, entities, main=None, keep_originals=False, new_name=None):
+    def _tiling_options(self, tile_size, processes):
+        # tiled booleans are only available in gds
+        if tile_size is None or self.mode != 'gds':
+            return {}
+        return {'tile_size': val(parse_entry(tile_size)),
+                'processes': processes}
+
+    def unite(self, entities, main=None, keep_originals=False, new_name=None,
+              tile_size=None, processes=None):
         # main: name or entity that should be returned/preserved/final union
         # if new_name (str) is provided, the original entities are kept and
         # the union is named new_name
-        if not isinstance(entities, list):
-            entities = [entities]
-        entities = entities.copy()
+        # if tile_size is provided (gds only), the union is computed on tiles
+        # of this size in processes worker processes, see tiled_boolean
+        entities = as_list(entities).copy()
 
         # if new_name is None:
         #     keep_originals = False
@@ -115,10 +304,13 @@ class Modeler():
 
         if main is not None:
             if isinstance(main, str):
-                main = Entity.dict_instances[main]
+                main = self.entity_instances[main]
             if main in entities:
                 entities.remove(main)
             entities = [main] + entities
+        apply_moves(entities)
+        if self.mode == 'gds' and len(entities) > 1:
+            self.interface.check_blanks(entities[:1])
 
         if len(entities)!=1:
             if not all([entity.dimension == entities[0].dimension
@@ -129,7 +321,13 @@ class Modeler():
                 if keep_originals:
                     entities[0] = entities[0].copy()
 
-                union_entity = self.interface.unite(entities, keep_originals=keep_originals)
+                entities[0].record_boolean(
+                    'unite', entities[1:],
+                    **self._tiling_options(tile_size, processes))
+                union_entity = self.interface.unite(
+                    entities, keep_originals=keep_originals,
+                    **self._tiling_options(tile_size, processes))
+                invalidate_boxes([union_entity])
                 union_entity.is_boolean = True
                 list_fillet = [entity.is_fillet for entity in entities]
                 union_entity.is_fillet = union_entity.is_fillet or any(list_fillet)
@@ -146,16 +344,19 @@ class Modeler():
 
         return union_entity
 
-    def subtract(self, blank_entities, tool_entities, keep_originals=False):
+    def subtract(self, blank_entities, tool_entities, keep_originals=False,
+                 tile_size=None, processes=None):
         """
         tool_entities: a list of Entity or a Entity
         keep_originals: Boolean, True : the tool entities still exist after
                         boolean operation
+        tile_size: gds only, if provided the subtraction is computed on tiles
+                   of this size e.g. '1mm', in processes worker processes
+                   (all the cpus if None), see tiled_boolean. The result is
+                   cut along the tiles.
         """
-        if not isinstance(blank_entities, list):
-            blank_entities = [blank_entities]
-        if not isinstance(tool_entities, list):
-            tool_entities = [tool_entities]
+        blank_entities = as_list(blank_entities)
+        tool_entities = as_list(tool_entities)
         if len(blank_entities)==0 or len(tool_entities)==0:
             pass
         else:
@@ -166,8 +367,17 @@ class Modeler():
                 raise TypeError('All subtracted elements should have the \
                                 same dimension')
             else:
-                self.interface.subtract(blank_entities, tool_entities,
-                                            keep_originals=True)
+                apply_moves(blank_entities+tool_entities)
+                if self.mode == 'gds':
+                    self.interface.check_blanks(blank_entities)
+                for entity in blank_entities:
+                    entity.record_boolean(
+                        'subtract', tool_entities,
+                        **self._tiling_options(tile_size, processes))
+                self.interface.subtract(
+                    blank_entities, tool_entities, keep_originals=True,
+                    **self._tiling_options(tile_size, processes))
+                invalidate_boxes(blank_entities)
                 # actualize the properties of the blank_entities
                 list_fillet_bool = any([entity.is_fillet
                                         for entity in tool_entities])
@@ -189,14 +399,24 @@ class Modeler():
                 raise Exception("angle should be either a float or a 2-dim array")
         elif not isinstance(angle, (float, int)):
             raise Exception("angle should be either a float or a 2-dim array")
-        if self.mode == 'gds':
+        entities = as_list(entities)
+        apply_moves(entities)
+        for entity in entities:
+            entity.record('rotate', angle)
+        if self.mode == 'gds' and self.symbolic:
             angle = val(angle)
         self.interface.rotate(entities, angle)  # angle in degrees
+        invalidate_boxes(entities)
 
     def translate(self, entities, vector=[0, 0, 0]):
         vector = parse_entry(vector)
-        if self.mode == 'gds':
+        entities = as_list(entities)
+        apply_moves(entities)
+        for entity in entities:
+            entity.record('translate', vector)
+        if self.mode == 'gds' and self.symbolic:
             vector = val(vector)
         self.interface.translate(entities, vector)
+        invalidate_boxes(entities)
 
 
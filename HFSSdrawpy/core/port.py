@@ -3,16 +3,17 @@ import math
 
 from ..utils import Vector, \
                    parse_entry, \
-                   check_name, \
-                   find_last_list, \
-                   val
+                   val, \
+                   MoveStack, \
+                   with_variables
 
+@with_variables
 class Port():
-    dict_instances  = {}
+    # ports are registered by name in the Modeler of their body
 
     def __init__(self, body, name, pos, ori, widths, subnames, layers, offsets, constraint_port, key='name'):
         if not (isinstance(key, Port) or key is None):
-            name = check_name(self.__class__, name)
+            name = body.port_names.allocate(name)
         self.name = name
         self.pos = Vector(pos)
         self.ori = Vector(ori)
@@ -32,8 +33,7 @@ class Port():
             self.offsets = offsets
             self.N = 0
 
-        if self.body.ports_to_move is not None:
-            find_last_list(self.body.ports_to_move).append(self)
+        self.body.ports_to_move.add(self)
         if key=='name':  # normal initialisation
             self.dict_instances[name] = self
 
@@ -61,14 +61,30 @@ class Port():
     def __repr__(self):
         return self.name
 
+    @property
+    def dict_instances(self):
+        return self.body.port_instances
+
+    @property
+    def variables(self):
+        return self.body.variables
+
+    @property
+    def names(self):
+        return self.body.port_names
+
     @staticmethod
-    def reset():
-        Port.dict_instances  = {}
+    def reset(pm):
+        # forgets the ports of the Modeler pm
+        pm.port_instances.clear()
+        pm.port_names.reset(pm.port_instances)
+        for body in pm.bodies:
+            body.ports_to_move = MoveStack()
 
-    @classmethod
-    def print_instances(cls):
-        for instance_name in cls.dict_instances:
-            print(instance_name)#, cls.dict_instances[instance_name])
+    @staticmethod
+    def print_instances(pm):
+        for instance_name in pm.port_instances:
+            print(instance_name)
 
     def compare(self, other, pm, slope=0.5):
         points = []
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight symbolic expressions, a sympy-free alternative for the design
+variables of a Modeler (see Modeler(mode, engine='native')).
+
+Only the operations used when drawing are supported: +, -, *, /, **, unary
+minus and abs. Expressions print as strings that HFSS understands and are
+evaluated by walking the tree, or through a python function compiled once
+per expression when they are evaluated repeatedly.
+"""
+
+import numpy
+
+# operator precedences used for printing, a negated operand is always put
+# in parentheses
+_PRECEDENCE = {'neg': 0, '+': 1, '-': 1, '*': 2, '/': 2, '**': 3}
+
+
+def _as_number(other):
+    # converts numpy scalars to python numbers, None if other is not a number
+    if isinstance(other, bool):
+        return int(other)
+    if isinstance(other, (int, float)):
+        return other
+    if isinstance(other, numpy.integer):
+        return int(other)
+    if isinstance(other, numpy.floating):
+        return float(other)
+    return None
+
+
+class Expression():
+    """
+    Node of an expression tree: op is either 'symbol' (args = (name,)), a
+    binary operator '+', '-', '*', '/', '**' or one of 'neg' and 'abs'.
+    Leaves which are numbers are kept as python numbers.
+    """
+    __slots__ = ('op', 'args', '_hash', '_free_symbols')
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        self._hash = hash((op, args))
+        self._free_symbols = None
+
+    ### Construction with basic simplifications
+
+    @staticmethod
+    def _binary(op, left, right):
+        left_number = _as_number(left)
+        right_number = _as_number(right)
+        if left_number is None and not isinstance(left, Expression):
+            return NotImplemented
+        if right_number is None and not isinstance(right, Expression):
+            return NotImplemented
+        if left_number is not None and right_number is not None:
+            return _OPERATIONS[op](left_number, right_number)
+        if left_number is not None:
+            left = left_number
+        if right_number is not None:
+            right = right_number
+        if op == '+':
+            if left_number == 0:
+                return right
+            if right_number == 0:
+                return left
+        elif op == '-':
+            if right_number == 0:
+                return left
+            if left_number == 0:
+                return -right
+        elif op == '*':
+            if left_number == 0 or right_number == 0:
+                return 0
+            if left_number == 1:
+                return right
+            if right_number == 1:
+                return left
+        elif op == '/':
+            if left_number == 0:
+                return 0
+            if right_number == 1:
+                return left
+        elif op == '**':
+            if right_number == 1:
+                return left
+            if right_number == 0:
+                return 1
+        return Expression(op, left, right)
+
+    def __add__(self, other):
+        return Expression._binary('+', self, other)
+
+    def __radd__(self, other):
+        return Expression._binary('+', other, self)
+
+    def __sub__(self, other):
+        return Expression._binary('-', self, other)
+
+    def __rsub__(self, other):
+        return Expression._binary('-', other, self)
+
+    def __mul__(self, other):
+        return Expression._binary('*', self, other)
+
+    def __rmul__(self, other):
+        return Expression._binary('*', other, self)
+
+    def __truediv__(self, other):
+        return Expression._binary('/', self, other)
+
+    def __rtruediv__(self, other):
+        return Expression._binary('/', other, self)
+
+    def __pow__(self, other):
+        return Expression._binary('**', self, other)
+
+    def __rpow__(self, other):
+        return Expression._binary('**', other, self)
+
+    def __neg__(self):
+        if self.op == 'neg':
+            return self.args[0]
+        return Expression('neg', self)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        if self.op == 'abs':
+            return self
+        return Expression('abs', self)
+
+    ### Comparisons
+
+    def __eq__(self, other):
+        # structural equality, as for sympy expressions
+        if not isinstance(other, Expression):
+            return False
+        return (self._hash == other._hash and self.op == other.op
+                and self.args == other.args)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    # ordering compares the numerical values
+    def __lt__(self, other):
+        return _evaluate(self) < _evaluate(other)
+
+    def __le__(self, other):
+        return _evaluate(self) <= _evaluate(other)
+
+    def __gt__(self, other):
+        return _evaluate(self) > _evaluate(other)
+
+    def __ge__(self, other):
+        return _evaluate(self) >= _evaluate(other)
+
+    ### Inspection
+
+    @property
+    def free_symbols(self):
+        if self._free_symbols is None:
+            if self.op == 'symbol':
+                self._free_symbols = frozenset([self])
+            else:
+                symbols = set()
+                for arg in self.args:
+                    if isinstance(arg, Expression):
+                        symbols |= arg.free_symbols
+                self._free_symbols = frozenset(symbols)
+        return self._free_symbols
+
+    @property
+    def name(self):
+        if self.op != 'symbol':
+            raise AttributeError('Only symbols have a name')
+        return self.args[0]
+
+    def _to_str(self, leaf):
+        # leaf returns the string of a symbol
+        if self.op == 'symbol':
+            return leaf(self)
+        if self.op == 'abs':
+            return 'abs(%s)'%_arg_str(self.args[0], leaf, 0)
+        precedence = _PRECEDENCE[self.op]
+        if self.op == 'neg':
+            return '-%s'%_arg_str(self.args[0], leaf, _PRECEDENCE['*'])
+        left, right = self.args
+        if self.op == '**':
+            # power is right associative
+            left_str = _arg_str(left, leaf, precedence+1)
+            right_str = _arg_str(right, leaf, precedence)
+            return '%s**%s'%(left_str, right_str)
+        left_str = _arg_str(left, leaf, precedence)
+        right_str = _arg_str(right, leaf, precedence+(self.op in '-/'))
+        if self.op in '+-':
+            return '%s %s %s'%(left_str, self.op, right_str)
+        return '%s%s%s'%(left_str, self.op, right_str)
+
+    def __str__(self):
+        return self._to_str(lambda symbol: symbol.args[0])
+
+    def __repr__(self):
+        return str(self)
+
+    def evaluate(self, values):
+        """
+        Returns the value of the expression, values giving the value of each
+        symbol. Cheaper than compile for an expression evaluated once.
+        """
+        if self.op == 'symbol':
+            return values[self]
+        args = [arg.evaluate(values) if isinstance(arg, Expression) else arg
+                for arg in self.args]
+        if self.op == 'neg':
+            return -args[0]
+        if self.op == 'abs':
+            return abs(args[0])
+        return _OPERATIONS[self.op](*args)
+
+    def compile(self, indices):
+        """
+        Returns a python function computing the expression from the packed
+        list of variable values, indices giving the position of each symbol.
+        """
+        source = self._to_str(lambda symbol: 'values[%d]'%indices[symbol])
+        return eval('lambda values: '+source, {'abs': abs})
+
+
+def _arg_str(arg, leaf, min_precedence):
+    if isinstance(arg, Expression):
+        if arg.op in _PRECEDENCE and _PRECEDENCE[arg.op] < min_precedence:
+            return '(%s)'%arg._to_str(leaf)
+        return arg._to_str(leaf)
+    if arg < 0:
+        return '(%r)'%arg
+    return repr(arg)
+
+
+_OPERATIONS = {'+': lambda a, b: a+b,
+               '-': lambda a, b: a-b,
+               '*': lambda a, b: a*b,
+               '/': lambda a, b: a/b,
+               '**': lambda a, b: a**b}
+
+
+def _evaluate(elt):
+    # late import, utils holds the values of the variables
+    from .utils import val
+    return val(elt)
+
+
+def Symbol(name):
+    return Expression('symbol', name)
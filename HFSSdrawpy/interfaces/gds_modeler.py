@@ -5,30 +5,474 @@ Created on Mon Nov  4 11:13:09 2019
 @author: antho
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import io
+import itertools
+import os
+import struct
+import weakref
+
 import numpy as np
 import gdspy
 
-from ..utils import parse_entry, val, Vector
-from ..core.entity import gen_name
+from ..utils import parse_entry, val, val_array, Vector, rotation_cos_sin, \
+                    ori2angle, IndexedList, GridIndex
 
 TOLERANCE = 1e-8 # for arcs
-print("gdspy_version : ",gdspy.__version__)
+# axis-aligned operands with fewer vertices are not tiled by tiled_boolean,
+# a single manhattan_boolean is faster than dispatching the tiles
+SCANLINE_VERTICES = 20000
+
+def polygon_bounding_boxes(polygons):
+    # array of the ((xmin, ymin), (xmax, ymax)) of each polygon
+    if not polygons:
+        return np.empty((0, 2, 2))
+    starts = np.cumsum([0]+[len(points) for points in polygons[:-1]])
+    vertices = np.concatenate(polygons)
+    return np.stack([np.minimum.reduceat(vertices, starts),
+                     np.maximum.reduceat(vertices, starts)], axis=1)
+
+class PiecewisePolygonSet(gdspy.PolygonSet):
+    """
+    PolygonSet whose polygons are abutting pieces of a region, e.g. the
+    rectangles of manhattan_boolean or the tiles of tiled_boolean. The pieces
+    are merged with gdspy.boolean before operations relying on the vertices
+    of the outline, such as fillets.
+    """
+    __slots__ = ()
+
+def snap_polygons(polygons, precision):
+    """
+    Rounds the vertices of a list of polygons to the grid of database units
+    of size precision, and removes the vertices repeated consecutively.
+    Snapped coordinates are exact multiples of precision, so that they are
+    written without rounding and identical vertices compare equal.
+    """
+    if not polygons:
+        return []
+    if len(polygons) == 1:
+        # faster for the single polygons of new entities
+        points = np.rint(polygons[0]/precision)*precision
+        repeated = points[1:] == points[:-1]
+        if (not (repeated[:, 0] & repeated[:, 1]).any()
+                and (points[0] != points[-1]).any()):
+            return [points]
+    return snap_vertices(np.concatenate(polygons),
+                         [len(points) for points in polygons], precision)
+
+def snap_vertices(vertices, lengths, precision):
+    # snap_polygons of the polygons given as concatenated vertices and the
+    # numbers of vertices of each polygon
+    lengths = np.asarray(lengths)
+    points = np.rint(vertices/precision)*precision
+    # a vertex equal to the previous one of its polygon is removed, the first
+    # vertex is compared to the last one
+    starts = np.cumsum(lengths)-lengths
+    previous = np.arange(len(points))-1
+    previous[starts] = starts+lengths-1
+    kept = (points != points[previous]).any(axis=1)
+    if kept.all():
+        return np.split(points, np.cumsum(lengths[:-1]))
+    counts = np.add.reduceat(kept, starts)
+    # a polygon reduced to a single point keeps it
+    kept[starts[counts == 0]] = True
+    counts = np.maximum(counts, 1)
+    return np.split(points[kept], np.cumsum(counts[:-1]))
+
+# placements of a cell, they are moved without touching the cell
+_REFERENCES = (gdspy.CellReference, gdspy.CellArray)
+
+def gds_polygons(gds_object):
+    # list of the polygons of a gdspy object
+    if isinstance(gds_object, gdspy.PolygonSet):
+        return gds_object.polygons
+    return gds_object.get_polygons()
+
+def manhattan_boolean(polygons1, polygons2, operation, precision=1e-9):
+    """
+    Boolean operation 'or', 'and' or 'not' of two lists of polygons whose
+    edges are all horizontal or vertical. It is computed exactly on integer
+    database units of size precision, by a scanline over the vertical edges
+    keeping the nonzero winding number of each operand.
+    The slabs between consecutive edges are processed by blocks, each on the
+    y breakpoints of its edges and of the winding numbers entering it, so
+    that the cost follows the number of edges crossing the scanline rather
+    than the number of unique x times unique y.
+    Returns the result as a list of rectangles, or None if a polygon is not
+    axis-aligned.
+    """
+    polygons = list(polygons1)+list(polygons2)
+    if not polygons:
+        return []
+    lengths = np.array([len(points) for points in polygons])
+    points = np.round(np.concatenate(polygons)/precision).astype(np.int64)
+    # index of the following vertex in each polygon
+    starts = np.cumsum(lengths)-lengths
+    following = np.arange(len(points))+1
+    following[starts+lengths-1] = starts
+    dx, dy = (points[following]-points).T
+    if ((dx != 0) & (dy != 0)).any():
+        return None
+
+    operands = np.repeat(np.arange(len(polygons)) >= len(polygons1), lengths)
+    # as in gdspy, each polygon counts positively whatever its orientation
+    cross = points[:, 0]*points[following, 1]-points[following, 0]*points[:, 1]
+    orientations = np.repeat(np.sign(np.add.reduceat(cross, starts)), lengths)
+    vertical = (dx == 0) & (dy != 0)
+    xs = points[vertical, 0]
+    y0s, y1s = points[vertical, 1], points[following][vertical, 1]
+    # crossing an edge going down from left to right enters a
+    # counterclockwise polygon
+    windings = np.where(y1s < y0s, 1, -1)*orientations[vertical]
+    lows, highs = np.minimum(y0s, y1s), np.maximum(y0s, y1s)
+    operands = operands[vertical].astype(int)
+
+    xs_unique, groups = np.unique(xs, return_inverse=True)
+    if len(xs_unique) < 2:
+        return []
+    order = np.argsort(groups, kind='stable')
+    groups, operands, windings = groups[order], operands[order], windings[order]
+    lows, highs = lows[order], highs[order]
+    edge_starts = np.searchsorted(groups, np.arange(len(xs_unique)+1))
+    combine = {'or': np.logical_or, 'and': np.logical_and,
+               'not': lambda inside1, inside2: inside1 & ~inside2}[operation]
+
+    # winding numbers of both operands entering the block, on the intervals
+    # between the breakpoints carry_ys, zero outside
+    carry_ys = np.zeros(0, dtype=np.int64)
+    carry = np.zeros((2, 0), dtype=np.int64)
+    runs = []  # (slab, y0, y1) of the intervals inside the result
+    first = 0
+    while first < len(xs_unique)-1:
+        # about as many edges in the block as breakpoints entering it, which
+        # bounds its size by twice the slabs times the breakpoints
+        budget = max(len(carry_ys), 256)
+        last = np.searchsorted(edge_starts, edge_starts[first]+budget,
+                               side='right')-1
+        last = min(max(last, first+1), len(xs_unique)-1)
+        selected = slice(edge_starts[first], edge_starts[last])
+        ys = np.unique(np.concatenate([carry_ys, lows[selected],
+                                       highs[selected]]))
+        n_ys = len(ys)
+        delta = np.zeros((last-first, 2, n_ys), dtype=np.int64)
+        indices = (groups[selected]-first, operands[selected])
+        np.add.at(delta, indices+(np.searchsorted(ys, lows[selected]),),
+                  windings[selected])
+        np.add.at(delta, indices+(np.searchsorted(ys, highs[selected]),),
+                  -windings[selected])
+        winding = np.cumsum(np.cumsum(delta, axis=2)[:, :, :-1], axis=0)
+        if len(carry_ys):
+            intervals = np.searchsorted(carry_ys, ys[:-1], side='right')-1
+            entering = (intervals >= 0) & (intervals < len(carry_ys)-1)
+            winding[:, :, entering] += carry[:, intervals[entering]]
+        inside = combine(winding[:, 0] != 0, winding[:, 1] != 0)
+        changes = np.diff(np.pad(inside.astype(np.int8), ((0, 0), (1, 1))),
+                          axis=1)
+        slabs, ilows = np.nonzero(changes == 1)
+        _, ihighs = np.nonzero(changes == -1)
+        runs.append((slabs+first, ys[ilows], ys[ihighs]))
+        # only the breakpoints where the winding numbers change are kept
+        padded = np.pad(winding[-1], ((0, 0), (1, 1)))
+        changed = (np.diff(padded, axis=1) != 0).any(axis=0)
+        carry_ys = ys[changed]
+        carry = padded[:, 1:][:, changed][:, :-1]
+        first = last
+    slabs, y0s, y1s = (np.concatenate(arrays) for arrays in zip(*runs))
+    if len(slabs) == 0:
+        return []
+
+    # the same interval in consecutive slabs forms a single rectangle
+    order = np.lexsort((slabs, y1s, y0s))
+    slabs, y0s, y1s = slabs[order], y0s[order], y1s[order]
+    new = np.ones(len(slabs), dtype=bool)
+    new[1:] = ((y0s[1:] != y0s[:-1]) | (y1s[1:] != y1s[:-1])
+               | (slabs[1:] != slabs[:-1]+1))
+    firsts = np.flatnonzero(new)
+    lasts = np.append(firsts[1:], len(slabs))-1
+    x0s, x1s = xs_unique[slabs[firsts]], xs_unique[slabs[lasts]+1]
+    y0s, y1s = y0s[firsts], y1s[firsts]
+    corners = np.stack([np.stack([x0s, y0s], axis=1),
+                        np.stack([x1s, y0s], axis=1),
+                        np.stack([x1s, y1s], axis=1),
+                        np.stack([x0s, y1s], axis=1)], axis=1)
+    return list(corners*precision)
+
+def boolean(polygons1, polygons2, operation, layer=0, precision=1e-9):
+    """
+    gdspy.boolean of two lists of polygons, computed by manhattan_boolean when
+    all the polygons are axis-aligned. Returns a PolygonSet snapped to the
+    database unit grid of size precision, or None if the result is empty.
+    """
+    rects = manhattan_boolean(polygons1, polygons2, operation, precision)
+    if rects is None:
+        result = gdspy.boolean(polygons1, polygons2, operation,
+                               precision=TOLERANCE, max_points=0, layer=layer)
+        if result is not None:
+            result.polygons = snap_polygons(result.polygons, precision)
+        return result
+    if not rects:
+        return None
+    return PiecewisePolygonSet(rects, layer=layer)
+
+def _workers(workers):
+    # number of worker processes, all the cpus if None
+    if workers is None:
+        return os.cpu_count() or 1
+    return workers
+
+class WorkerPool():
+    """
+    Worker processes of a GdsModeler, created when first needed and kept
+    between the calls of _map so that each parallel operation does not pay
+    for starting processes. They are shut down by shutdown, when the pool is
+    garbage collected and at exit.
+    """
+    def __init__(self):
+        self.executor = None
+        self.workers = None
+        self._finalizer = None
+
+    def get(self, workers):
+        # executor with workers processes, the previous one is shut down if it
+        # has another number of processes
+        if self.executor is not None and self.workers != workers:
+            self.shutdown()
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(workers)
+            self.workers = workers
+            self._finalizer = weakref.finalize(self, self.executor.shutdown)
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self._finalizer()
+            self.executor = None
+            self.workers = None
+
+def _map(function, tasks, workers, pool=None):
+    # results of function on the argument tuples of tasks, in order, computed
+    # in workers worker processes (all the cpus if None) of pool, or of a
+    # temporary pool if None
+    workers = _workers(workers)
+    if workers == 1 or len(tasks) < 2:
+        return [function(*task) for task in tasks]
+    chunksize = max(1, len(tasks)//(4*workers))
+    if pool is not None:
+        return list(pool.get(workers).map(function, *zip(*tasks),
+                                          chunksize=chunksize))
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(function, *zip(*tasks),
+                                 chunksize=chunksize))
+
+def _boolean_tile(polygons1, polygons2, operation, tile, precision):
+    # boolean operation of the polygons clipped to the tile, run in the
+    # worker processes of tiled_boolean
+    if operation == 'or':
+        result = boolean(polygons1+polygons2, [tile], 'and',
+                         precision=precision)
+    else:
+        result = boolean(polygons1, [tile], 'and', precision=precision)
+        if result is not None and polygons2:
+            result = boolean(result.polygons, polygons2, 'not',
+                             precision=precision)
+    return [] if result is None else result.polygons
+
+def tiled_boolean(polygons1, polygons2, operation, tile_size, processes=None,
+                  precision=1e-9, pool=None):
+    """
+    Boolean operation 'or' or 'not' of two lists of polygons computed tile
+    by tile on a grid of square tiles of size tile_size. Each tile only gets
+    the polygons whose bounding box overlaps it, and the tiles are
+    processed in parallel in processes worker processes (all the cpus if
+    None, no worker process if 1) of pool, a WorkerPool.
+    Tiling pays off for curved polygons with many holes, for which a single
+    gdspy.boolean is superlinear, and each tile of axis-aligned polygons is
+    computed by manhattan_boolean. Axis-aligned operands of fewer than
+    SCANLINE_VERTICES vertices are rather computed at once by
+    manhattan_boolean, and so are the operations with fewer tiles than
+    processes.
+    Returns the polygons of the result, cut along the tile boundaries when
+    tiled. The covered area is the same as with a single gdspy.boolean.
+
+    On Windows, the worker processes import the main script again: a script
+    using several processes should draw under `if __name__ == '__main__':`.
+    """
+    n_vertices = (sum(len(points) for points in polygons1)
+                  + sum(len(points) for points in polygons2))
+    if n_vertices < SCANLINE_VERTICES:
+        rects = manhattan_boolean(polygons1, polygons2, operation, precision)
+        if rects is not None:
+            return rects
+    bboxes1 = polygon_bounding_boxes(polygons1)
+    bboxes2 = polygon_bounding_boxes(polygons2)
+    # only the tiles overlapping polygons1 can contain a difference
+    bboxes = bboxes1 if operation == 'not' else np.concatenate([bboxes1,
+                                                                bboxes2])
+    if len(bboxes) == 0:
+        return []
+    # the tiles overlapped by the bounding box of each polygon, the
+    # polygons over several tiles are repeated
+    lows = np.floor(np.concatenate([bboxes1, bboxes2])[:, 0]
+                    /tile_size).astype(int)
+    highs = np.floor(np.concatenate([bboxes1, bboxes2])[:, 1]
+                     /tile_size).astype(int)
+    sizes = highs-lows+1
+    counts = sizes[:, 0]*sizes[:, 1]
+    found = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(len(found))-np.repeat(np.cumsum(counts)-counts,
+                                              counts)
+    iis = lows[found, 0]+offsets//sizes[found, 1]
+    jjs = lows[found, 1]+offsets % sizes[found, 1]
+    # grouped by tile, in the order of the polygons within each tile
+    order = np.lexsort((found, jjs, iis))
+    found, iis, jjs = found[order], iis[order], jjs[order]
+    firsts = np.flatnonzero(np.diff(iis, prepend=iis[0]-1)
+                            | np.diff(jjs, prepend=jjs[0]-1))
+    lasts = np.append(firsts[1:], len(found))
+
+    tasks = []
+    for first, last in zip(firsts.tolist(), lasts.tolist()):
+        ii, jj = int(iis[first]), int(jjs[first])
+        x0, y0 = ii*tile_size, jj*tile_size
+        x1, y1 = (ii+1)*tile_size, (jj+1)*tile_size
+        tile_found = found[first:last].tolist()
+        tile_polygons1 = [polygons1[kk] for kk in tile_found
+                          if kk < len(polygons1)]
+        tile_polygons2 = [polygons2[kk-len(polygons1)] for kk in tile_found
+                          if kk >= len(polygons1)]
+        if tile_polygons1 or (operation == 'or' and tile_polygons2):
+            tile = np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+            tasks.append((tile_polygons1, tile_polygons2, operation, tile,
+                          precision))
+
+    processes = _workers(processes)
+    if len(tasks) < processes:
+        result = boolean(polygons1, polygons2, operation, precision=precision)
+        return [] if result is None else result.polygons
+    results = _map(_boolean_tile, tasks, processes, pool)
+    return [polygon for result in results for polygon in result]
+
+def _fracture(polygons, layers, datatypes, max_points, precision):
+    # fractures polygons into pieces of at most max_points vertices, run in
+    # the worker processes of GdsModeler.generate_gds
+    polygon_set = gdspy.PolygonSet(list(polygons))
+    polygon_set.layers, polygon_set.datatypes = list(layers), list(datatypes)
+    polygon_set.fracture(max_points=max_points, precision=precision)
+    return (snap_polygons(polygon_set.polygons, precision),
+            polygon_set.layers, polygon_set.datatypes)
+
+def _write_cell(cell, filename, library_name, unit, precision, timestamp):
+    # writes a cell and the cells it references in its own gds file as
+    # GdsLibrary.write_gds, run in the worker processes of
+    # GdsModeler.generate_gds
+    library = gdspy.GdsLibrary(library_name, unit=unit, precision=precision)
+    dependencies = sorted(cell.get_dependencies(True),
+                          key=lambda dependency: dependency.name)
+    library.write_gds(filename, cells=[cell]+dependencies,
+                      timestamp=timestamp)
+
+def _cell_bytes(cell, multiplier, timestamp):
+    # GDSII structure of a cell, run in the worker processes of
+    # GdsModeler.generate_gds
+    outfile = io.BytesIO()
+    cell.to_gds(outfile, multiplier, timestamp=timestamp)
+    return outfile.getvalue()
+
+class GdsCellStream():
+    """
+    GDSII file of a single cell written incrementally: each call to write
+    appends elements of the cell to the structure of the file, so that they
+    can be released from memory. close finalizes the file, which is the same
+    as the one of GdsLibrary.write_gds when the cell is written at once.
+    """
+    def __init__(self, filename, cell_name, library_name='library', unit=1.0,
+                 precision=1e-9, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.today()
+        self.multiplier = unit/precision
+        self.outfile = open(filename, 'wb')
+        # library header
+        self.writer = gdspy.GdsWriter(self.outfile, library_name, unit,
+                                      precision, timestamp)
+        # structure header, as in gdspy.Cell.to_gds
+        name = cell_name if len(cell_name) % 2 == 0 else cell_name+'\0'
+        date = (timestamp.year, timestamp.month, timestamp.day,
+                timestamp.hour, timestamp.minute, timestamp.second)
+        self.outfile.write(struct.pack('>2H12h2H', 28, 0x0502, *date*2,
+                                       4+len(name), 0x0606)
+                           + name.encode('ascii'))
+        self.timestamp = timestamp
+        self.dependencies = {}  # referenced cells, written at the end
+
+    def write(self, elements):
+        dependencies = set()
+        for element in elements:
+            element.to_gds(self.outfile, self.multiplier)
+            if isinstance(element, _REFERENCES):
+                dependencies.add(element.ref_cell)
+                dependencies |= element.ref_cell.get_dependencies(True)
+        for dependency in sorted(dependencies,
+                                 key=lambda dependency: dependency.name):
+            self.dependencies.setdefault(dependency.name, dependency)
+
+    def close(self):
+        self.outfile.write(struct.pack('>2H', 4, 0x0700))  # end of structure
+        for dependency in self.dependencies.values():
+            dependency.to_gds(self.outfile, self.multiplier,
+                              timestamp=self.timestamp)
+        self.writer.close()  # end of library
+        self.outfile.close()
+
+class Redrawn():
+    """
+    Stand-in for an entity, or one of its boolean tools, drawn again by
+    GdsModeler.redraw: the interface methods only use its name, body and
+    layer. Its gds object is removed from the interface if it is deleted,
+    e.g. fully subtracted.
+    """
+    names = itertools.count()
+
+    def __init__(self, interface, body, layer):
+        self.interface = interface
+        self.name = '#redrawn_%d'%next(self.names)
+        self.body = body
+        self.layer = layer
+
+    def delete(self):
+        self.interface.delete(self)
 
 class GdsModeler():
-    gds_object_instances = {}
-    gds_cells  = {}
     dict_units = {'km':1.0e3,'m':1.0,'cm':1.0e-2,'mm':1.0e-3}
     # coor_systems = {'Global':[[0,0,0],[1,0]]}
     # coor_system = coor_systems['Global']
 
     def __init__(self, unit=1.0e-6, precision=1.0e-9):
+        # precision is the size in meters of the database unit, the vertices
+        # of the polygons are snapped to this grid when they are created
         self.unit = unit
         self.precision = precision
-        gdspy.current_library = gdspy.GdsLibrary()
-
-    @classmethod
-    def print_instances(cls):
-        for instance_name in cls.gds_object_instances:
+        self.streams = {}  # cell name -> GdsCellStream, see stream_gds
+        self.pool = WorkerPool()
+        self.reset()
+
+    def reset(self):
+        # each GdsModeler has its own library, independent from the global
+        # gdspy.current_library
+        for stream in self.streams.values():
+            stream.close()  # the streamed files are finalized as they are
+        self.streams = {}
+        self.pool.shutdown()
+        self.library = gdspy.GdsLibrary(unit=1.0, precision=self.precision)
+        self.gds_object_instances = {}
+        self.gds_cells = {}
+        self.coor_systems = {}  # coor_sys -> (rel_coor, ref_name)
+        self.component_cells = {}  # cells only placed by references
+        self.cell = None
+        self.stream_options = None
+
+    def print_instances(self):
+        for instance_name in self.gds_object_instances:
             print(instance_name)
 
     def reset_cell(self):
@@ -36,24 +480,72 @@ class GdsModeler():
 
     def create_coor_sys(self, coor_sys='chip', rel_coor=None,
                         ref_name='Global'):
-        # this creates a cell, should not care about the rel_coor
-        if not (coor_sys in gdspy.current_library.cells.keys()):
-            cell = gdspy.Cell(coor_sys)
+        # this creates a cell, the rel_coor only places the cell in the
+        # cell of ref_name in hierarchical exports
+        if rel_coor is None:
+            rel_coor = [[0, 0, 0], [1, 0, 0], [0, 1, 0]]
+        self.coor_systems[coor_sys] = (rel_coor, ref_name)
+        if not (coor_sys in self.library.cells.keys()):
+            cell = self.new_cell(coor_sys)
             self.gds_cells[coor_sys] = cell
         else:
             cell = self.gds_cells[coor_sys]
         # active cell should be the new cell
         self.cell = cell
 
+    def make_component(self, cell_name):
+        # the cell of cell_name is only placed by references, it is not
+        # written on its own nor referenced by the top cell
+        self.component_cells[cell_name] = self.gds_cells.pop(cell_name)
+        self.coor_systems.pop(cell_name)
+
+    def cell_reference(self, cell_name, **kwargs):
+        reference = gdspy.CellReference(self.component_cells[cell_name],
+                                        (0, 0))
+        self.gds_object_instances[kwargs['name']] = reference
+        self.cell.add(reference)
+
+    def snap(self, gds_object):
+        # snaps the polygons of a gds object to the database unit grid
+        if isinstance(gds_object, gdspy.PolygonSet):
+            gds_object.polygons = snap_polygons(gds_object.polygons,
+                                                self.precision)
+        return gds_object
+
+    def new_cell(self, name):
+        cell = gdspy.Cell(name, exclude_from_current=True)
+        # O(1) removal of the polygons in deletions and booleans
+        cell.polygons = IndexedList()
+        self.library.add(cell, overwrite_duplicate=True)
+        return cell
+
     def set_coor_sys(self, coor_sys):
         if coor_sys in self.gds_cells.keys():
             self.cell = self.gds_cells[coor_sys]
         else:
             raise ValueError('%s cell do not exist'%coor_sys)
 
-    def copy(self, entity):
-        new_polygon = gdspy.copy(self.gds_object_instances[entity.name], 0, 0)
-        new_name = gen_name(entity.name)
+    def get_coor_sys(self):
+        # None if the active cell is not a coordinate system e.g. a component
+        cell = getattr(self, 'cell', None)
+        if cell is None or self.gds_cells.get(cell.name) is not cell:
+            return None
+        return cell.name
+
+    def copy(self, entity, new_name):
+        gds_entity = self.gds_object_instances[entity.name]
+        if isinstance(gds_entity, gdspy.CellReference):
+            # a deep copy would copy the referenced cell
+            new_polygon = gdspy.CellReference(
+                gds_entity.ref_cell, gds_entity.origin, gds_entity.rotation,
+                gds_entity.magnification, gds_entity.x_reflection)
+        elif isinstance(gds_entity, gdspy.CellArray):
+            new_polygon = gdspy.CellArray(
+                gds_entity.ref_cell, gds_entity.columns, gds_entity.rows,
+                gds_entity.spacing, gds_entity.origin, gds_entity.rotation,
+                gds_entity.magnification, gds_entity.x_reflection)
+        else:
+            new_polygon = gdspy.copy(gds_entity, 0, 0)
         self.gds_object_instances[new_name] = new_polygon
         self.cell.add(new_polygon)
 
@@ -61,21 +553,195 @@ class GdsModeler():
         obj = self.gds_object_instances.pop(entity.name)
         self.gds_object_instances[name]=obj
 
-    def generate_gds(self, file, max_points):
-        for instance in self.gds_object_instances.keys():
-            obj = self.gds_object_instances[instance]
-            if isinstance(obj, gdspy.Polygon) or isinstance(obj, gdspy.PolygonSet):
-                self.gds_object_instances[instance] = obj.fracture(max_points=max_points, precision=1e-9)
-
-        for cell_name in self.gds_cells.keys():
-            filename = file+'_%s.gds'%cell_name
-            gdspy.write_gds(filename, cells=[cell_name],
-                            unit=1.0, precision=1e-9)
+    def generate_gds(self, file, max_points, workers=1, timestamp=None,
+                     hierarchical=False):
+        """
+        Fractures the polygons into pieces of at most max_points vertices
+        (no fracture if max_points is 0) and writes each cell in the file
+        file_<cell name>.gds.
+        If hierarchical, a single library file.gds is written instead, see
+        write_hierarchy.
+        The polygons to fracture and the cells are processed in workers worker
+        processes (all the cpus if None, no worker process if 1). The results
+        are collected in order and all the files have the same timestamp (now
+        if None), so the files are identical whatever the number of workers.
+        As for tiled_boolean, a script using several workers on Windows
+        should draw under `if __name__ == '__main__':`.
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.today()
+        self._fracture(self.gds_object_instances.values(), max_points,
+                       workers)
+        if hierarchical:
+            self.write_hierarchy(file, workers, timestamp)
+            return
+        _map(_write_cell,
+             [(cell, file+'_%s.gds'%cell_name, self.library.name,
+               self.library.unit, self.library.precision, timestamp)
+              for cell_name, cell in self.gds_cells.items()], workers,
+             self.pool)
+
+    def reference(self, coor_sys):
+        # CellReference of the cell of coor_sys placed by its rel_coor, the
+        # new x axis gives the rotation and an indirect frame a reflection
+        rel_coor, _ = self.coor_systems[coor_sys]
+        origin, new_x, new_y = (val(coor) for coor in rel_coor)
+        x_reflection = new_x[0]*new_y[1]-new_x[1]*new_y[0] < 0
+        return gdspy.CellReference(self.gds_cells[coor_sys],
+                                   (origin[0], origin[1]),
+                                   rotation=ori2angle(new_x),
+                                   x_reflection=x_reflection)
+
+    def write_hierarchy(self, file, workers=1, timestamp=None):
+        """
+        Writes the library file.gds whose top cell, named after the file,
+        references the cells of the coordinate systems of ref_name 'Global'.
+        The cell of a coordinate system referring to another one is
+        referenced in the cell of the latter, so that the transforms of the
+        rel_coor chains are composed by the references. Other cells are
+        written only if they are referenced.
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.today()
+        top = gdspy.Cell(os.path.basename(file), exclude_from_current=True)
+        if top.name in self.gds_cells:
+            raise ValueError('the top cell %s has the name of a cell, choose '
+                             'another file name'%top.name)
+        # the references of the chains are added to the cells for the export
+        added = []
+        for coor_sys, (rel_coor, ref_name) in self.coor_systems.items():
+            parent = self.gds_cells[ref_name] \
+                     if ref_name in self.coor_systems else top
+            reference = self.reference(coor_sys)
+            parent.references.append(reference)
+            added.append((parent, reference))
+        try:
+            dependencies = top.get_dependencies(True)
+            cells = [top]+[cell for cell in list(self.gds_cells.values())
+                           +list(self.component_cells.values())
+                           if cell in dependencies]
+            structures = _map(_cell_bytes,
+                              [(cell, self.library.unit/self.library.precision,
+                                timestamp) for cell in cells], workers,
+                              self.pool)
+        finally:
+            for parent, reference in added:
+                parent.references.remove(reference)
+        with open(file+'.gds', 'wb') as outfile:
+            writer = gdspy.GdsWriter(outfile, self.library.name,
+                                     self.library.unit,
+                                     self.library.precision, timestamp)
+            for structure in structures:
+                outfile.write(structure)
+            writer.close()
+
+    def _fracture(self, gds_objects, max_points, workers=1):
+        # fractures in place the polygon sets of gds_objects, only those with
+        # a polygon above max_points are sent to the worker processes
+        polygon_sets = []
+        if max_points > 4:
+            for obj in gds_objects:
+                if (isinstance(obj, gdspy.PolygonSet)
+                        and any(len(points) > max_points
+                                for points in obj.polygons)):
+                    polygon_sets.append(obj)
+        results = _map(_fracture,
+                       [(obj.polygons, obj.layers, obj.datatypes, max_points,
+                         self.precision) for obj in polygon_sets], workers,
+                       self.pool)
+        for obj, (polygons, layers, datatypes) in zip(polygon_sets, results):
+            obj.polygons, obj.layers, obj.datatypes = polygons, layers, \
+                                                      datatypes
+
+    def stream_gds(self, file, max_points, timestamp=None):
+        """
+        Starts the streaming mode: flush writes the current elements of a
+        cell at the end of the file file_<cell name>.gds, fractured into
+        pieces of at most max_points vertices, and close_streams finalizes
+        the files.
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.today()
+        self.close_streams()
+        self.stream_options = (file, max_points, timestamp)
+
+    def flush(self, cell_name, entities=None):
+        # writes the elements of the cell in its stream, or only those of
+        # entities, the caller releases them afterwards
+        if self.stream_options is None:
+            raise ValueError('stream_gds should be called before flushing '
+                             'the cell %s'%cell_name)
+        file, max_points, timestamp = self.stream_options
+        if entities is None:
+            cell = self.gds_cells[cell_name]
+            elements = (list(cell.polygons)+list(cell.paths)
+                        +list(cell.labels)+list(cell.references))
+        else:
+            elements = [self.gds_object_instances[entity.name]
+                        for entity in entities]
+        self._fracture(elements, max_points)
+        if cell_name not in self.streams:
+            self.streams[cell_name] = GdsCellStream(
+                file+'_%s.gds'%cell_name, cell_name, self.library.name,
+                self.library.unit, self.library.precision, timestamp)
+        self.streams[cell_name].write(elements)
+
+    def close_streams(self):
+        # writes the remaining elements of the cells and closes their files
+        if self.stream_options is not None:
+            for cell_name in self.gds_cells:
+                self.flush(cell_name)
+        for stream in self.streams.values():
+            stream.close()
+        self.streams = {}
+        self.stream_options = None
+
+    def merge_pieces(self, entity):
+        # replaces the pieces of a PiecewisePolygonSet by their outline
+        polygon = self.gds_object_instances[entity.name]
+        if isinstance(polygon, PiecewisePolygonSet):
+            merged = self.snap(gdspy.boolean(
+                polygon, None, 'or', precision=TOLERANCE, max_points=0,
+                layer=polygon.layers[0]))
+            self.gds_object_instances[entity.name] = merged
+            cell = self.gds_cells[entity.body.name]
+            cell.polygons.remove(polygon)
+            cell.add(merged)
+        return self.gds_object_instances[entity.name]
 
     def get_vertices(self, entity):
-        polygon = self.gds_object_instances[entity.name]
+        polygon = self.merge_pieces(entity)
         return polygon.polygons[0]
 
+    def get_bounding_boxes(self, entities):
+        # ((xmin, ymin), (xmax, ymax)) of each entity, None if it is empty,
+        # computed on the concatenated vertices of all the entities
+        vertices = []
+        lengths = []
+        for entity in entities:
+            gds_entity = self.gds_object_instances[entity.name]
+            if isinstance(gds_entity, gdspy.PolygonSet):
+                polygons = gds_entity.polygons
+            elif isinstance(gds_entity, _REFERENCES):
+                # not flattened, computed from the box of the cell
+                bbox = gds_entity.get_bounding_box()
+                polygons = [] if bbox is None else [bbox]
+            else:
+                polygons = gds_entity.get_polygons()
+            vertices += polygons
+            lengths.append(sum(len(points) for points in polygons))
+        bboxes = [None]*len(lengths)
+        if not vertices:
+            return bboxes
+        vertices = np.concatenate(vertices)
+        non_empty = [ii for ii, length in enumerate(lengths) if length > 0]
+        starts = np.cumsum([0]+lengths)[non_empty]
+        mins = np.minimum.reduceat(vertices, starts).tolist()
+        maxs = np.maximum.reduceat(vertices, starts).tolist()
+        for ii, bbox_min, bbox_max in zip(non_empty, mins, maxs):
+            bboxes[ii] = (bbox_min, bbox_max)
+        return bboxes
+
     def set_units(self, units='m'):
         self.unit = self.dict_units[units]
 
@@ -90,16 +756,10 @@ class GdsModeler():
         #size is the thickness of the polyline for gds, must be a 2D-list with idential elements
         name = kwargs['name']
         layer = kwargs['layer']
-        points = parse_entry(points)
-
-        #TODO, this is a dirty fixe cause of Vector3D
-
-        points_2D = []
-        for point in points:
-            points_2D.append([point[0], point[1]])
+        points_2D = val_array(points)[:, :2]
 
         if closed:
-            poly1 = gdspy.Polygon(points_2D, layer=layer)
+            poly1 = self.snap(gdspy.Polygon(points_2D, layer=layer))
         else:
             poly1 = gdspy.FlexPath(points_2D, 1e-9, layer=layer)
 
@@ -111,8 +771,14 @@ class GdsModeler():
         name = kwargs['name']
         layer = kwargs['layer']
         #This function neglects the z coordinate
-        points = [(pos[0],pos[1]), (pos[0]+size[0],pos[1]+0), (pos[0]+size[0],pos[1]+size[1]), (pos[0],pos[1]+size[1])]
+        # the corners are snapped to the database unit grid
+        x0, y0, x1, y1 = [round(coor/self.precision)*self.precision
+                          for coor in (pos[0], pos[1], pos[0]+size[0],
+                                       pos[1]+size[1])]
+        points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
         poly1 = gdspy.Polygon(points, layer)
+        if x0 == x1 or y0 == y1:
+            self.snap(poly1)  # removes the repeated vertices
 
         self.gds_object_instances[name] = poly1
         self.cell.add(poly1)
@@ -130,7 +796,7 @@ class GdsModeler():
         name = kwargs['name']
         layer = kwargs['layer']
         assert axis=='Z', "axis must be 'Z' for the gdsModeler"
-        round1 = gdspy.Round((pos[0],pos[1]), radius, layer=layer, tolerance=TOLERANCE, number_of_points=number_of_points)
+        round1 = self.snap(gdspy.Round((pos[0],pos[1]), radius, layer=layer, tolerance=TOLERANCE, number_of_points=number_of_points))
         self.gds_object_instances[name] = round1
         self.cell.add(round1)
 
@@ -143,12 +809,7 @@ class GdsModeler():
         self.disk(bond2, bond_diam/2, 'Z', layer=kwargs['layer'], name=kwargs['name']+'b', number_of_points=6)
 
     def path(self, points, port, fillet, name='', corner="circular bend"):
-
-        #TODO, this is a dirty fixe cause of Vector3D
-
-        points_2D = []
-        for point in points:
-            points_2D.append([point[0], point[1]])
+        points_2D = val_array(points)[:, :2]
 
         # use dummy layers to recover the right elements
         layers = [ii  for ii in range(len(port.widths))]
@@ -161,7 +822,7 @@ class GdsModeler():
         names = []
         layers = []
         for ii in range(len(polygons)):
-            poly = gdspy.Polygon(polygons[ii])
+            poly = self.snap(gdspy.Polygon(polygons[ii]))
             poly.layers = [port.layers[ii]]
             current_name = name+'_'+port.subnames[ii]
             names.append(current_name)
@@ -174,34 +835,112 @@ class GdsModeler():
         pass
 
     def delete(self, entity):
-        self.cell.polygons.remove(self.gds_object_instances[entity.name])
-        self.gds_object_instances.pop(entity.name)
+        gds_entity = self.gds_object_instances.pop(entity.name)
+        cell = self.gds_cells[entity.body.name]
+        if isinstance(gds_entity, gdspy.PolygonSet):
+            cell.polygons.remove(gds_entity)
+        elif isinstance(gds_entity, _REFERENCES):
+            cell.references.remove(gds_entity)
+        else:
+            cell.paths.remove(gds_entity)  # open polyline
+
+    def redraw(self, entity, history):
+        # replaces the gds object of entity by the replay of history, a
+        # sequence of (method, args, kwargs) calls recorded by the entity,
+        # see Modeler.redraw
+        previous = self.get_coor_sys()
+        try:
+            redrawn = self._replay(history, entity.body, entity.layer)
+        finally:
+            if previous is not None:
+                self.set_coor_sys(previous)
+        self.delete(entity)
+        if redrawn.name in self.gds_object_instances:
+            self.rename(redrawn, entity.name)
+        else:
+            print('Warning: the entity %s was fully subtracted when '
+                  'redrawn'%entity.name)
+            # kept empty, it is drawn again by the next change
+            empty = gdspy.PolygonSet([], layer=entity.layer)
+            self.gds_object_instances[entity.name] = empty
+            self.gds_cells[entity.body.name].add(empty)
+
+    def _replay(self, history, body, layer):
+        # draws history as a new Redrawn in the cell of body
+        redrawn = Redrawn(self, body, layer)
+        self.set_coor_sys(body.name)
+        for method, args, kwargs in history:
+            if redrawn.name not in self.gds_object_instances and \
+                    method not in ('rect', 'disk', 'polyline'):
+                break  # fully subtracted
+            if method in ('subtract', 'unite'):
+                tools = [self._replay(tool_history, body, layer)
+                         for tool_history in args[0]]
+                tools = [tool for tool in tools
+                         if tool.name in self.gds_object_instances]
+                if method == 'subtract':
+                    self.subtract([redrawn], tools, **kwargs)
+                else:
+                    self.unite([redrawn]+tools, **kwargs)
+                for tool in tools:
+                    self.delete(tool)
+            elif method == 'fillet':
+                self.fillet(redrawn, val(args[0]), *args[1:])
+            elif method in ('rotate', 'translate'):
+                getattr(self, method)([redrawn], val(args[0]))
+            else:
+                # primitive, polyline evaluates its points itself
+                if method != 'polyline':
+                    args = [val(arg) for arg in args]
+                kwargs = dict(kwargs, name=redrawn.name, layer=layer)
+                getattr(self, method)(*args, **kwargs)
+        return redrawn
 
     def rename_entity(self, entity, name):
         polygon = self.gds_object_instances.pop(entity.name)
         self.gds_object_instances[name] = polygon
 
-    def unite(self, entities, keep_originals=True):
+    def _tool_polygons(self, tool_entities):
+        # polygons of the tool entities of a boolean operation
+        tool_polygons = []
+        for tool_entity in tool_entities:
+            tool_polygons += gds_polygons(
+                self.gds_object_instances[tool_entity.name])
+        return tool_polygons
+
+    def check_blanks(self, blank_entities):
+        # the result of a boolean replaces the polygons of its blank, which
+        # cannot be a reference to a cell. References are flattened as tools.
+        for blank_entity in blank_entities:
+            if isinstance(self.gds_object_instances[blank_entity.name],
+                          _REFERENCES):
+                raise TypeError("The entity '%s' places a cell by reference "
+                                "(component or array) and cannot be the blank "
+                                "of a boolean operation"%blank_entity.name)
+
+    def unite(self, entities, keep_originals=True, tile_size=None,
+              processes=None):
 
         blank_entity = entities.pop(0)
         blank_polygon = self.gds_object_instances.pop(blank_entity.name)
         self.cell = self.gds_cells[blank_entity.body.name]
         self.cell.polygons.remove(blank_polygon)
 
-        tool_polygons = []
-        for tool_entity in entities:
-            tool_polygon = self.gds_object_instances[tool_entity.name]
-            if isinstance(tool_polygon, gdspy.PolygonSet):
-                for polygon in tool_polygon.polygons:
-                    tool_polygons.append(polygon)
-            else:
-                tool_polygons.append(tool_polygon)
+        tool_polygons = self._tool_polygons(entities)
 
         #2 unite operation
-        tool_polygon_set = gdspy.PolygonSet(tool_polygons, layer = blank_entity.layer)
-        united = gdspy.boolean(blank_polygon, tool_polygon_set, 'or',
-                               precision=TOLERANCE, max_points=0,
-                               layer=blank_entity.layer)
+        if tool_polygons and tile_size is not None:
+            united = PiecewisePolygonSet(
+                tiled_boolean(gds_polygons(blank_polygon), tool_polygons,
+                              'or', tile_size, processes=processes,
+                              precision=self.precision, pool=self.pool),
+                layer=blank_entity.layer)
+        elif tool_polygons:
+            united = boolean(gds_polygons(blank_polygon), tool_polygons, 'or',
+                             layer=blank_entity.layer,
+                             precision=self.precision)
+        else:
+            united = blank_polygon  # nothing to unite
 
         self.gds_object_instances[blank_entity.name] = united
         self.cell.add(united)
@@ -211,35 +950,72 @@ class GdsModeler():
     def intersect(self, entities):
         raise NotImplementedError()
 
-    def subtract(self, blank_entities, tool_entities, keep_originals=True):
-        if isinstance(blank_entities, list):
-            for blank_entity in blank_entities:
-                self.subtract(blank_entity, tool_entities,
-                              keep_originals=keep_originals)
-        else:
-            blank_entity = blank_entities
-            #1 We clear the cell of all elements and create lists to store the polygons
+    def subtract(self, blank_entities, tool_entities, keep_originals=True,
+                 tile_size=None, processes=None):
+        if not isinstance(blank_entities, list):
+            blank_entities = [blank_entities]
+        # the tool polygons and their bounding boxes are computed once for
+        # all the blank entities, each blank only uses the tool polygons
+        # overlapping its bounding box
+        tool_polygons = self._tool_polygons(tool_entities)
+        tool_bboxes = polygon_bounding_boxes(tool_polygons)
+
+        #1 We clear the cell of the blank polygons, each blank is given the
+        # indices of the tool polygons overlapping its bounding box
+        blanks = []
+        for blank_entity in blank_entities:
             blank_polygon = self.gds_object_instances.pop(blank_entity.name)
+            self.gds_cells[blank_entity.body.name].polygons.remove(
+                blank_polygon)
+            blank_bbox = blank_polygon.get_bounding_box()
+            if blank_bbox is None or not tool_polygons:
+                indices = ()
+            else:
+                mask = ((tool_bboxes[:, 0] <= blank_bbox[1]).all(axis=1)
+                        & (tool_bboxes[:, 1] >= blank_bbox[0]).all(axis=1))
+                indices = tuple(np.flatnonzero(mask))
+            blanks.append((blank_entity, blank_polygon, blank_bbox, indices))
+
+        #2 blanks overlapped by the same tools are subtracted at once
+        merged = {}  # index in blanks -> subtracted
+        if tile_size is None:
+            groups = {}
+            for ii, (_, _, _, indices) in enumerate(blanks):
+                if indices:
+                    groups.setdefault(indices, []).append(ii)
+            for indices, group in groups.items():
+                if len(group) > 1:
+                    merged.update(self._merged_subtract(
+                        [blanks[ii] for ii in group], group,
+                        [tool_polygons[index] for index in indices]))
+
+        for ii, (blank_entity, blank_polygon, blank_bbox, indices) in \
+                enumerate(blanks):
             self.cell = self.gds_cells[blank_entity.body.name] # assumes blank and tool are in same body
-            self.cell.polygons.remove(blank_polygon)
-
-            tool_polygons = []
-            for tool_entity in tool_entities:
-                tool_polygon = self.gds_object_instances[tool_entity.name]
-                if isinstance(tool_polygon, gdspy.PolygonSet):
-                    for polygon in tool_polygon.polygons:
-                        tool_polygons.append(polygon)
-                else:
-                    tool_polygons.append(tool_polygon)
-
-
-            #2 subtract operation
-            tool_polygon_set = gdspy.PolygonSet(tool_polygons, layer = blank_entity.layer)
-            subtracted = gdspy.boolean(blank_polygon, tool_polygon_set, 'not',
-                                        precision=TOLERANCE, max_points=0,
-                                        layer=blank_entity.layer)
+            overlapping = [tool_polygons[index] for index in indices]
+
+            #3 subtract operation
+            if ii in merged:
+                subtracted = merged[ii]
+            elif blank_bbox is None:
+                subtracted = None  # empty blank
+            elif overlapping and tile_size is not None:
+                polygons = tiled_boolean(gds_polygons(blank_polygon),
+                                         overlapping, 'not', tile_size,
+                                         processes=processes,
+                                         precision=self.precision,
+                                         pool=self.pool)
+                subtracted = PiecewisePolygonSet(polygons,
+                                                 layer=blank_entity.layer) \
+                             if polygons else None
+            elif overlapping:
+                subtracted = boolean(gds_polygons(blank_polygon), overlapping,
+                                     'not', layer=blank_entity.layer,
+                                     precision=self.precision)
+            else:
+                subtracted = blank_polygon  # no tool overlaps the blank
             if subtracted is not None:
-                #3 At last we update the cell and the gds_object_instance
+                #4 At last we update the cell and the gds_object_instance
                 self.gds_object_instances[blank_entity.name] = subtracted
                 self.cell.add(subtracted)
             else:
@@ -250,6 +1026,34 @@ class GdsModeler():
                 self.cell.add(dummy)
                 blank_entity.delete()
 
+    def _merged_subtract(self, blanks, keys, overlapping):
+        # subtracts overlapping from all the blanks with a single boolean,
+        # returns {key: subtracted} or {} if the bounding boxes of the blanks
+        # are not disjoint, in which case the pieces of the result cannot be
+        # given back to their blank
+        index = GridIndex()
+        for key, (_, _, blank_bbox, _) in zip(keys, blanks):
+            index.insert(key, blank_bbox)
+        if any(len(index.query(blank_bbox)) > 1
+               for _, _, blank_bbox, _ in blanks):
+            return {}
+        result = boolean([points for _, blank_polygon, _, _ in blanks
+                          for points in gds_polygons(blank_polygon)],
+                         overlapping, 'not', precision=self.precision)
+        pieces = {key: [] for key in keys}
+        if result is not None:
+            bboxes = polygon_bounding_boxes(result.polygons)
+            for points, (low, high) in zip(result.polygons, bboxes):
+                # each piece lies in the bounding box of its blank
+                center = (low+high)/2
+                owners = index.query((center, center))
+                if len(owners) != 1:
+                    return {}
+                pieces[owners[0]].append(points)
+        return {key: type(result)(pieces[key], layer=blank_entity.layer)
+                     if pieces[key] else None
+                for key, (blank_entity, _, _, _) in zip(keys, blanks)}
+
     def assign_material(self, *args, **kwargs):
         pass
 
@@ -278,7 +1082,7 @@ class GdsModeler():
         pass
 
     def fillet(self, entity, radius, vertex_indices=None):
-        polygon = self.gds_object_instances[entity.name]
+        polygon = self.merge_pieces(entity)
         if vertex_indices is None:
             polygon.fillet(radius, max_points=0)
         else:
@@ -288,6 +1092,7 @@ class GdsModeler():
                 for index in indices:
                     radii[index]=rad
             polygon.fillet([radii], max_points=0, precision=TOLERANCE)
+        self.snap(polygon)
 
     def get_vertex_ids(self, entity):
         return None
@@ -324,45 +1129,87 @@ class GdsModeler():
         '''vector is 3-dimentional but with a z=0 component'''
         if not isinstance(entities, list):
             entities = [entities]
-        translation_vector = [vector[0], vector[1]]
-        for entity in entities:
-            # if entity!=None:
-            gds_entity = self.gds_object_instances[entity.name]
+        translation_vector = np.array([vector[0], vector[1]], dtype=float)
+        polygon_sets, others = self._gds_objects(entities)
+        self._transform_polygons(polygon_sets,
+                                 lambda points: points + translation_vector)
+        for gds_entity in others:
             gds_entity.translate(*translation_vector)
+            if isinstance(gds_entity, _REFERENCES):
+                gds_entity.origin = self._snap_point(gds_entity.origin)
 
     def rotate(self, entities, angle, center=None):
-        
+        # angle in degrees, quarter turns are exact
         if(center is None):
             center = (0, 0)
+        center = np.array([val(center[0]), val(center[1])], dtype=float)
 
         if not isinstance(entities, list):
             entities = [entities]
-        for entity in entities:
-            # if entity!=None:
-            gds_entity = self.gds_object_instances[entity.name]
-            gds_entity.rotate(angle/360*2*np.pi, center=(val(center[0]), val(center[1])))
-
-
-    def rect_array(self, pos, size, columns,rows,spacing, origin=(0, 0), **kwargs):
-        pos, size = parse_entry(pos, size)
-        name = kwargs['name']
-        layer = kwargs['layer']
-        points = [(pos[0],pos[1]), (pos[0]+size[0],pos[1]+0), (pos[0]+size[0],pos[1]+size[1]), (pos[0],pos[1]+size[1])]
-        poly1 = gdspy.Polygon(points, layer)
-
-        self.gds_object_instances[name] = poly1
-
-
-        cell_to_copy = gdspy.Cell('cell_to_copy')
-        self.gds_cells['cell_to_copy'] = cell_to_copy
-        cell_to_copy.add(poly1)
-
-
-        spacing = parse_entry(spacing)
+        cos, sin = rotation_cos_sin(angle)
+        matrix = np.array([[cos, sin], [-sin, cos]])
+        polygon_sets, others = self._gds_objects(entities)
+        if center.any():
+            transform = lambda points: (points - center) @ matrix + center
+        else:
+            transform = lambda points: points @ matrix
+        self._transform_polygons(polygon_sets, transform)
+        for gds_entity in others:
+            if isinstance(gds_entity, _REFERENCES):
+                # references have no rotate method, the rotation of an array
+                # also turns its lattice
+                gds_entity.origin = self._snap_point(
+                    transform(np.array(gds_entity.origin, dtype=float)))
+                gds_entity.rotation = ((gds_entity.rotation or 0)+angle) % 360
+            else:
+                gds_entity.rotate(angle/360*2*np.pi, center=center)
 
-        cell_array=gdspy.CellArray(cell_to_copy, columns, rows, spacing, origin)
-        polygon_list=cell_array.get_polygons()
-        poly2 = gdspy.PolygonSet(polygon_list, layer)
-        self.cell.add(poly2)
+    def _snap_point(self, point):
+        return tuple(np.rint(np.array(point)/self.precision)*self.precision)
 
-        self.gds_object_instances[name] = poly2
+    def _gds_objects(self, entities):
+        # splits the gds objects of entities into polygon sets, which are
+        # transformed at once, and other objects (paths)
+        polygon_sets, others = [], []
+        for entity in entities:
+            gds_entity = self.gds_object_instances[entity.name]
+            if isinstance(gds_entity, gdspy.PolygonSet):
+                polygon_sets.append(gds_entity)
+            else:
+                others.append(gds_entity)
+        return polygon_sets, others
+
+    def _transform_polygons(self, polygon_sets, transform):
+        # applies transform to the vertices of all the polygons of
+        # polygon_sets as a single array operation, the transformed vertices
+        # are snapped to the database unit grid
+        polygons = [points for polygon_set in polygon_sets
+                    for points in polygon_set.polygons]
+        if not polygons:
+            return
+        lengths = [len(points) for points in polygons]
+        polygons = snap_vertices(transform(np.concatenate(polygons)), lengths,
+                                 self.precision)
+        start = 0
+        for polygon_set in polygon_sets:
+            stop = start + len(polygon_set.polygons)
+            polygon_set.polygons = polygons[start:stop]
+            start = stop
+
+    def array(self, entity, columns, rows, spacing):
+        # the gds object of entity is moved to its own cell, placed columns x
+        # rows times by a single CellArray that replaces it
+        gds_entity = self.gds_object_instances[entity.name]
+        cell_name = entity.name
+        ii = 0
+        while cell_name in self.library.cells:
+            ii += 1
+            cell_name = '%s_%d'%(entity.name, ii)
+        cell = self.new_cell(cell_name)
+        self.component_cells[cell_name] = cell
+        self.delete(entity)
+        cell.add(gds_entity)
+        cell_array = gdspy.CellArray(cell, columns, rows,
+                                     self._snap_point(spacing[:2]))
+        self.gds_object_instances[entity.name] = cell_array
+        self.gds_cells[entity.body.name].add(cell_array)
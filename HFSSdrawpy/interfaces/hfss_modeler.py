@@ -10,19 +10,19 @@ import pythoncom
 import time
 from functools import wraps
 from sympy.parsing import sympy_parser
-from pint import UnitRegistry
 from win32com.client import Dispatch, CDispatch
 
 from ..utils import parse_entry, \
                             val, \
                             LENGTH_UNIT, \
                             Vector, \
-                            coor2angle
+                            coor2angle, \
+                            get_unit_registry
                             #extract_value_unit, \
                             #extract_value_dim, \
                             #rem_unit, \
 
-ureg = UnitRegistry()
+ureg = get_unit_registry()
 Q = ureg.Quantity
 
 BASIS_ORDER = {"Zero Order": 0,
@@ -837,9 +837,16 @@ class HfssModeler(COMWrapper):
                                "Selections:=", ','.join([entity1.name, entity2.name])])
         return name
 
-    def copy(self, entity):
+    def copy(self, entity, new_name=None):
         self._modeler.Copy(["NAME:Selections", "Selections:=", entity.name])
         new_obj = self._modeler.Paste()
+        if new_name is not None and new_obj[0] != new_name:
+            # keep the name the Entity expects
+            self._modeler.ChangeProperty(["NAME:AllTabs",
+                ["NAME:Geometry3DAttributeTab",
+                ["NAME:PropServers", str(new_obj[0])],
+                ["NAME:ChangedProps",["NAME:Name","Value:=", new_name]]]])
+            return new_name
         return new_obj[0]
 
     def create_coor_sys(self, coor_sys='chip', rel_coor=None,
@@ -882,17 +889,18 @@ class HfssModeler(COMWrapper):
     def get_coor_sys(self):
         return self._modeler.GetActiveCoordinateSystem()
 
+    def get_object_names(self):
+        return [self._modeler.GetObjectName(str(ii))
+                for ii in range(int(self._modeler.GetNumObjects()))]
+
     def delete(self, entity):
-        objects = [self._modeler.GetObjectName(str(ii))
-                        for ii in range(int(self._modeler.GetNumObjects()))]
-        if entity.name in objects:
+        if entity.name in self.get_object_names():
             self._modeler.Delete(["NAME:Selections",
                                   "Selections:=", entity.name])
 
     def delete_all_objects(self):
-        objects = [self._modeler.GetObjectName(str(ii))
-                        for ii in range(int(self._modeler.GetNumObjects()))]
-        self._modeler.Delete(self._selections_array(*objects))
+        self._modeler.Delete(self._selections_array(
+            *self.get_object_names()))
 
     @assert_name
     def box(self, pos, size, **kwargs):
@@ -1112,6 +1120,9 @@ class HfssModeler(COMWrapper):
         return entity_to_sweep.name
 
     def duplicate_along_line(self, entity, vec, n=2):
+        # returns the names of the n-1 new objects, found by comparing the
+        # objects of the design before and after the duplication
+        before = set(self.get_object_names())
         self._modeler.DuplicateAlongLine(["NAME:Selections","Selections:=", entity.name,
                                           "NewPartsModelFlag:="	, "Model"],
                                         	["NAME:DuplicateToAlongLineParameters",
@@ -1123,6 +1134,19 @@ class HfssModeler(COMWrapper):
                                         	["NAME:Options",
                                         	"DuplicateAssignments:=", False],
                                         	["CreateGroupsForNewObjects:=", False	])
+        return [name for name in self.get_object_names()
+                if name not in before]
+
+    def array(self, entity, columns, rows, spacing):
+        # entity is duplicated along x then along y and united with its
+        # clones, keeping its name
+        for n, vec in [(columns, [spacing[0], 0, 0]),
+                       (rows, [0, spacing[1], 0])]:
+            if n > 1:
+                names = self.duplicate_along_line(entity, vec, n)
+                self._modeler.Unite(
+                    self._selections_array(entity.name, *names),
+                    ["NAME:UniteParameters", "KeepOriginals:=", False])
 
 
     def intersect(self, entities, keep_originals=False):
@@ -1374,6 +1398,18 @@ class HfssModeler(COMWrapper):
     def get_edge_ids(self, entity):
         return self._modeler.GetEdgeIDsFromObject(entity.name)
 
+    def get_bounding_boxes(self, entities):
+        # 2D bounding boxes in meters of the vertices of entities
+        unit = Q(1, self._modeler.GetModelUnits()).to('m').magnitude
+        bboxes = []
+        for entity in entities:
+            vertices = numpy.array(self.get_vertices(entity))*unit
+            if len(vertices) == 0:
+                bboxes.append(None)
+            else:
+                bboxes.append((vertices.min(axis=0), vertices.max(axis=0)))
+        return bboxes
+
     def get_matched_object_name(self, name):
         return self._modeler.GetMatchedObjectName(name+'*')
 
@@ -5,13 +5,39 @@ Created on Thu Nov 14 13:46:42 2019
 @author: Zaki
 """
 
-from sympy.parsing import sympy_parser
-from pint import UnitRegistry
+import ast
+import bisect
+import contextlib
+import contextvars
+from functools import lru_cache, wraps
+import linecache
+import math
+import os
+import re
 import numpy
-import sympy
 
-ureg = UnitRegistry()
-Q = ureg.Quantity
+from .expression import Expression
+
+# pint and sympy take most of the import time of the package: they are only
+# imported when first needed and a single unit registry is shared by all
+# modules (use get_unit_registry, or utils.ureg and utils.Q)
+_ureg = None
+
+def get_unit_registry():
+    global _ureg
+    if _ureg is None:
+        from pint import UnitRegistry
+        _ureg = UnitRegistry()
+    return _ureg
+
+def __getattr__(name):
+    if name == 'ureg':
+        return get_unit_registry()
+    if name == 'Q':
+        return get_unit_registry().Quantity
+    if name == 'UNITS':
+        return get_units()
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
 
 LENGTH = '[length]'
 INDUCTANCE = '[length] ** 2 * [mass] / [current] ** 2 / [time] ** 2'
@@ -25,90 +51,363 @@ CAPACITANCE_UNIT = 'fF'
 RESISTANCE_UNIT = 'ohm'
 DIMENSIONLESS_UNIT = ''
 
-### List handling
-# Useful function to manipulate to_move entities and ports
-def find_last_list(list_entities):
-    # return the last list of a set of nested lists
+@lru_cache(maxsize=None)
+def get_units():
+    # SI unit of each supported dimensionality, keyed the way the installed
+    # pint version prints dimensionalities
+    Q = get_unit_registry().Quantity
+    return {str(Q(1, unit).dimensionality): unit
+            for unit in [LENGTH_UNIT, INDUCTANCE_UNIT, CAPACITANCE_UNIT,
+                         RESISTANCE_UNIT, DIMENSIONLESS_UNIT]}
+
+# metric lengths such as '20um' or '-0.3mm' are converted without pint
+METRIC_LENGTHS = {'nm': 1e-9, 'um': 1e-6, 'mm': 1e-3, 'm': 1}
+_metric_length = re.compile(r'\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+                            r'\s*(nm|um|mm|m)\s*$')
+PARSE_CACHE_SIZE = 4096
+
+### Move stack
+# Entities and ports created inside nested `with body(pos, ori):` blocks are
+# recorded in a stack of frames, one per open block, to be moved when the
+# block exits.
+
+class MoveFrame():
+    """
+    Ordered set of the objects created in a `with body(...)` block. It is a
+    circular doubly linked list indexed by object, so that appending,
+    inserting after an object and removing an object are O(1).
+    """
+    def __init__(self):
+        self._root = object()
+        self._links = {self._root: [self._root, self._root]}  # [prev, next]
 
-    if isinstance(list_entities, list):
-        if len(list_entities)==0:
-            return list_entities
-        else:
-            if isinstance(list_entities[-1], list):
-                return find_last_list(list_entities[-1])
-            else:
-                return list_entities
-    else:
-        raise TypeError('There are no list')
+    def __len__(self):
+        return len(self._links)-1
 
-def find_penultimate_list(list_entities):
-    # return the last list of a set of nested lists
-    if isinstance(list_entities, list):
-        if len(list_entities)==0:
-            return False
-        else:
-            if isinstance(list_entities[-1], list):
-                if len(list_entities[-1])==0:
-                    return list_entities
-                else:
-                    if isinstance(list_entities[-1][-1], list):
-                        return find_penultimate_list(list_entities[-1])
-                    else:
-                        return list_entities
-            else:
-                return False
-    else:
-        raise TypeError('There are no list')
-
-def add_to_corresponding_list(elt, nested_list, added_elt):
-    # return the last list of a set of nested lists
-    if isinstance(nested_list, list):
-        if elt in nested_list:
-            index = nested_list.index(elt)
-            nested_list.insert(index+1, added_elt)
-            return True
-        else:
-            for elt_list in nested_list:
-                if isinstance(elt_list, list):
-                    if add_to_corresponding_list(elt, elt_list, added_elt):
-                        break
-            else:
-                return False
-            return True
-    else:
-        pass#raise TypeError('Argument is not a list')
+    def __contains__(self, elt):
+        return elt in self._links
 
-def general_remove(elt, nested_list):
-    # same as list.remove(elt) but for a nested list
-    if isinstance(nested_list, list):
-        if elt in nested_list:
-            nested_list.remove(elt)
-            return True
+    def __iter__(self):
+        elt = self._links[self._root][1]
+        while elt is not self._root:
+            yield elt
+            elt = self._links[elt][1]
+
+    def append(self, elt):
+        self.insert_after(self._links[self._root][0], elt)
+
+    def insert_after(self, previous, elt):
+        following = self._links[previous][1]
+        self._links[elt] = [previous, following]
+        self._links[previous][1] = elt
+        self._links[following][0] = elt
+
+    def remove(self, elt):
+        previous, following = self._links.pop(elt)
+        self._links[previous][1] = following
+        self._links[following][0] = previous
+
+class MoveStack():
+    """
+    Stack of the MoveFrame of the open `with body(...)` blocks, the last one
+    collecting the newly created objects. The frame of each object is
+    indexed, hence finding, removing or inserting next to an object does not
+    depend on the number of objects nor on the depth of the blocks.
+    When a block exits, its objects join the frame of the enclosing block.
+    """
+    def __init__(self):
+        self.frames = []
+        self.frame_of = {}  # object -> MoveFrame containing it
+
+    def __bool__(self):
+        # True when inside a `with body(...)` block
+        return bool(self.frames)
+
+    def push(self):
+        self.frames.append(MoveFrame())
+
+    def current(self):
+        return self.frames[-1]
+
+    def pop(self):
+        frame = self.frames.pop()
+        if self.frames:
+            parent = self.frames[-1]
+            for elt in frame:
+                parent.append(elt)
+                self.frame_of[elt] = parent
         else:
-            for elt_list in nested_list:
-                if isinstance(elt_list, list):
-                    success = general_remove(elt, elt_list)
-                    if success:
-                        break
-    else:
-        raise TypeError('Argument is not a list')
+            for elt in frame:
+                del self.frame_of[elt]
+        return frame
+
+    def add(self, elt):
+        # records a new object in the current frame, if any
+        if self.frames:
+            frame = self.frames[-1]
+            frame.append(elt)
+            self.frame_of[elt] = frame
+
+    def add_after(self, elt, added_elt):
+        # records added_elt next to elt e.g. a copy, if elt is recorded
+        frame = self.frame_of.get(elt)
+        if frame is not None:
+            frame.insert_after(elt, added_elt)
+            self.frame_of[added_elt] = frame
+
+    def remove(self, elt):
+        frame = self.frame_of.pop(elt, None)
+        if frame is not None:
+            frame.remove(elt)
+
+### Indexed storage
+
+class IndexedList():
+    """
+    List of distinct objects in insertion order, backed by a dict so that
+    appending, removing and membership tests are O(1). It is used for the
+    entities of a body by layer and for the polygons of a gds cell.
+    """
+    def __init__(self, elts=()):
+        self._elts = dict.fromkeys(elts)
+
+    def __len__(self):
+        return len(self._elts)
 
-def find_corresponding_list(elt, nested_list):
-    # return the last list of a set of nested lists
-    if isinstance(nested_list, list):
-        if elt in nested_list:
-            return nested_list
+    def __contains__(self, elt):
+        return elt in self._elts
+
+    def __iter__(self):
+        return iter(self._elts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._elts)[index]
+        if index < 0:
+            index += len(self._elts)
+        if not 0 <= index < len(self._elts):
+            raise IndexError('IndexedList index out of range')
+        for ii, elt in enumerate(self._elts):
+            if ii == index:
+                return elt
+
+    def __add__(self, other):
+        return list(self._elts) + list(other)
+
+    def __repr__(self):
+        return 'IndexedList(%r)'%list(self._elts)
+
+    def append(self, elt):
+        self._elts[elt] = None
+
+    def extend(self, elts):
+        self._elts.update(dict.fromkeys(elts))
+
+    def remove(self, elt):
+        try:
+            del self._elts[elt]
+        except KeyError:
+            raise ValueError('%r is not in IndexedList'%(elt,)) from None
+
+    def copy(self):
+        return list(self._elts)
+
+def as_list(elts):
+    # elts can be a single object, a list or an IndexedList
+    if isinstance(elts, IndexedList):
+        return list(elts)
+    if not isinstance(elts, list):
+        return [elts]
+    return elts
+
+### Spatial index
+
+def bbox_distance(bbox, point):
+    # distance from point to the 2D bounding box ((xmin, ymin), (xmax, ymax))
+    (xmin, ymin), (xmax, ymax) = bbox
+    dx = max(xmin-point[0], 0, point[0]-xmax)
+    dy = max(ymin-point[1], 0, point[1]-ymax)
+    return math.hypot(dx, dy)
+
+class GridIndex():
+    """
+    Uniform grid index of 2D bounding boxes ((xmin, ymin), (xmax, ymax)) by
+    object. Each box is registered in the grid cells it overlaps, boxes
+    covering too many cells are kept aside and always tested. Inserting and
+    removing a box is O(1) for boxes of the typical size, queries only look
+    at the cells around the searched region.
+    The grid is built at the first query, with cells of twice the median box
+    size, and rebuilt when the number of boxes has doubled since, unless a
+    fixed cell_size is given.
+    """
+    MAX_CELLS = 64  # boxes covering more cells are kept aside
+    CHUNK = 16  # cells tested at once against the best distance in nearest
+
+    def __init__(self, cell_size=None):
+        self.boxes = {}  # object -> (bbox, insertion number)
+        self.count = 0
+        self.cell_size = cell_size
+        self.cells = {}  # (i, j) -> {object: None}
+        self.large = {}  # object -> None
+        self.extent = None  # bounds of the cell indices ever occupied
+        # number of boxes when the grid was built
+        self.built_size = 0 if cell_size is None else math.inf
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, elt):
+        return elt in self.boxes
+
+    def insert(self, elt, bbox):
+        # a moved object keeps its rank in the query results
+        if elt in self.boxes:
+            number = self.boxes[elt][1]
+            self.remove(elt)
         else:
-            for elt_list in nested_list:
-                if isinstance(elt_list, list):
-                    found_list = find_corresponding_list(elt, elt_list)
-                    if found_list:
-                        break
+            number = self.count
+            self.count += 1
+        bbox = tuple(map(tuple, bbox))
+        self.boxes[elt] = (bbox, number)
+        if self.cell_size is not None:
+            self._register(elt, bbox)
+
+    def remove(self, elt):
+        bbox, _ = self.boxes.pop(elt)
+        if self.cell_size is not None:
+            if elt in self.large:
+                del self.large[elt]
             else:
-                return False
-            return found_list
-    else:
-        return None
+                for key in self._keys(bbox):
+                    cell = self.cells[key]
+                    del cell[elt]
+                    if not cell:
+                        del self.cells[key]
+
+    def query(self, bbox):
+        # objects whose box intersects bbox, in insertion order
+        (xmin, ymin), (xmax, ymax) = bbox
+        if not self.boxes:
+            return []
+        self._build()
+        ranges = self._ranges(bbox)
+        if ranges is None or (ranges[1]-ranges[0]+1)*(ranges[3]-ranges[2]+1) \
+                > len(self.boxes):
+            candidates = self.boxes
+        else:
+            candidates = dict(self.large)
+            imin, imax, jmin, jmax = ranges
+            for ii in range(imin, imax+1):
+                for jj in range(jmin, jmax+1):
+                    candidates.update(self.cells.get((ii, jj), ()))
+        found = []
+        for elt in candidates:
+            ((bxmin, bymin), (bxmax, bymax)), number = self.boxes[elt]
+            if bxmin <= xmax and xmin <= bxmax and bymin <= ymax \
+                    and ymin <= bymax:
+                found.append((number, elt))
+        return [elt for number, elt in sorted(found, key=lambda x: x[0])]
+
+    def nearest(self, point):
+        # (object, distance) of the box closest to point, None if empty
+        if not self.boxes:
+            return None
+        self._build()
+        best = (math.inf, None, None)  # distance, insertion number, object
+        def consider(elts):
+            nonlocal best
+            for elt in elts:
+                bbox, number = self.boxes[elt]
+                candidate = (bbox_distance(bbox, point), number, elt)
+                if candidate[:2] < best[:2]:
+                    best = candidate
+        consider(self.large)
+        if self.cells:
+            size = self.cell_size
+            cells = self.cells
+            def scan(irange, jrange):
+                # cells of irange x jrange by chunks, skipping the chunks
+                # farther than the best box
+                for istart in range(irange.start, irange.stop, self.CHUNK):
+                    for jstart in range(jrange.start, jrange.stop,
+                                        self.CHUNK):
+                        istop = min(istart+self.CHUNK, irange.stop)
+                        jstop = min(jstart+self.CHUNK, jrange.stop)
+                        chunk = ((istart*size, jstart*size),
+                                 (istop*size, jstop*size))
+                        if bbox_distance(chunk, point) > best[0]:
+                            continue
+                        for ii in range(istart, istop):
+                            for jj in range(jstart, jstop):
+                                consider(cells.get((ii, jj), ()))
+            i0, j0 = math.floor(point[0]/size), math.floor(point[1]/size)
+            imin, imax, jmin, jmax = self.extent
+            # rings of cells around the cell of point, clipped to the extent
+            radius = max(imin-i0, i0-imax, jmin-j0, j0-jmax, 0)
+            max_radius = max(i0-imin, imax-i0, j0-jmin, jmax-j0)
+            # the cells of the ring radius are at least (radius-1)*size away
+            while radius <= max_radius and best[0] >= (radius-1)*size:
+                irange = range(max(i0-radius, imin), min(i0+radius, imax)+1)
+                jrange = range(max(j0-radius+1, jmin),
+                               min(j0+radius-1, jmax)+1)
+                for jj in sorted({j0-radius, j0+radius}):
+                    if jmin <= jj <= jmax:
+                        scan(irange, range(jj, jj+1))
+                for ii in sorted({i0-radius, i0+radius}):
+                    if imin <= ii <= imax:
+                        scan(range(ii, ii+1), jrange)
+                radius += 1
+        return best[2], best[0]
+
+    def _build(self):
+        if self.cell_size is not None and len(self.boxes) < 2*self.built_size:
+            return
+        sizes = sorted(max(bbox[1][0]-bbox[0][0], bbox[1][1]-bbox[0][1])
+                       for bbox, _ in self.boxes.values())
+        sizes = [size for size in sizes if size > 0]
+        self.cell_size = 2*sizes[len(sizes)//2] if sizes else 1.0
+        self.built_size = max(len(self.boxes), 1)
+        self.cells = {}
+        self.large = {}
+        self.extent = None
+        for elt, (bbox, _) in self.boxes.items():
+            self._register(elt, bbox)
+
+    def _ranges(self, bbox):
+        size = self.cell_size
+        try:
+            return (math.floor(bbox[0][0]/size), math.floor(bbox[1][0]/size),
+                    math.floor(bbox[0][1]/size), math.floor(bbox[1][1]/size))
+        except (OverflowError, ValueError):  # infinite or nan bounds
+            return None
+
+    def _keys(self, bbox):
+        imin, imax, jmin, jmax = self._ranges(bbox)
+        return [(ii, jj) for ii in range(imin, imax+1)
+                for jj in range(jmin, jmax+1)]
+
+    def _register(self, elt, bbox):
+        ranges = self._ranges(bbox)
+        if ranges is None or (ranges[1]-ranges[0]+1)*(ranges[3]-ranges[2]+1) \
+                > self.MAX_CELLS:
+            self.large[elt] = None
+            return
+        imin, imax, jmin, jmax = ranges
+        cells = self.cells
+        for ii in range(imin, imax+1):
+            for jj in range(jmin, jmax+1):
+                cell = cells.get((ii, jj))
+                if cell is None:
+                    cells[(ii, jj)] = {elt: None}
+                else:
+                    cell[elt] = None
+        extent = self.extent
+        if extent is None:
+            self.extent = ranges
+        elif imin < extent[0] or imax > extent[1] or jmin < extent[2] \
+                or jmax > extent[3]:
+            self.extent = (min(imin, extent[0]), max(imax, extent[1]),
+                           min(jmin, extent[2]), max(jmax, extent[3]))
 
 ### Naming
 
@@ -131,8 +430,10 @@ def gen_name(name):
         suffix = str(number+1)
         return prefix+suffix
 
-def check_name(_class, name):
+def split_name(name):
+    # 'rect_12' -> ('rect_', 12), names without trailing digits get number 0
     end = ''
+    ii = -1
     for ii, char in enumerate(name[::-1]):
         if char.isdigit():
             end+=char
@@ -141,18 +442,125 @@ def check_name(_class, name):
     else:
         ii += 1
     if end == '':
-        radical = name
-        number = 0
-    else:
-        radical = name[:-ii]
-        number = int(end[::-1])
-    new_name = name
-    while(new_name in _class.dict_instances.keys()):
-        number+=1
-        new_name = radical+str(number)
-    if new_name != name:
-        print("%s: changed '%s' name into '%s'"%(_class.__name__, name, new_name))
-    return new_name
+        return name, 0
+    return name[:-ii], int(end[::-1])
+
+class NameAllocator():
+    """
+    Gives unique names among the keys of instances, a dict of named objects.
+    A name already in use gets its trailing number incremented until it is
+    free. The runs of taken numbers met while searching are remembered and
+    skipped at once afterwards, so that creating N objects with the same
+    default name e.g. 'rect_0', or copying N numbered objects, takes O(N)
+    dict lookups instead of O(N**2). Names removed from instances must be
+    released: their number is kept in a sorted list of freed numbers, which
+    are given again before the end of the runs they fall in.
+
+    Inputs:
+    -------
+    instances: dict whose keys are the names in use
+    label: prefix of the renaming messages e.g. 'Entity'
+    silent: if True, renamings are not printed
+    """
+    def __init__(self, instances, label, silent=False):
+        self.instances = instances
+        self.label = label
+        self.silent = silent
+        # radical -> {number: next}, all numbers from number to next
+        # (excluded) are taken or freed
+        self.skips = {}
+        # radical -> sorted list of the released numbers, some of which may
+        # have been taken again
+        self.freed = {}
+
+    def allocate(self, name):
+        if name not in self.instances:
+            return name
+        radical, number = split_name(name)
+        skips = self.skips.setdefault(radical, {})
+        visited = []
+        new_number = number+1
+        while radical+str(new_number) in self.instances:
+            visited.append(new_number)
+            new_number = skips.get(new_number, new_number+1)
+        for visited_number in visited:
+            skips[visited_number] = new_number
+        freed = self.freed.get(radical)
+        if freed:
+            # the first free number may be a released one inside a run
+            index = bisect.bisect_right(freed, number)
+            while index < len(freed) and freed[index] < new_number:
+                if radical+str(freed[index]) in self.instances:
+                    del freed[index]  # taken again since it was released
+                else:
+                    new_number = freed.pop(index)
+                    break
+        new_name = radical+str(new_number)
+        if not self.silent:
+            print("%s: changed '%s' name into '%s'"%(self.label, name,
+                                                     new_name))
+        return new_name
+
+    def release(self, name):
+        radical, number = split_name(name)
+        if radical in self.skips:
+            bisect.insort(self.freed.setdefault(radical, []), number)
+
+    def reset(self, instances):
+        self.instances = instances
+        self.skips = {}
+        self.freed = {}
+
+def _assignment_targets(source):
+    # line number -> source of the assignment target of the statement
+    # spanning that line e.g. 'track' for "track = pm.set_variable('20um')"
+    targets = {}
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Assign):
+            target = node.targets[0]
+        elif isinstance(node, ast.AnnAssign):
+            target = node.target
+        else:
+            continue
+        name = ast.get_source_segment(source, target)
+        for lineno in range(node.lineno, node.end_lineno+1):
+            targets.setdefault(lineno, name)
+    return targets
+
+_targets_by_file = {}  # filename -> (mtime, assignment targets by line)
+
+def infer_variable_name(frame):
+    """
+    Returns the name of the variable assigned on the line being executed in
+    frame. Source files are parsed once and their index of assignment targets
+    is kept until they are modified. Code without a file on disk (notebooks,
+    exec) falls back to the line given by linecache.
+    """
+    while frame.f_code is _ACTIVATING_CODE:
+        frame = frame.f_back  # called through a method of a design
+    filename = frame.f_code.co_filename
+    lineno = frame.f_lineno
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime is not None:
+        cached = _targets_by_file.get(filename)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(filename) as file:
+                    targets = _assignment_targets(file.read())
+            except (OSError, SyntaxError, UnicodeDecodeError):
+                targets = {}
+            cached = (mtime, targets)
+            _targets_by_file[filename] = cached
+        if lineno in cached[1]:
+            return cached[1][lineno]
+    code_line = linecache.getline(filename, lineno, frame.f_globals)
+    if not code_line:
+        raise ValueError('Cannot infer the variable name from the source '
+                         'code, please provide a name')
+    return code_line.split("=")[0].strip()
 
 ### Litteral Expressions
 
@@ -173,7 +581,14 @@ def equal_float(float1, float2):
     else:
         return True
 
+def equal_float_array(array1, array2):
+    # element-wise equal_float on arrays of floats
+    abs1, abs2 = numpy.abs(array1), numpy.abs(array2)
+    ref = numpy.where(abs1 > 1e-10, abs1, abs2)
+    return (ref <= 1e-10) | (numpy.abs(array1-array2) < 1e-5*ref)
+
 def simplify_arith_expr(expr):
+    from sympy.parsing import sympy_parser
     try:
         out = repr(sympy_parser.parse_expr(str(expr)))
         return out
@@ -181,25 +596,66 @@ def simplify_arith_expr(expr):
         print("Couldn't parse", expr)
         raise
 
-def extract_value_unit(expr, units):
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_value_dim(expr, units):
     """
+    Parses the string expr once and returns its value in units along with its
+    dimensionality (None if expr is not a quantity).
+    Results are memoized since scripts pass the same literals over and over.
+
     :type expr: str
     :type units: str
-    :return: float
+    :return: (float, str)
     """
+    match = _metric_length.match(expr)
+    if match is not None and units == LENGTH_UNIT:
+        number, unit = match.groups()
+        try:
+            number = int(number)
+        except ValueError:
+            number = float(number)
+        return number*METRIC_LENGTHS[unit], LENGTH
     try:
-        return Q(expr).to(units).magnitude
+        quantity = get_unit_registry().Quantity(expr)
+    except Exception:
+        quantity = None
+    try:
+        return quantity.to(units).magnitude, str(quantity.dimensionality)
     except Exception:
         try:
-            return float(expr)
+            value = float(expr)
         except Exception:
-            return expr
+            value = expr
+        if quantity is None:
+            return value, None
+        return value, str(quantity.dimensionality)
+
+def extract_value_unit(expr, units):
+    """
+    :type expr: str
+    :type units: str
+    :return: float
+    """
+    if isinstance(expr, str):
+        return parse_value_dim(expr, units)[0]
+    if getattr(expr, 'free_symbols', None):
+        # symbolic expression, nothing to convert
+        return expr
+    if _ureg is not None and isinstance(expr, _ureg.Quantity):
+        return expr.to(units).magnitude
+    try:
+        return float(expr)
+    except Exception:
+        return expr
 
 def extract_value_dim(expr):
     """
     type expr: str
     """
-    return str(Q(expr).dimensionality)
+    dim = parse_value_dim(expr, LENGTH_UNIT)[1]
+    if dim is None:
+        raise ValueError('Could not parse the quantity %s'%expr)
+    return dim
 
 def parse_entry(*entries, marker=True):
     #should take a list of tuple of list... of int, float or str...
@@ -229,11 +685,12 @@ def rem_unit(other):
     except Exception:
         return other
 
+_NUMBERS = (int, float, numpy.int64, numpy.float64, numpy.int32, numpy.float32)
+
 def _val(elt):
-    if isinstance(elt, (int, float, numpy.int64, numpy.float64, numpy.int32, numpy.float32)):
+    if isinstance(elt, _NUMBERS):
         return elt
-    else:
-        return float(elt.evalf(subs=variables))
+    return get_variables().evaluate(elt)
 
 def val(*entries, marker=True):
     #should take a list of tuple of list... of int, float or str...
@@ -243,7 +700,10 @@ def val(*entries, marker=True):
             parsed.append(_val(entry))
         else:
             if isinstance(entry, Vector):
-                parsed.append(Vector(val(*entry, marker=False)))
+                if entry.is_numeric():
+                    parsed.append(entry.copy())
+                else:
+                    parsed.append(Vector(val(*entry, marker=False)))
             elif isinstance(entry, list):
                 parsed.append(val(*entry, marker=False))
             elif isinstance(entry, tuple):
@@ -255,6 +715,36 @@ def val(*entries, marker=True):
     else:
         return parsed
 
+def val_array(points):
+    """
+    Bulk version of parse_entry followed by val for a list of N points of 2 or
+    3 coordinates. Returns a contiguous (N, 2) or (N, 3) float64 array, points
+    of different lengths being padded with z=0. An empty list gives a (0, 2)
+    array.
+    Only the entries which are not plain numbers (strings, symbolic
+    expressions) are parsed and evaluated one by one.
+    """
+    if isinstance(points, numpy.ndarray) and points.dtype.kind in 'biuf':
+        return numpy.array(points, dtype=float)
+    if len(points) == 0:
+        return numpy.empty((0, 2))
+    width = max(len(point) for point in points)
+    if any(len(point) != width for point in points):
+        points = [tuple(point) + (0,)*(width-len(point)) for point in points]
+    entries = numpy.array(points, dtype=object).reshape(len(points), width)
+    try:
+        return entries.astype(float)
+    except (TypeError, ValueError):
+        pass
+    flat = entries.ravel()
+    result = numpy.empty(flat.shape)
+    numeric = numpy.array([isinstance(entry, _NUMBERS) for entry in flat],
+                          dtype=bool)
+    result[numeric] = flat[numeric].astype(float)
+    result[~numeric] = [_val(extract_value_unit(entry, LENGTH_UNIT))
+                        for entry in flat[~numeric]]
+    return result.reshape(entries.shape)
+
 def way(vec):
     if vec[1] != 0:
         if abs(vec[0]/vec[1])<1e-2:
@@ -269,22 +759,268 @@ def way(vec):
             elif vec[0]<0:
                 return Vector(-1,0)
 
-variables = {}
+### Numerical evaluation
+# The variables of a design and the evaluations derived from them are held by
+# a Variables object, one per Modeler, so that several designs can be built
+# side by side or in threads. val and store_variable work on the active
+# Variables: the methods of a Modeler, its bodies, entities and ports activate
+# the Variables of their design (see with_variables), and creating a Modeler
+# makes its Variables the active ones of the current thread.
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _lambdify(expr):
+    # python function of the free symbols of the sympy expression expr sorted
+    # by name, it does not depend on the values and is shared by the designs
+    from sympy import lambdify
+    return lambdify(sorted(expr.free_symbols, key=str), expr, modules='math')
+
+# maximum number of expressions kept by each cache of a Variables object, the
+# oldest entries are dropped first
+EVALUATION_CACHE_SIZE = 65536
+# compiling costs about 10 evaluations by substitution, so an expression is
+# only compiled once it has been evaluated that many times
+COMPILE_AFTER = 10
+
+def _bounded_set(cache, key, value):
+    # cache[key] = value, dropping the oldest entry if cache is full
+    if len(cache) >= EVALUATION_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+class Variables():
+    """
+    Values of the variables of a design and cache of the numerical
+    evaluation of the expressions built from them.
+    An expression is evaluated by substitution. Once it has been evaluated
+    COMPILE_AFTER times, because variables changed or it was dropped from the
+    cache, it is compiled into a plain python function of its free symbols,
+    the values of which are packed in a list. The evaluated expressions are
+    recorded as dependents of their symbols so that changing a variable only
+    invalidates what was derived from it. All caches are bounded by
+    EVALUATION_CACHE_SIZE.
+    A Variables object should only be used by one thread at a time, as the
+    Modeler it belongs to.
+    """
+    def __init__(self):
+        self.values = {}  # symbol -> SI value
+        self._indices = {}  # symbol -> position in _packed
+        self._packed = []
+        self._counts = {}  # expression -> evaluations by substitution
+        self._compiled = {}  # expression -> (function of _packed, symbols)
+        self._evaluated = {}  # expression -> (float, symbols)
+        self._dependents = {}  # symbol -> expressions in _evaluated using it
+        self._definitions = {}  # symbol -> expression, for derived variables
+        self._derived = {}  # symbol -> variables defined from it
+
+    def __contains__(self, symbol):
+        return symbol in self.values
+
+    def clear_caches(self):
+        # forgets the compiled and evaluated expressions, values are kept
+        self._counts.clear()
+        self._compiled.clear()
+        self._evaluated.clear()
+        for symbol in self._dependents:
+            self._dependents[symbol] = set()
+
+    def evaluate(self, elt):
+        try:
+            return self._evaluated[elt][0]
+        except KeyError:
+            pass
+        compiled = self._compiled.get(elt)
+        if compiled is None:
+            count = self._counts.get(elt, 0)
+            if count >= COMPILE_AFTER:
+                del self._counts[elt]
+                compiled = self._compile(elt)
+        if compiled is not None:
+            func, symbols = compiled
+            value = float(func(self._packed))
+        else:
+            symbols = self._symbols(elt)
+            value = self._substitute(elt, symbols)
+            _bounded_set(self._counts, elt, count+1)
+
+        if len(self._evaluated) >= EVALUATION_CACHE_SIZE:
+            oldest = next(iter(self._evaluated))
+            for symbol in self._evaluated.pop(oldest)[1]:
+                self._dependents[symbol].discard(oldest)
+        self._evaluated[elt] = (value, symbols)
+        for symbol in symbols:
+            self._dependents[symbol].add(elt)
+        return value
 
-def store_variable(symbol, value):  # put value in SI
+    def _symbols(self, expr):
+        symbols = sorted(expr.free_symbols, key=str)
+        for symbol in symbols:
+            if symbol not in self._indices:
+                raise TypeError('Cannot evaluate %s: %s is not a defined '
+                                'variable'%(expr, symbol))
+        return symbols
+
+    def _substitute(self, expr, symbols):
+        # evaluation without compiling, for expressions seldom evaluated
+        if expr in self._indices:
+            return self._packed[self._indices[expr]]
+        if isinstance(expr, Expression):
+            return float(expr.evaluate(self.values))
+        return float(expr.evalf(subs={symbol: self.values[symbol]
+                                      for symbol in symbols}))
+
+    def _compile(self, expr):
+        symbols = self._symbols(expr)
+        if isinstance(expr, Expression):
+            func = expr.compile(self._indices)
+        else:
+            indices = [self._indices[symbol] for symbol in symbols]
+            lambdified = _lambdify(expr)
+            func = lambda values: lambdified(*[values[index]
+                                               for index in indices])
+        _bounded_set(self._compiled, expr, (func, symbols))
+        return func, symbols
+
+    def store(self, symbol, value):
+        """
+        Stores the SI value of the variable symbol. The value can also be an
+        expression of previously stored variables, in which case the variable
+        is re-evaluated whenever one of them changes.
+        """
+        value = si_value(value)
+
+        definition = None
+        if getattr(value, 'free_symbols', None):
+            if symbol in value.free_symbols:
+                raise ValueError('%s cannot be defined from itself'%symbol)
+            # checked before any change so that a rejected definition leaves
+            # the variables as they were
+            cycle = value.free_symbols & self._descendants(symbol)
+            if cycle:
+                raise ValueError('%s cannot be defined from %s which depends '
+                                 'on it'%(symbol, ', '.join(sorted(map(str,
+                                                                 cycle)))))
+            definition, value = value, self.evaluate(value)
+
+        if symbol in self._definitions:
+            for other in self._definitions.pop(symbol).free_symbols:
+                self._derived[other].discard(symbol)
+        if definition is not None:
+            self._definitions[symbol] = definition
+            for other in definition.free_symbols:
+                self._derived[other].add(symbol)
+
+        if symbol in self._indices:
+            self._update(symbol, value)
+        else:
+            self.values[symbol] = value
+            self._indices[symbol] = len(self._packed)
+            self._packed.append(value)
+            self._dependents[symbol] = set()
+            self._derived[symbol] = set()
+
+    def is_used(self, symbol):
+        # True if cached evaluations depend on symbol or on the variables
+        # defined from it
+        return any(self._dependents[other] for other in self.affected(symbol))
+
+    def affected(self, symbol):
+        # symbol and the variables defined, directly or not, from it
+        return self._descendants(symbol) | {symbol}
+
+    def _descendants(self, symbol):
+        # variables defined, directly or not, from symbol
+        descendants = set()
+        to_visit = list(self._derived.get(symbol, ()))
+        while to_visit:
+            derived = to_visit.pop()
+            if derived not in descendants:
+                descendants.add(derived)
+                to_visit.extend(self._derived[derived])
+        return descendants
+
+    def _update(self, symbol, value):
+        index = self._indices[symbol]
+        if self._packed[index] == value:
+            return
+        self._packed[index] = value
+        self.values[symbol] = value
+        # invalidate the evaluations that used the old value
+        for expr in self._dependents[symbol]:
+            self._evaluated.pop(expr, None)
+        self._dependents[symbol] = set()
+        # and recompute the variables that are defined from this one
+        for derived in self._derived[symbol]:
+            self._update(derived, self.evaluate(self._definitions[derived]))
+
+_default_variables = Variables()  # used when no Modeler was created
+_active_variables = contextvars.ContextVar('variables', default=None)
+
+def get_variables():
+    # Variables used by val and store_variable in the current thread
+    variables = _active_variables.get()
+    return _default_variables if variables is None else variables
+
+def set_variables(variables):
+    # makes variables the active Variables of the current thread
+    _active_variables.set(variables)
+
+@contextlib.contextmanager
+def use_variables(variables):
+    # activates variables in the block
+    token = _active_variables.set(variables)
+    try:
+        yield variables
+    finally:
+        _active_variables.reset(token)
+
+def with_variables(cls):
+    """
+    Class decorator making the methods defined in cls run with the Variables
+    of the design of the instance, self.variables, active.
+    """
+    for attr, method in list(vars(cls).items()):
+        if (attr.startswith('__') and attr not in ('__call__', '__enter__',
+                                                   '__exit__')
+                or not callable(method)
+                or isinstance(method, (staticmethod, classmethod, type))):
+            continue
+        setattr(cls, attr, _activating(method))
+    return cls
+
+def _activating(method):
+    @wraps(method)
+    def activated(self, *args, **kwargs):
+        token = _active_variables.set(self.variables)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _active_variables.reset(token)
+    return activated
+
+_ACTIVATING_CODE = _activating(None).__code__
+
+def si_value(value):
+    """
+    Returns the SI value of a quantity given as a string e.g. '20um' or '1nH',
+    other values are returned unchanged.
+    """
     if isinstance(value, str):
-        if LENGTH == extract_value_dim(value):
+        dim = extract_value_dim(value)
+        if dim == LENGTH:
             unit = LENGTH_UNIT
-        if INDUCTANCE == extract_value_dim(value):
-            unit = INDUCTANCE_UNIT
-        if CAPACITANCE == extract_value_dim(value):
-            unit = CAPACITANCE_UNIT
-        if RESISTANCE == extract_value_dim(value):
-            unit = RESISTANCE_UNIT
-        if DIMENSIONLESS == extract_value_dim(value):
-            unit = DIMENSIONLESS_UNIT
+        elif dim in get_units():
+            unit = get_units()[dim]
+        else:
+            raise ValueError('Unsupported dimension %s for %s'%(dim, value))
         value = extract_value_unit(value, unit)
-    variables[symbol] = value
+    return value
+
+def store_variable(symbol, value):  # put value in SI
+    """
+    Stores the SI value of the variable symbol in the active Variables, see
+    Variables.store.
+    """
+    get_variables().store(symbol, value)
 
 class Vector(numpy.ndarray):
 
@@ -341,7 +1077,18 @@ class Vector(numpy.ndarray):
         except:
             return False
 
+    def is_numeric(self):
+        # True when all components are numbers, in which case the vector is
+        # stored as a plain int or float array and operations skip val
+        return self.dtype.kind in 'biuf'
+
     def __eq__(self, other):
+        if (isinstance(other, Vector) and self.is_numeric()
+                and other.is_numeric()):
+            x0, y0, z0 = self.tolist()
+            x1, y1, z1 = other.tolist()
+            return (equal_float(x0, x1) and equal_float(y0, y1)
+                    and equal_float(z0, z1))
         val_self = val(self)
         val_other = val(other)
         bool_result = (equal_float(val_self[0], val_other[0]) and
@@ -430,6 +1177,12 @@ class Vector(numpy.ndarray):
             type Vector, self x other
         """
 
+        if isinstance(other, Vector) and self.is_numeric() and \
+           other.is_numeric():
+            x0, y0, z0 = self.tolist()
+            x1, y1, z1 = other.tolist()
+            return _numeric_vector(y0*z1-z0*y1, -(x0*z1-z0*x1), x0*y1-y0*x1)
+
         if(Vector.check(other) and Vector.check(other)):
 
             return Vector(self[1]*other[2]-self[2]*other[1],
@@ -505,6 +1258,18 @@ class Vector(numpy.ndarray):
 
         other = Vector(other)
 
+        if self.is_numeric() and other.is_numeric() and ref.is_numeric():
+            # same computation as below, on python numbers
+            x, y, z = self.tolist()
+            ox, oy, oz = other.tolist()
+            norm = (ox**2+oy**2+oz**2)**0.5
+            ox, oy, oz = ox/norm, oy/norm, oz/norm
+            r0, r1, r2 = ref.tolist()
+            return _numeric_vector(
+                (x*ox-y*oy+z*oz)*r2 + (-x*oy-y*ox)*r1 + 0*r0,
+                (x*oy+y*ox)*r2 + 0*r1 + (-x*ox+y*oy+z*oz)*r0,
+                0*r2 + (x*ox+y*oy-z*oz)*r1 + (-x*oy+y*ox)*r0)
+
         if(Vector.check(other) and Vector.check(ref)):
 
             other = Vector(other).unit()
@@ -526,14 +1291,27 @@ class Vector(numpy.ndarray):
         return Vector([0, 0, self[2]])
 
     def refx(self, offset=0):
+        if self.is_numeric() and isinstance(offset, _NUMBERS):
+            x, y, z = self.tolist()
+            return _numeric_vector(x, -y+2*offset, z)
         return Vector([self[0], -self[1]+2*offset, self[2]])
 
     def refy(self, offset=0):
+        if self.is_numeric() and isinstance(offset, _NUMBERS):
+            x, y, z = self.tolist()
+            return _numeric_vector(-x+2*offset, y, z)
         return Vector([-self[0]+2*offset, self[1], self[2]])
 
     def refz(self, offset=0):
+        if self.is_numeric() and isinstance(offset, _NUMBERS):
+            x, y, z = self.tolist()
+            return _numeric_vector(x, y, -z+2*offset)
         return Vector([self[0], self[1], -self[2]+2*offset])
 
+def _numeric_vector(x, y, z):
+    # builds a Vector from 3 numbers without the checks of Vector.__new__
+    return numpy.array((x, y, z)).view(Vector)
+
 
 # if(__name__ == "__main__"):
 
@@ -542,6 +1320,18 @@ class Vector(numpy.ndarray):
 
 #     print(x.rot(y))
 
+def ori2angle(ori):
+    # angle in degrees of the 2D orientation ori, exact for the axes
+    return math.atan2(val(ori[1]), val(ori[0]))/math.pi*180
+
+def rotation_cos_sin(angle):
+    # cosine and sine of angle in degrees, exact integers for quarter turns
+    # so that symbolic coordinates are not multiplied by rounding errors
+    if angle % 90 == 0:
+        return [(1, 0), (0, 1), (-1, 0), (0, -1)][int(angle//90) % 4]
+    rad = angle/180*math.pi
+    return math.cos(rad), math.sin(rad)
+
 def coor2angle(x, y=None):
 
     if(y is None):
@@ -0,0 +1,747 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the expression engines of the Modeler, and of its non-symbolic
+mode, on an example chip.
+Run as a script: python tests/benchmark_modeler.py
+"""
+
+import time
+
+import gdspy
+import numpy as np
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.parameters import GAP, TRACK
+import HFSSdrawpy.libraries.example_elements as elt
+from HFSSdrawpy.interfaces.gds_modeler import manhattan_boolean, gds_polygons
+
+N_CHIPS = 5
+
+def same_area(polygons1, polygons2):
+    # exact comparison of axis-aligned geometries on the 1nm grid, a xor with
+    # gdspy.boolean at this precision is too slow for these many polygons
+    polygons1, polygons2 = gds_polygons(polygons1), gds_polygons(polygons2)
+    return (manhattan_boolean(polygons1, polygons2, 'not') == []
+            and manhattan_boolean(polygons2, polygons1, 'not') == [])
+
+def draw_chips(engine, symbolic=True):
+    pm = Modeler('gds', engine=engine, symbolic=symbolic)
+    pm.entity_names.silent = True
+    pm.port_names.silent = True
+    if not symbolic:
+        engine = 'numeric'  # only used in the names
+    track = pm.set_variable('20um', name='track_'+engine)
+    gap = pm.set_variable('10um', name='gap_'+engine)
+    fillet = pm.set_variable('100um', name='fillet_'+engine)
+    for ii in range(N_CHIPS):
+        chip = Body(pm, 'chip_%s_%d'%(engine, ii))
+        with chip(['0.5mm', '0.5mm'], [1, 0]):
+            con1, = elt.draw_connector(chip, track, gap, '100um',
+                                       name='con1_%s_%d'%(engine, ii))
+        with chip(['3mm', '2mm'], [-1, 0]):
+            con2, = elt.draw_connector(chip, track, gap, '100um',
+                                       name='con2_%s_%d'%(engine, ii))
+        chip.draw_cable(con1, con2, fillet=fillet, is_bond=True,
+                        to_meander=[0, 1, 0], meander_length='1mm',
+                        name='cable_%s_%d'%(engine, ii))
+        for jj in range(50):
+            chip.rect([jj*track, -gap], [track, track+2*gap], layer=GAP)
+    return pm
+
+def polygons(pm):
+    result = []
+    for name, cell in sorted(pm.interface.gds_cells.items()):
+        for layer, polys in sorted(cell.get_polygons(by_spec=True).items()):
+            result += [np.asarray(poly) for poly in polys]
+    return result
+
+def timeit(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print('%-40s %8.3f s'%(label, time.perf_counter()-start))
+    return result
+
+#%% sympy versus native expressions versus plain floats
+
+pm_sympy = timeit('engine sympy', draw_chips, 'sympy')
+pm_native = timeit('engine native', draw_chips, 'native')
+pm_numeric = timeit('non-symbolic', draw_chips, 'native', False)
+
+polys_sympy = polygons(pm_sympy)
+polys_native = polygons(pm_native)
+polys_numeric = polygons(pm_numeric)
+assert len(polys_sympy) == len(polys_native) == len(polys_numeric) > 0
+for poly_sympy, poly_native, poly_numeric in zip(polys_sympy, polys_native,
+                                                 polys_numeric):
+    assert np.allclose(poly_sympy, poly_native)
+    assert np.allclose(poly_sympy, poly_numeric)
+
+#%% many entities with the same default name
+
+N_RECTS = 5000
+
+def draw_rects(pm):
+    chip = Body(pm, 'chip_names')
+    for ii in range(N_RECTS):
+        chip.rect([ii*1e-5, 0], [5e-6, 5e-6], layer=GAP)
+
+pm_names = Modeler('gds', symbolic=False)
+pm_names.entity_names.silent = True
+timeit('%d rects named rect_0'%N_RECTS, draw_rects, pm_names)
+assert 'rect_%d'%(N_RECTS-1) in pm_names.entity_instances
+
+#%% nested body blocks
+
+N_LEVELS = 7
+N_NESTED_RECTS = 1000
+
+def draw_nested(pm):
+    chip = Body(pm, 'chip_nested')
+    def nest(level):
+        if level == N_LEVELS:
+            for ii in range(N_NESTED_RECTS):
+                chip.rect([ii*1e-5, 0], [5e-6, 5e-6], layer=GAP)
+            return
+        with chip([1e-3, 0], [0, 1]):
+            nest(level+1)
+    nest(0)
+
+pm_nested = Modeler('gds', symbolic=False)
+pm_nested.entity_names.silent = True
+calls = []
+for method in ['rotate', 'translate']:
+    def counted(entities, *args, method=getattr(pm_nested.interface, method)):
+        calls.append(len(entities))
+        return method(entities, *args)
+    setattr(pm_nested.interface, method, counted)
+timeit('%d levels of %d rects'%(N_LEVELS, N_NESTED_RECTS), draw_nested,
+       pm_nested)
+print('%d interface calls moving %d entities'%(len(calls), sum(calls)))
+# the moves of the levels are composed into a single rotation and translation
+assert calls == [N_NESTED_RECTS]*2
+corners = np.array([[0, 0], [(N_NESTED_RECTS-1)*1e-5+5e-6, 5e-6]])
+for level in range(N_LEVELS):
+    corners = corners @ np.array([[0, 1], [-1, 0]]) + [1e-3, 0]
+bbox = pm_nested.interface.gds_cells['chip_nested'].get_bounding_box()
+assert np.allclose(bbox, [corners.min(axis=0), corners.max(axis=0)])
+
+#%% moving many polygons at once
+
+N_MOVED_RECTS = 10000
+
+pm_moved = Modeler('gds', symbolic=False)
+pm_moved.entity_names.silent = True
+chip = Body(pm_moved, 'chip_moved')
+rects = [chip.rect([ii*1e-5, 0], [5e-6, 5e-6], layer=GAP)
+         for ii in range(N_MOVED_RECTS)]
+gds_rects = [pm_moved.interface.gds_object_instances[rect.name]
+             for rect in rects]
+gds_copies = [gdspy.copy(gds_rect) for gds_rect in gds_rects]
+
+def move_each(gds_objects):
+    # previous implementation: gdspy loops over each object
+    for gds_object in gds_objects:
+        gds_object.rotate(np.pi/2)
+        gds_object.translate(1e-3, 2e-3)
+
+def move_at_once(entities):
+    pm_moved.interface.rotate(entities, 90)
+    pm_moved.interface.translate(entities, [1e-3, 2e-3, 0])
+
+timeit('move %d rects one by one'%N_MOVED_RECTS, move_each, gds_copies)
+timeit('move %d rects at once'%N_MOVED_RECTS, move_at_once, rects)
+for gds_rect, gds_copy in zip(gds_rects, gds_copies):
+    assert np.allclose(gds_rect.polygons[0], gds_copy.polygons[0])
+# quarter turns are exact: the rects stay aligned on the grid
+assert all(gds_rect.polygons[0][0][0] == 1e-3 for gds_rect in gds_rects)
+
+#%% deleting many entities
+
+def copy_and_delete(n_rects):
+    pm = Modeler('gds', symbolic=False)
+    pm.entity_names.silent = True
+    chip = Body(pm, 'chip_deleted')
+    rects = [chip.rect([ii*1e-5, 0], [5e-6, 5e-6], layer=GAP,
+                       name='rect_%d'%ii) for ii in range(n_rects)]
+    start = time.perf_counter()
+    copies = [rect.copy() for rect in rects]
+    for rect in rects:
+        rect.delete()
+    duration = time.perf_counter()-start
+    print('%-40s %8.3f s'%('copy and delete %d rects'%n_rects, duration))
+    assert list(chip.entities[GAP]) == copies
+    assert list(pm.interface.gds_cells['chip_deleted'].polygons) == \
+        [pm.interface.gds_object_instances[copy.name] for copy in copies]
+    return duration
+
+# removals are O(1): the time per rect does not grow with the number of rects
+durations = [copy_and_delete(n_rects) for n_rects in [2000, 8000]]
+print('time ratio for 4 times more rects: %.1f'%(durations[1]/durations[0]))
+
+#%% spatial index of 100k entities
+
+N_INDEXED_RECTS = 100000
+N_QUERIES = 1000
+
+def draw_grid(pm):
+    chip = Body(pm, 'chip_indexed')
+    for ii in range(N_INDEXED_RECTS):
+        chip.rect([ii % 300*2e-5, ii//300*2e-5], [1e-5, 1e-5], layer=GAP)
+    return chip
+
+pm_indexed = Modeler('gds', symbolic=False)
+pm_indexed.entity_names.silent = True
+chip = timeit('draw %d rects'%N_INDEXED_RECTS, draw_grid, pm_indexed)
+windows = [[[ii*1e-5, ii*1e-5], [ii*1e-5+1e-4, ii*1e-5+1e-4]]
+           for ii in range(N_QUERIES)]
+# the first query computes the bounding boxes
+timeit('first query', chip.query, GAP, windows[0])
+found = timeit('%d queries'%N_QUERIES,
+               lambda: [chip.query(GAP, window) for window in windows])
+entities = list(chip.entities[GAP])
+bboxes = pm_indexed.interface.get_bounding_boxes(entities)
+for window, entities_found in zip(windows[:10], found):
+    (xmin, ymin), (xmax, ymax) = window
+    assert entities_found == [
+        entity for entity, ((x0, y0), (x1, y1)) in zip(entities, bboxes)
+        if x0 <= xmax and xmin <= x1 and y0 <= ymax and ymin <= y1]
+nearest = timeit('%d nearest'%N_QUERIES,
+                 lambda: [chip.nearest(window[0]) for window in windows])
+assert nearest[0] is found[0][0]
+moved = list(chip.entities[GAP])[:N_INDEXED_RECTS//10]
+pm_indexed.translate(moved, [-1, 0, 0])
+timeit('query after moving %d rects'%len(moved), chip.query, GAP, windows[0])
+assert chip.query(GAP, [[-1, 0], [-1+1e-5, 0]]) == moved[:1]
+
+#%% ground tiles minus many gaps
+
+N_TILES = 10
+N_GAPS = 5000
+
+def draw_tiles(pm):
+    chip = Body(pm, 'chip_tiles')
+    tiles = [chip.rect([ii*1e-3, 0], [1e-3, 1e-3], layer=TRACK)
+             for ii in range(N_TILES)]
+    gaps = [chip.rect([ii*N_TILES*1e-3/N_GAPS, 4e-4], [1e-6, 2e-4], layer=GAP)
+            for ii in range(N_GAPS)]
+    return chip, tiles, gaps
+
+def subtract_each(blank_polygons, tool_polygons):
+    # previous implementation: every blank against all the tools
+    tool_polygon_set = gdspy.PolygonSet(tool_polygons)
+    return [gdspy.boolean(blank_polygon, tool_polygon_set, 'not',
+                          precision=1e-8, max_points=0)
+            for blank_polygon in blank_polygons]
+
+pm_tiles = Modeler('gds', symbolic=False)
+pm_tiles.entity_names.silent = True
+chip, tiles, gaps = draw_tiles(pm_tiles)
+gds_objects = pm_tiles.interface.gds_object_instances
+references = timeit('%d tiles minus %d gaps, all gaps'%(N_TILES, N_GAPS),
+                    subtract_each, [gds_objects[tile.name] for tile in tiles],
+                    [gds_objects[gap.name].polygons[0] for gap in gaps])
+timeit('%d tiles minus %d gaps, culled'%(N_TILES, N_GAPS), chip.subtract,
+       tiles, gaps)
+for tile, reference in zip(tiles, references):
+    assert same_area(gds_objects[tile.name], reference)
+
+# pads overlapped by the same tools are subtracted by a single boolean
+N_PADS = 2000
+
+def draw_pads(name):
+    chip = Body(pm_tiles, name)
+    pads = [chip.rect([ii*1e-4, 0], [5e-5, 1e-4], layer=TRACK)
+            for ii in range(N_PADS)]
+    slots = [chip.rect([-1e-4, 4e-5], [N_PADS*1e-4+2e-4, 2e-5], layer=GAP),
+             chip.rect([-1e-4, 7e-5], [N_PADS*1e-4+2e-4, 1e-5], layer=GAP)]
+    chip.apply_moves()
+    return chip, pads, slots
+
+def subtract_pads(pads, slots):
+    for pad in pads:
+        pad.subtract(slots, keep_originals=True)
+
+chip, pads_each, slots = draw_pads('chip_pads_each')
+start = time.perf_counter()
+timeit('%d pads minus 2 slots, per pad'%N_PADS, subtract_pads, pads_each,
+       slots)
+duration = time.perf_counter()-start
+chip, pads, slots = draw_pads('chip_pads_merged')
+start = time.perf_counter()
+timeit('%d pads minus 2 slots, merged'%N_PADS, chip.subtract, pads, slots)
+assert time.perf_counter()-start < duration/2
+for pad, pad_each in zip(pads, pads_each):
+    assert same_area(gds_objects[pad.name], gds_objects[pad_each.name])
+
+#%% tiled booleans on a large ground plane
+
+import os
+
+N_SIDE = 200  # N_SIDE**2 gaps
+N_HOLES_SIDE = 60  # N_HOLES_SIDE**2 curved holes
+
+def draw_wafer(pm, curved=False):
+    chip = Body(pm, 'chip_wafer')
+    ground = chip.rect([0, 0], [2e-2, 2e-2], layer=TRACK)
+    if curved:
+        pitch = 2e-2/N_HOLES_SIDE
+        gaps = [chip.disk([(ii+0.5)*pitch, (jj+0.5)*pitch], 3e-5, 'Z',
+                          layer=GAP, number_of_points=32)
+                for ii in range(N_HOLES_SIDE) for jj in range(N_HOLES_SIDE)]
+    else:
+        gaps = [chip.rect([ii*1e-4+2e-5, jj*1e-4+2e-5], [6e-5, 1e-5],
+                          layer=GAP)
+                for ii in range(N_SIDE) for jj in range(N_SIDE)]
+    return chip, ground, gaps
+
+def wafer_polygons(label, tile_size=None, processes=None,
+                   operation='subtract', curved=False):
+    # polygons of the ground after the operation, only the operation is timed
+    pm = Modeler('gds', symbolic=False)
+    pm.entity_names.silent = True
+    chip, ground, gaps = draw_wafer(pm, curved)
+    chip.apply_moves()
+    start = time.perf_counter()
+    getattr(ground, operation)(gaps, tile_size=tile_size, processes=processes)
+    duration = time.perf_counter()-start
+    print('%-40s %8.3f s'%(label, duration))
+    polygons = pm.interface.gds_object_instances[ground.name]
+    pm.reset()  # shuts the worker processes down
+    return polygons, duration
+
+# axis-aligned polygons are tiled as the others, the scanline runs on each
+# tile: in a single process the tiles cost about twice a single scanline
+monolithic, duration = wafer_polygons('ground minus %d gaps'%N_SIDE**2)
+tiled, tiled_duration = wafer_polygons('tiled, 1 process', '1mm', 1)
+assert same_area(monolithic, tiled)
+assert len(tiled.polygons) > len(monolithic.polygons)
+assert tiled_duration < 3*duration+0.1
+tiled, tiled_duration = wafer_polygons('tiled, 2 processes', '1mm', 2)
+assert same_area(monolithic, tiled)
+monolithic, duration = wafer_polygons('ground plus %d gaps'%N_SIDE**2,
+                                      operation='unite')
+tiled, tiled_duration = wafer_polygons('tiled, 1 process', '1mm', 1, 'unite')
+assert same_area(monolithic, tiled)
+assert tiled_duration < 3*duration+0.1
+
+# a single gdspy.boolean is superlinear in the number of curved holes
+monolithic, duration = wafer_polygons('ground minus %d disks'
+                                      %N_HOLES_SIDE**2, curved=True)
+tiled_results = []
+for processes in [1, os.cpu_count()]:
+    tiled, tiled_duration = wafer_polygons('tiled, processes=%d'%processes,
+                                           '5mm', processes, curved=True)
+    assert tiled_duration < duration/2
+    tiled_results.append(tiled)
+# the vertices are on the 1nm grid, a xor at this precision is exact but slow
+assert gdspy.boolean(monolithic, tiled_results[0], 'xor', precision=1e-9,
+                     max_points=0) is None
+for tiled in tiled_results[1:]:
+    assert len(tiled.polygons) == len(tiled_results[0].polygons)
+    assert all(np.array_equal(points, reference_points) for points,
+               reference_points in zip(tiled.polygons,
+                                       tiled_results[0].polygons))
+print('%d polygons, %d tiled polygons'%(len(monolithic.polygons),
+                                        len(tiled.polygons)))
+
+# the worker processes are started once per Modeler, reset shuts them down
+pm_pool = Modeler('gds', symbolic=False)
+pm_pool.entity_names.silent = True
+chip = Body(pm_pool, 'chip_pool')
+grounds = [chip.rect([ii*1e-3, 0], [1e-3, 1e-3], layer=TRACK)
+           for ii in range(2)]
+disks = [chip.disk([(ii+0.5)*5e-5, 5e-4], 2e-5, 'Z', layer=GAP,
+                   number_of_points=32) for ii in range(40)]
+grounds[0].subtract(disks, keep_originals=True, tile_size='0.25mm',
+                    processes=2)
+executor = pm_pool.interface.pool.executor
+assert executor is not None
+grounds[1].subtract(disks, keep_originals=True, tile_size='0.25mm',
+                    processes=2)
+assert pm_pool.interface.pool.executor is executor
+pm_pool.reset()
+assert pm_pool.interface.pool.executor is None
+
+#%% Manhattan booleans on a synthetic CPW chip
+
+N_LINES = 20
+N_SEGMENTS = 50
+N_HOLES = 50  # N_HOLES**2 flux trapping holes in the ground
+
+def draw_cpw_chip(pm):
+    # CPW meanders made of rects, in a ground plane with flux trapping holes
+    chip = Body(pm, 'chip_cpw')
+    ground = chip.rect([0, 0], [1e-2, 1e-2], layer=TRACK)
+    width, length = 2.2e-5, 8e-5  # track and gaps
+    gaps, tracks = [], []
+    for ii in range(N_LINES):
+        x0, y0 = 5e-4, 5e-4+ii*4.5e-4
+        for jj in range(N_SEGMENTS):
+            x, y = x0+jj*length, y0+(jj % 2)*length
+            gaps.append(chip.rect([x, y], [length+width, width], layer=GAP))
+            gaps.append(chip.rect([x+length, y0], [width, length+width],
+                                  layer=GAP))
+            tracks.append(chip.rect([x, y+6e-6], [length+width, 1e-5],
+                                    layer=TRACK))
+            tracks.append(chip.rect([x+length+6e-6, y0+6e-6],
+                                    [1e-5, length+1e-5], layer=TRACK))
+    for ii in range(N_HOLES):
+        for jj in range(N_HOLES):
+            gaps.append(chip.rect([ii*1e-4+5e-5, jj*1e-4+1e-5], [2e-6, 2e-6],
+                                  layer=GAP))
+    return chip, ground, gaps, tracks
+
+pm_cpw = Modeler('gds', symbolic=False)
+pm_cpw.entity_names.silent = True
+chip, ground, gaps, tracks = draw_cpw_chip(pm_cpw)
+gds_objects = pm_cpw.interface.gds_object_instances
+ground_polygons = list(gds_objects[ground.name].polygons)
+gap_polygons = [gds_objects[gap.name].polygons[0] for gap in gaps]
+track_polygons = [gds_objects[track.name].polygons[0] for track in tracks]
+
+def gdspy_boolean(polygons1, polygons2, operation):
+    # as the general engine of GdsModeler
+    return gdspy.boolean(polygons1, polygons2, operation, precision=1e-8,
+                         max_points=0)
+
+def same_geometry(polygons1, polygons2):
+    # a xor of so many polygons is too slow, compare the areas and boxes
+    if isinstance(polygons1, list):
+        polygons1 = gdspy.PolygonSet(polygons1)
+    if isinstance(polygons2, list):
+        polygons2 = gdspy.PolygonSet(polygons2)
+    return (abs(polygons1.area()-polygons2.area()) < 1e-15
+            and np.allclose(polygons1.get_bounding_box(),
+                            polygons2.get_bounding_box(), rtol=0, atol=1e-12))
+
+reference = timeit('gdspy.boolean, ground minus %d gaps'%len(gaps),
+                   gdspy_boolean, ground_polygons, gap_polygons, 'not')
+rects = timeit('manhattan_boolean, ground minus %d gaps'%len(gaps),
+               manhattan_boolean, ground_polygons, gap_polygons, 'not')
+assert same_geometry(rects, reference)
+reference = timeit('gdspy.boolean, plus %d tracks'%len(tracks),
+                   gdspy_boolean, reference, track_polygons, 'or')
+rects = timeit('manhattan_boolean, plus %d tracks'%len(tracks),
+               manhattan_boolean, rects, track_polygons, 'or')
+assert same_geometry(rects, reference)
+
+ground.subtract(gaps)
+ground.unite(tracks)
+assert same_geometry(gds_objects[ground.name], reference)
+
+# gaps at random positions share no coordinates, the scanline stays about
+# linear in their number instead of unique x times unique y
+rng = np.random.default_rng(0)
+plane = [gdspy.Rectangle((0, 0), (1e-2, 1e-2)).polygons[0]]
+durations = []
+for n_gaps in [1000, 4000, 16000]:
+    # on the 10nm grid of gdspy_boolean
+    corners = np.round(rng.uniform(0, 1e-2-1e-5, (n_gaps, 2)), 8)
+    random_gaps = [gdspy.Rectangle(corner, corner+1e-5).polygons[0]
+                   for corner in corners]
+    reference = timeit('gdspy.boolean, %d random gaps'%n_gaps,
+                       gdspy_boolean, plane, random_gaps, 'not')
+    start = time.perf_counter()
+    rects = timeit('manhattan_boolean, %d random gaps'%n_gaps,
+                   manhattan_boolean, plane, random_gaps, 'not')
+    durations.append(time.perf_counter()-start)
+    assert same_geometry(rects, reference)
+assert durations[2] < 8*durations[1]
+
+#%% geometry snapped to the database unit grid
+
+N_SNAPPED_RECTS = 10000
+
+pm_snapped = Modeler('gds', symbolic=False, precision=1e-9)
+pm_snapped.entity_names.silent = True
+chip = Body(pm_snapped, 'chip_snapped')
+rects = [chip.rect([ii*1.23456789e-5, 0], [5e-6, 5e-6], layer=GAP)
+         for ii in range(N_SNAPPED_RECTS)]
+
+def move_off_grid(entities):
+    pm_snapped.rotate(entities, 30)
+    pm_snapped.translate(entities, [1.0000000004e-3, 2.3e-10, 0])
+
+timeit('move %d rects off the grid'%N_SNAPPED_RECTS, move_off_grid, rects)
+vertices = np.concatenate([
+    pm_snapped.interface.gds_object_instances[rect.name].polygons[0]
+    for rect in rects])
+# the vertices are exact multiples of the database unit
+assert (np.round(vertices/1e-9)*1e-9 == vertices).all()
+# a flat rect keeps only its distinct vertices
+flat = chip.rect([0, 0], [1e-5, 2e-10], layer=GAP)
+assert len(pm_snapped.interface.gds_object_instances[flat.name].polygons[0]) \
+    == 2
+
+#%% fracturing and writing in worker processes
+
+import datetime
+import filecmp
+import os
+import tempfile
+
+N_CELLS = 4
+N_DISKS = 500  # disks of 1000 points in each cell
+
+def write_chips(folder, workers):
+    pm = Modeler('gds', symbolic=False)
+    pm.entity_names.silent = True
+    for ii in range(N_CELLS):
+        chip = Body(pm, 'chip_written_%d'%ii)
+        for jj in range(N_DISKS):
+            chip.disk([jj*1e-4, ii*1e-4], 4e-5, 'Z', layer=TRACK,
+                      number_of_points=1000)
+    for body in pm.bodies:
+        body.apply_moves()
+    start = time.perf_counter()
+    pm.interface.generate_gds(os.path.join(folder, 'out'), 199,
+                              workers=workers,
+                              timestamp=datetime.datetime(2020, 1, 1))
+    print('%-40s %8.3f s'%('fracture and write, workers=%d'%workers,
+                           time.perf_counter()-start))
+
+with tempfile.TemporaryDirectory() as serial, \
+        tempfile.TemporaryDirectory() as parallel:
+    write_chips(serial, 1)
+    write_chips(parallel, 2)
+    # the files are the same whatever the number of workers
+    names = sorted(os.listdir(serial))
+    assert len(names) == N_CELLS and names == sorted(os.listdir(parallel))
+    assert all(filecmp.cmp(os.path.join(serial, name),
+                           os.path.join(parallel, name), shallow=False)
+               for name in names)
+
+#%% streaming the bodies to gds files
+
+import tracemalloc
+
+N_BLOCKS = 20
+N_BLOCK_RECTS = 1000
+
+def draw_blocks(pm, folder=None):
+    # blocks of rects, flushed at the exit of each block in streaming mode
+    if folder is not None:
+        pm.stream_gds(folder, 'out', flush_on_exit=True)
+    chip = Body(pm, 'chip_streamed')
+    for ii in range(N_BLOCKS):
+        with chip([0, ii*1e-4], [1, 0]):
+            for jj in range(N_BLOCK_RECTS):
+                chip.rect([jj*1e-5, 0], [5e-6, 5e-5], layer=GAP)
+    return chip
+
+def peak_memory(folder, streamed):
+    pm = Modeler('gds', symbolic=False)
+    pm.entity_names.silent = True
+    tracemalloc.start()
+    start = time.perf_counter()
+    if streamed:
+        draw_blocks(pm, folder)
+        pm.close_gds_stream()
+    else:
+        draw_blocks(pm)
+        pm.generate_gds(folder, 'out')
+    duration = time.perf_counter()-start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('%-40s %8.3f s %6d MB'%('%d rects, %s'%(
+        N_BLOCKS*N_BLOCK_RECTS, 'streamed' if streamed else 'in memory'),
+        duration, peak//1e6))
+    return peak
+
+def read_polygons(folder):
+    library = gdspy.GdsLibrary(infile=os.path.join(folder,
+                                                   'out_chip_streamed.gds'))
+    return library.cells['chip_streamed'].get_polygons()
+
+with tempfile.TemporaryDirectory() as in_memory, \
+        tempfile.TemporaryDirectory() as streamed:
+    peak = peak_memory(in_memory, False)
+    streamed_peak = peak_memory(streamed, True)
+    # only the geometry of one block is in memory at a time, the flushed
+    # entities are kept as handles of a few hundred bytes, see Body.flush
+    assert streamed_peak < (2*peak/N_BLOCKS + N_BLOCKS*N_BLOCK_RECTS*300
+                            + 1e6)
+    assert streamed_peak < peak/2
+    polygons = read_polygons(in_memory)
+    streamed_polygons = read_polygons(streamed)
+    assert len(polygons) == len(streamed_polygons) == N_BLOCKS*N_BLOCK_RECTS
+    assert all(np.array_equal(points, streamed_points) for points,
+               streamed_points in zip(polygons, streamed_polygons))
+
+# written at once, a streamed cell gives the same file as generate_gds
+with tempfile.TemporaryDirectory() as folder:
+    timestamp = datetime.datetime(2020, 1, 1)
+    for streamed in [False, True]:
+        pm = Modeler('gds', symbolic=False)
+        pm.entity_names.silent = True
+        draw_blocks(pm)
+        for body in pm.bodies:
+            body.apply_moves()
+        file = os.path.join(folder, 'streamed' if streamed else 'written')
+        if streamed:
+            pm.interface.stream_gds(file, 0, timestamp=timestamp)
+            pm.interface.close_streams()
+        else:
+            pm.interface.generate_gds(file, 0, timestamp=timestamp)
+    assert filecmp.cmp(os.path.join(folder, 'written_chip_streamed.gds'),
+                       os.path.join(folder, 'streamed_chip_streamed.gds'),
+                       shallow=False)
+
+#%% hierarchical gds library
+
+N_CHIPS = 10
+N_CHIP_RECTS = 2000
+
+def draw_wafer_chips(pm):
+    # chips placed on a wafer by their rel_coor, each with a rotated and
+    # mirrored sub-chip
+    for ii in range(N_CHIPS):
+        chip = Body(pm, 'chip_%d'%ii, rel_coor=[[ii*1e-2, 0, 0], [0, 1, 0],
+                                                 [-1, 0, 0]])
+        sub = Body(pm, 'sub_%d'%ii, rel_coor=[[1e-3, 2e-3, 0], [1, 0, 0],
+                                               [0, -1, 0]],
+                   ref_name='chip_%d'%ii)
+        for body in [chip, sub]:
+            for jj in range(N_CHIP_RECTS//2):
+                body.rect([jj*1e-5, 0], [5e-6, 2e-5], layer=GAP)
+
+pm_wafer = Modeler('gds', symbolic=False)
+pm_wafer.entity_names.silent = True
+draw_wafer_chips(pm_wafer)
+with tempfile.TemporaryDirectory() as folder:
+    timeit('write %d flat files'%(2*N_CHIPS), pm_wafer.generate_gds, folder,
+           'flat')
+    timeit('write a hierarchical library', pm_wafer.generate_gds, folder,
+           'wafer', 0, 1, True)
+    assert len(os.listdir(folder)) == 2*N_CHIPS+1
+    library = gdspy.GdsLibrary(infile=os.path.join(folder, 'wafer.gds'))
+    assert [cell.name for cell in library.top_level()] == ['wafer']
+    polygons = library.cells['wafer'].get_polygons()
+
+# the references compose the transforms of the rel_coor chains
+def to_wafer(points, ii, in_sub):
+    x, y = points.T
+    if in_sub:
+        x, y = 1e-3+x, 2e-3-y
+    return np.stack([ii*1e-2-y, x], axis=1)
+
+expected = []
+for ii in range(N_CHIPS):
+    for in_sub in [False, True]:
+        cell = pm_wafer.interface.gds_cells['%s_%d'%('sub' if in_sub
+                                                       else 'chip', ii)]
+        expected += [to_wafer(points, ii, in_sub)
+                     for points in cell.get_polygons()]
+assert len(polygons) == len(expected) == N_CHIPS*N_CHIP_RECTS
+def grid_vertices(polygons):
+    # sorted vertices of each polygon in database units, sorted polygons
+    return sorted(sorted(map(tuple, np.round(points/1e-9).astype(int)))
+                  for points in polygons)
+
+assert grid_vertices(polygons) == grid_vertices(expected)
+
+#%% memoized components
+
+from HFSSdrawpy import component
+
+N_CONNECTORS = 1000
+
+def draw_connectors(pm, memoized):
+    # the same connector placed on a grid, its ports used by cables
+    draw_connector = component(elt.draw_connector) if memoized \
+                     else elt.draw_connector
+    track = pm.set_variable('20um', name='track')
+    gap = pm.set_variable('10um', name='gap')
+    chip = Body(pm, 'chip')
+    ports = []
+    for ii in range(N_CONNECTORS):
+        with chip([(ii % 40)*5e-4, (ii//40)*5e-4], [[1, 0], [0, 1]][ii % 2]):
+            port, = draw_connector(chip, track, gap, '100um',
+                                   name='con_%d'%ii)
+        ports.append(port)
+    chip.draw_cable(ports[0], ports[3], fillet='100um', name='cable')
+    return ports
+
+for memoized in [False, True]:
+    pm = Modeler('gds', symbolic=False)
+    pm.entity_names.silent = True
+    pm.port_names.silent = True
+    label = 'memoized' if memoized else 'drawn'
+    ports = timeit('%d connectors, %s'%(N_CONNECTORS, label),
+                   draw_connectors, pm, memoized)
+    if memoized:
+        assert len(pm.components) == 1
+        assert [port.name for port in ports] == names
+        assert np.allclose([port.pos for port in ports], positions,
+                           rtol=0, atol=1e-12)
+    names = [port.name for port in ports]
+    positions = [port.pos for port in ports]
+    with tempfile.TemporaryDirectory() as folder:
+        timeit('write %d connectors, %s'%(N_CONNECTORS, label),
+               pm.generate_gds, folder, label)
+        file = os.path.join(folder, label+'_chip.gds')
+        print('file size: %d kB'%(os.path.getsize(file)//1000))
+        library = gdspy.GdsLibrary(infile=file)
+    polygons = library.cells['chip'].get_polygons(by_spec=True)
+    areas = {spec: sum(gdspy.Polygon(points).area() for points in layer)
+             for spec, layer in polygons.items()}
+    if memoized:
+        # the references place the same geometry, up to the rounding of
+        # the rotated vertices to the database unit (1nm along 10um edges)
+        assert areas.keys() == drawn_areas.keys()
+        for spec in areas:
+            assert abs(areas[spec]-drawn_areas[spec]) \
+                   < len(polygons[spec])*1e-9*1e-5
+    drawn_areas = areas
+
+#%% arrays of entities and components
+
+N_COLUMNS = 100
+N_ROWS = 100
+
+def draw_holes(pm, as_array):
+    # a grid of holes and a grid of connectors in a rotated block
+    chip = Body(pm, 'chip')
+    with chip(['1mm', '0mm'], [0, 1]):
+        if as_array:
+            chip.rect_array([0, 0], ['2um', '2um'], N_COLUMNS, N_ROWS,
+                            ['5um', '7um'], layer=GAP)
+            connector, = draw_connector(chip, 2e-5, 1e-5, '100um',
+                                        name='con')
+            chip.array(chip.entity_instances['con'], 10, 10, ['1mm', '1mm'])
+        else:
+            for ii in range(N_COLUMNS):
+                for jj in range(N_ROWS):
+                    chip.rect([ii*5e-6, jj*7e-6], ['2um', '2um'], layer=GAP)
+            for ii in range(10):
+                for jj in range(10):
+                    with chip([ii*1e-3, jj*1e-3], [1, 0]):
+                        draw_connector(chip, 2e-5, 1e-5, '100um',
+                                       name='con')
+    return chip
+
+draw_connector = component(elt.draw_connector)
+for as_array in [False, True]:
+    pm = Modeler('gds', symbolic=False)
+    pm.entity_names.silent = True
+    pm.port_names.silent = True
+    label = 'array' if as_array else 'drawn'
+    tracemalloc.start()
+    timeit('%d holes, 100 connectors, %s'%(N_COLUMNS*N_ROWS, label),
+           draw_holes, pm, as_array)
+    print('memory: %d kB'%(tracemalloc.get_traced_memory()[0]//1000))
+    tracemalloc.stop()
+    with tempfile.TemporaryDirectory() as folder:
+        timeit('write, %s'%label, pm.generate_gds, folder, label)
+        file = os.path.join(folder, label+'_chip.gds')
+        print('file size: %.1f kB'%(os.path.getsize(file)/1000))
+        library = gdspy.GdsLibrary(infile=file)
+    polygons = library.cells['chip'].get_polygons(by_spec=True)
+    if as_array:
+        # the arrays turn with the block they are drawn in
+        assert grid_vertices(polygons[(GAP, 0)]) \
+               == grid_vertices(drawn_polygons[(GAP, 0)])
+        assert polygons.keys() == drawn_polygons.keys()
+        for spec in polygons:
+            assert len(polygons[spec]) == len(drawn_polygons[spec])
+    drawn_polygons = polygons
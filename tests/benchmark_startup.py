@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the startup time of HFSSdrawpy, as seen by python -X importtime.
+Run as a script: python tests/benchmark_startup.py
+"""
+
+import subprocess
+import sys
+
+HEAVY_MODULES = ['sympy', 'pint', 'gdspy']
+
+def importtime(code):
+    """
+    Runs code in a fresh interpreter, returns the cumulative import time in
+    seconds of each top-level module and the heavy modules that got imported.
+    """
+    code += ("\nimport sys\nprint(','.join(module for module in %r "
+             "if module in sys.modules))"%HEAVY_MODULES)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             capture_output=True, text=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        if not module.startswith('  '):  # top-level import
+            times[module.strip()] = int(cumulative)*1e-6
+    return times, process.stdout.strip().split(',')
+
+def report(label, code):
+    times, heavy = importtime(code)
+    print('%-40s %8.3f s   loaded: %s'%(label, sum(times.values()),
+                                          ', '.join(filter(None, heavy))
+                                          or 'none'))
+    for module in sorted(times, key=times.get, reverse=True)[:3]:
+        print('    %-36s %8.3f s'%(module, times[module]))
+
+#%% import HFSSdrawpy
+
+report('import HFSSdrawpy', 'import HFSSdrawpy')
+
+#%% Modeler('gds')
+
+report("Modeler('gds')",
+       "from HFSSdrawpy import Modeler\npm = Modeler('gds')")
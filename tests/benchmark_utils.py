@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the parsing and evaluation utilities on large point lists.
+Run as a script: python tests/benchmark_utils.py
+"""
+
+import time
+
+from HFSSdrawpy.utils import Q, LENGTH_UNIT, parse_entry, parse_value_dim
+
+N_POINTS = 100000
+
+def timeit(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print('%-40s %8.3f s'%(label, time.perf_counter()-start))
+    return result
+
+#%% parse_entry on a 100k-point polyline given with units
+
+points = [('%dum'%(ii % 1000), '%.1fmm'%(ii % 50/10)) for ii in range(N_POINTS)]
+
+def parse_with_pint(points):
+    return [tuple(Q(coor).to(LENGTH_UNIT).magnitude for coor in point)
+            for point in points]
+
+# pint alone is too slow to go through all the points
+reference = timeit('pint for every entry (1/10 of points)', parse_with_pint,
+                   points[:N_POINTS//10])
+parse_value_dim.cache_clear()
+parsed = timeit('parse_entry', parse_entry, points)
+assert parsed[:N_POINTS//10] == reference
+print(parse_value_dim.cache_info())
+
+#%% val versus val_array on a 100k-point list with a few symbolic entries
+
+import sympy
+from HFSSdrawpy.utils import store_variable, val, val_array
+
+track = sympy.symbols('track')
+store_variable(track, '20um')
+points = [(ii*1e-6, track/2 if ii % 100 == 0 else 0.0)
+          for ii in range(N_POINTS)]
+
+evaluated = timeit('val', val, points)
+evaluated_array = timeit('val_array', val_array, points)
+assert (evaluated_array == evaluated).all()
+
+#%% expressions seldom evaluated are not compiled, caches are bounded
+
+from HFSSdrawpy.expression import Symbol
+from HFSSdrawpy.utils import Variables, use_variables, EVALUATION_CACHE_SIZE, \
+                             COMPILE_AFTER
+
+N_EXPRESSIONS = 2000
+
+variables = Variables()
+with use_variables(variables):
+    width, gap = sympy.symbols('width gap')
+    variables.store(width, '20um')
+    variables.store(gap, '10um')
+    expressions = [width*ii+gap/(ii+1) for ii in range(N_EXPRESSIONS)]
+    start = time.perf_counter()
+    reference = timeit('evalf of one-off expressions',
+                       lambda: [float(expr.evalf(subs=variables.values))
+                                for expr in expressions])
+    duration = time.perf_counter()-start
+    evaluated = timeit('val of one-off expressions', val, expressions)
+    assert max(abs(x-y) for x, y in zip(evaluated, reference)) < 1e-15
+    # the first changes cost an evalf per expression, not a compilation
+    variables.store(width, '21um')
+    start = time.perf_counter()
+    timeit('val after a change', val, expressions)
+    assert time.perf_counter()-start < 2*duration
+    for ii in range(COMPILE_AFTER-2):
+        variables.store(width, '%dum'%(22+ii))
+        val(expressions)
+    assert not variables._compiled
+    variables.store(width, '30um')
+    timeit('val after %d changes (compiles)'%COMPILE_AFTER, val, expressions)
+    # all but the first expression, gap, depend on width
+    assert len(variables._compiled) == N_EXPRESSIONS-1
+    variables.store(width, '31um')
+    evaluated = timeit('val after a change (compiled)', val, expressions)
+    assert abs(evaluated[1]-(31e-6+5e-6)) < 1e-15
+
+# native expressions are cheap enough to overflow the caches
+variables = Variables()
+with use_variables(variables):
+    width = Symbol('width')
+    variables.store(width, 1.)
+    expressions = [width*ii for ii in range(EVALUATION_CACHE_SIZE+100)]
+    val(expressions)
+    variables.store(width, 2.)
+    evaluated = val(expressions)
+    assert evaluated[-1] == 2.*(EVALUATION_CACHE_SIZE+99)
+    assert len(variables._evaluated) == EVALUATION_CACHE_SIZE
+    assert len(variables._compiled) <= EVALUATION_CACHE_SIZE
+    assert len(variables._counts) <= EVALUATION_CACHE_SIZE
+    assert sum(map(len, variables._dependents.values())) \
+        == EVALUATION_CACHE_SIZE
+
+#%% numeric versus symbolic Vector operations
+
+import numpy as np
+from HFSSdrawpy.utils import Vector
+
+N_VECTORS = 10000
+
+def vector_operations(vectors):
+    ori = vectors[0].__class__(np.array([0, 1, 0], dtype=vectors[0].dtype))
+    result = []
+    for vec, next_vec in zip(vectors[:-1], vectors[1:]):
+        result.append((vec == next_vec, vec.cross(next_vec), vec.rot(ori),
+                       vec.refx(), vec.refy()))
+    return result
+
+numeric = [Vector(ii*1e-6, (ii % 7)*1e-6) for ii in range(N_VECTORS)]
+symbolic = [np.array(vec, dtype=object).view(Vector) for vec in numeric]
+fast = timeit('numeric Vector operations', vector_operations, numeric)
+slow = timeit('object Vector operations', vector_operations, symbolic)
+for fast_ops, slow_ops in zip(fast, slow):
+    assert fast_ops[0] == slow_ops[0]
+    for fast_vec, slow_vec in zip(fast_ops[1:], slow_ops[1:]):
+        assert np.array_equal(fast_vec, np.array(slow_vec, dtype=float))
+
+#%% move stack versus nested lists, for growing numbers of recorded objects
+
+from HFSSdrawpy.utils import MoveStack
+
+N_OPERATIONS = 1000
+DEPTH = 5
+
+def nested_remove(elt, nested_list):
+    # former bookkeeping: recursive scan of nested lists
+    if elt in nested_list:
+        nested_list.remove(elt)
+        return True
+    return any(nested_remove(elt, sub_list) for sub_list in nested_list
+               if isinstance(sub_list, list))
+
+def nested_insert_after(elt, nested_list, added_elt):
+    if elt in nested_list:
+        nested_list.insert(nested_list.index(elt)+1, added_elt)
+        return True
+    return any(nested_insert_after(elt, sub_list, added_elt)
+               for sub_list in nested_list if isinstance(sub_list, list))
+
+class Item():
+    pass
+
+for n_objects in [1000, 4000, 16000]:
+    objects = [Item() for ii in range(n_objects)]
+    stack = MoveStack()
+    nested = inner = []
+    for ii in range(DEPTH):
+        stack.push()
+        inner.append([])
+        inner = inner[-1]
+    for obj in objects:
+        stack.add(obj)
+        inner.append(obj)
+
+    def with_stack():
+        for obj in objects[-N_OPERATIONS:]:
+            copied = Item()
+            stack.add_after(obj, copied)
+            stack.remove(copied)
+
+    def with_lists():
+        for obj in objects[-N_OPERATIONS:]:
+            copied = Item()
+            nested_insert_after(obj, nested, copied)
+            nested_remove(copied, nested)
+
+    # copy and delete the last recorded objects
+    timeit('%d objects, move stack'%n_objects, with_stack)
+    timeit('%d objects, nested lists'%n_objects, with_lists)
+    assert list(stack.current()) == inner
+
+#%% spatial index of 100k boxes
+
+import random
+from HFSSdrawpy.utils import GridIndex, bbox_distance
+
+N_BOXES = 100000
+N_QUERIES = 1000
+
+random.seed(0)
+boxes = {}
+for ii in range(N_BOXES):
+    x, y = random.uniform(0, 1e-2), random.uniform(0, 1e-2)
+    boxes[Item()] = ((x, y), (x+random.uniform(1e-6, 2e-5),
+                             y+random.uniform(1e-6, 2e-5)))
+ground = Item()
+boxes[ground] = ((0, 0), (1e-2, 1e-2))  # a ground plane
+windows = []
+for ii in range(N_QUERIES):
+    x, y = random.uniform(0, 1e-2), random.uniform(0, 1e-2)
+    windows.append(((x, y), (x+1e-4, y+1e-4)))
+
+def build_index():
+    index = GridIndex()
+    for obj, box in boxes.items():
+        index.insert(obj, box)
+    index.query(windows[0])  # builds the grid
+    return index
+
+def intersects(box, window):
+    return (box[0][0] <= window[1][0] and window[0][0] <= box[1][0]
+            and box[0][1] <= window[1][1] and window[0][1] <= box[1][1])
+
+def scan_queries(windows):
+    return [[obj for obj, box in boxes.items() if intersects(box, window)]
+            for window in windows]
+
+def index_queries(windows):
+    return [index.query(window) for window in windows]
+
+index = timeit('insert %d boxes'%N_BOXES, build_index)
+# the linear scan is too slow to go through all the queries
+found = timeit('%d queries, linear scan'%(N_QUERIES//100), scan_queries,
+               windows[:N_QUERIES//100])
+assert index_queries(windows[:N_QUERIES//100]) == found
+timeit('%d queries, grid index'%N_QUERIES, index_queries, windows)
+
+index.remove(ground)
+points = [(random.uniform(-1e-3, 1.1e-2), random.uniform(-1e-3, 1.1e-2))
+          for ii in range(N_QUERIES)]
+nearest = timeit('%d nearest, grid index'%N_QUERIES,
+                 lambda: [index.nearest(point) for point in points])
+for point, (obj, distance) in zip(points[:10], nearest):
+    assert distance == min(bbox_distance(box, point)
+                           for obj, box in boxes.items() if obj is not ground)
+
+def move_boxes():
+    for obj, ((x, y), (x1, y1)) in list(boxes.items())[:N_BOXES//10]:
+        index.insert(obj, ((x+1e-5, y), (x1+1e-5, y1)))
+
+timeit('move %d boxes'%(N_BOXES//10), move_boxes)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the tests of the gds interface.
+"""
+
+import gdspy
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.interfaces.gds_modeler import gds_polygons
+
+# the vertices are snapped to a 1nm grid, the geometries are compared below
+# it: the default precision of gdspy.boolean is 1e-3 i.e. 1mm in our units
+PRECISION = 1e-10
+
+def new_chip(symbolic=False):
+    # gds Modeler without renaming messages, and a Body 'chip' in it
+    pm = Modeler('gds', symbolic=symbolic)
+    pm.entity_names.silent = True
+    pm.port_names.silent = True
+    return pm, Body(pm, 'chip')
+
+def polygons(pm, entity):
+    return gds_polygons(pm.interface.gds_object_instances[entity.name])
+
+def same_geometry(polygons1, polygons2):
+    # True if both polygon lists cover the same area
+    return gdspy.boolean(polygons1, polygons2, 'xor',
+                         precision=PRECISION) is None
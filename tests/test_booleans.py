@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+gds booleans: the subtraction of several blanks gives the same geometry
+whether the blanks are subtracted one by one or together.
+"""
+
+import pytest
+
+from HFSSdrawpy.parameters import GAP, TRACK
+
+from gds_helpers import new_chip, polygons, same_geometry
+
+def draw_pads(chip, spacing, disk=False):
+    # 5 pads, overlapped by the same two slots
+    pads = [chip.rect([ii*spacing, 0], [5e-5, 1e-4], layer=TRACK)
+            for ii in range(5)]
+    slots = [chip.rect([-1e-4, 4e-5], [1e-3, 2e-5], layer=GAP),
+             chip.rect([-1e-4, 7e-5], [1e-3, 1e-5], layer=GAP)]
+    if disk:
+        slots.append(chip.disk([2e-4, 1e-4], 4e-5, 'Z', layer=GAP,
+                               number_of_points=16))
+    return pads, slots
+
+#%% blanks sharing their tools
+
+# disjoint, touching and overlapping pads, with axis-aligned or curved tools
+@pytest.mark.parametrize('spacing', [1e-4, 5e-5, 3e-5])
+@pytest.mark.parametrize('disk', [False, True])
+def test_shared_tools(spacing, disk):
+    pm_each, chip_each = new_chip()
+    pads_each, slots_each = draw_pads(chip_each, spacing, disk)
+    for pad in pads_each:
+        pad.subtract(slots_each, keep_originals=True)
+    pm, chip = new_chip()
+    pads, slots = draw_pads(chip, spacing, disk)
+    chip.subtract(pads, slots)
+    for pad, pad_each in zip(pads, pads_each):
+        assert pad.name == pad_each.name
+        assert pad.layer == TRACK
+        assert same_geometry(polygons(pm, pad), polygons(pm_each, pad_each))
+    assert not any(slot.name in pm.entity_instances for slot in slots)
+
+def test_fully_subtracted():
+    pm, chip = new_chip()
+    pads = [chip.rect([ii*1e-4, 0], [5e-5, 1e-4], layer=TRACK)
+            for ii in range(3)]
+    # covers the first two pads only
+    tool = chip.rect([-1e-5, -1e-5], [1.7e-4, 1.2e-4], layer=GAP)
+    chip.subtract(pads, [tool])
+    assert [pad.name in pm.entity_instances for pad in pads] == \
+        [False, False, True]
+    assert len(chip.entities[TRACK]) == 1
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Native expression engine: construction with basic simplifications, printing
+as HFSS expressions, evaluation by walking the tree or compiled, and the
+same values as with sympy in a Modeler.
+"""
+
+import numpy as np
+import pytest
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.expression import Expression, Symbol
+from HFSSdrawpy.utils import val
+import HFSSdrawpy.libraries.example_elements as elt
+
+x, y = Symbol('x'), Symbol('y')
+VALUES = {x: 2., y: -3.}
+
+def values_of(expr):
+    indices = {x: 0, y: 1}
+    return expr.evaluate(VALUES), expr.compile(indices)([VALUES[x],
+                                                         VALUES[y]])
+
+#%% construction
+
+def test_simplifications():
+    assert x+0 is x and 0+x is x and x-0 is x
+    assert x*1 is x and 1*x is x and x/1 is x and x**1 is x
+    assert x*0 == 0 and 0*x == 0 and 0/x == 0 and x**0 == 1
+    assert 0-x == -x and -(-x) is x
+    assert abs(abs(x)) == abs(x)
+    assert Expression._binary('+', 1, 2) == 3
+
+def test_equality():
+    assert x+2*y == Symbol('x')+2*Symbol('y')
+    assert hash(x+2*y) == hash(Symbol('x')+2*Symbol('y'))
+    assert x+y != y+x  # structural, as the cache keys
+    assert x != 'x' and x != 1
+    assert (x*y).free_symbols == {x, y}
+    assert (x+1).free_symbols == {x}
+    assert x.name == 'x'
+    with pytest.raises(AttributeError):
+        (x+1).name
+
+def test_unsupported():
+    with pytest.raises(TypeError):
+        x+'1mm'
+    with pytest.raises(TypeError):
+        [1, 2]*x
+
+#%% printing
+
+def test_str():
+    assert str(x+y) == 'x + y'
+    assert str(x-(y-1)) == 'x - (y - 1)'
+    assert str((x+y)*2) == '(x + y)*2'
+    assert str(x/(y*2)) == 'x/(y*2)'
+    assert str(-x*y) == '(-x)*y'
+    assert str(-(x+y)) == '-(x + y)'
+    assert str(x*-2) == 'x*(-2)'
+    assert str(x**y**2) == 'x**y**2'
+    assert str((x**y)**2) == '(x**y)**2'
+    assert str(abs(x-y)) == 'abs(x - y)'
+
+#%% evaluation
+
+@pytest.mark.parametrize('expr, expected', [
+    (x+y, -1.), (x-y, 5.), (x*y, -6.), (x/y, -2/3), (x**2, 4.),
+    (2**x, 4.), (-x, -2.), (abs(y), 3.), (x-(y-1), 6.),
+    (-(x+y)*2/(x-y)**2, 2/25), (abs(x*y-10)/x, 8.)])
+def test_evaluate(expr, expected):
+    walked, compiled = values_of(expr)
+    assert walked == pytest.approx(expected)
+    assert compiled == pytest.approx(expected)
+
+def draw(engine):
+    pm = Modeler('gds', engine=engine)
+    pm.entity_names.silent = True
+    track = pm.set_variable('20um', name='track')
+    gap = pm.set_variable('10um', name='gap')
+    chip = Body(pm, 'chip')
+    with chip(['0.5mm', '0.5mm'], [0, 1]):
+        port, = elt.draw_connector(chip, track, gap, '100um', name='con')
+    chip.rect([-gap, -gap/2], [track*3, abs(gap-track)])
+    chip.apply_moves()
+    entities = list(pm.entity_instances.values())
+    return (np.array(pm.interface.get_bounding_boxes(entities)),
+            np.array(val(port.pos)))
+
+def test_modeler_parity():
+    # the same design with both engines gives the same geometry
+    sympy_boxes, sympy_pos = draw('sympy')
+    native_boxes, native_pos = draw('native')
+    assert sympy_boxes.shape == native_boxes.shape
+    assert np.allclose(sympy_boxes, native_boxes, rtol=0, atol=1e-12)
+    assert np.allclose(sympy_pos, native_pos, rtol=0, atol=1e-12)
+
+def test_ordering():
+    pm = Modeler('gds', engine='native')
+    track = pm.set_variable('20um', name='track')
+    gap = pm.set_variable('10um', name='gap')
+    assert gap < track and track > gap and gap <= gap and track >= 1e-6
+    assert max([track, gap, 2*gap+1e-9]) == 2*gap+1e-9
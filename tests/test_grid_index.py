@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Grid index of bounding boxes: query and nearest give the same results as a
+brute force search over all the boxes, for random boxes of mixed sizes,
+points, boxes covering many cells, removed and moved boxes.
+"""
+
+import math
+import random
+
+import pytest
+
+from HFSSdrawpy.utils import GridIndex, bbox_distance
+
+def random_box(rng, scale=1e-3):
+    kind = rng.random()
+    x, y = rng.uniform(-scale, scale), rng.uniform(-scale, scale)
+    if kind < 0.2:
+        # degenerate boxes: points and segments
+        width = 0 if kind < 0.1 else rng.uniform(0, scale/50)
+        return ((x, y), (x+width, y))
+    if kind < 0.25:
+        # covering many cells
+        return ((x, y), (x+rng.uniform(scale/2, scale), y+scale/3))
+    width, height = rng.uniform(0, scale/50), rng.uniform(0, scale/50)
+    return ((x, y), (x+width, y+height))
+
+def brute_query(boxes, bbox):
+    (xmin, ymin), (xmax, ymax) = bbox
+    return [elt for elt, ((bxmin, bymin), (bxmax, bymax)) in boxes.items()
+            if bxmin <= xmax and xmin <= bxmax and bymin <= ymax
+            and ymin <= bymax]
+
+def brute_nearest(boxes, point):
+    if not boxes:
+        return None
+    # ties are resolved by insertion order, boxes is ordered as the ranks
+    distance, elt = min((bbox_distance(bbox, point), rank)
+                        for rank, bbox in enumerate(boxes.values()))
+    return list(boxes)[elt], distance
+
+def check(index, boxes, rng, n_checks=50):
+    for _ in range(n_checks):
+        bbox = random_box(rng, 1.5e-3)
+        assert index.query(bbox) == brute_query(boxes, bbox)
+        point = (rng.uniform(-3e-3, 3e-3), rng.uniform(-3e-3, 3e-3))
+        assert index.nearest(point) == brute_nearest(boxes, point)
+
+#%% empty index
+
+@pytest.mark.parametrize('cell_size', [None, 1e-4])
+def test_empty(cell_size):
+    index = GridIndex(cell_size)
+    assert len(index) == 0
+    assert index.query(((0, 0), (1, 1))) == []
+    assert index.nearest((0, 0)) is None
+    index.insert('a', ((0, 0), (1e-5, 1e-5)))
+    assert index.query(((-1, -1), (1, 1))) == ['a']
+    index.remove('a')
+    assert 'a' not in index
+    assert index.query(((-1, -1), (1, 1))) == []
+    assert index.nearest((0, 0)) is None
+    with pytest.raises(KeyError):
+        index.remove('a')
+
+#%% against brute force
+
+@pytest.mark.parametrize('cell_size', [None, 1e-5, 1e-4, 1e-2])
+def test_random(cell_size):
+    rng = random.Random(0)
+    index, boxes = GridIndex(cell_size), {}
+    for elt in range(1000):
+        boxes[elt] = random_box(rng)
+        index.insert(elt, boxes[elt])
+    check(index, boxes, rng)
+    # removed boxes, and moved boxes keeping their rank
+    for elt in rng.sample(range(1000), 300):
+        index.remove(elt)
+        del boxes[elt]
+    for elt in rng.sample(sorted(boxes), 300):
+        boxes[elt] = random_box(rng)
+        index.insert(elt, boxes[elt])
+    check(index, boxes, rng)
+    # new boxes, the grid is rebuilt when their number doubles
+    for elt in range(1000, 2500):
+        boxes[elt] = random_box(rng, 2e-3)
+        index.insert(elt, boxes[elt])
+    check(index, boxes, rng)
+    assert len(index) == len(boxes)
+
+def test_points():
+    # only zero size boxes, the cell size cannot be taken from their sizes
+    rng = random.Random(1)
+    index, boxes = GridIndex(), {}
+    for elt in range(500):
+        x, y = rng.uniform(-1e-3, 1e-3), rng.uniform(-1e-3, 1e-3)
+        boxes[elt] = ((x, y), (x, y))
+        index.insert(elt, boxes[elt])
+    check(index, boxes, rng)
+    x, y = boxes[10][0]
+    assert index.query(((x, y), (x, y))) == [10]
+    assert index.nearest((x, y)) == (10, 0)
+
+def test_ties():
+    index = GridIndex()
+    for elt in 'abc':
+        index.insert(elt, ((0, 0), (1e-5, 1e-5)))
+    index.insert('a', ((0, 0), (1e-5, 1e-5)))
+    assert index.query(((0, 0), (0, 0))) == ['a', 'b', 'c']
+    assert index.nearest((1, 1))[0] == 'a'
+    index.remove('a')
+    assert index.nearest((1, 1))[0] == 'b'
+
+def test_infinite():
+    index = GridIndex()
+    index.insert('finite', ((0, 0), (1e-5, 1e-5)))
+    index.insert('plane', ((-math.inf, -math.inf), (math.inf, 0)))
+    assert index.query(((-math.inf, -math.inf), (math.inf, math.inf))) == \
+        ['finite', 'plane']
+    assert index.query(((1e-3, 1e-3), (2e-3, 2e-3))) == []
+    assert index.nearest((5e-6, 5e-6)) == ('finite', 0)
+    assert index.nearest((1, -1)) == ('plane', 0)
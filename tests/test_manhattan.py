@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Scanline boolean of axis-aligned polygons: manhattan_boolean covers the same
+area as gdspy.boolean for random rectangles and L shapes of both
+orientations, overlapping polygons, holes, empty operands and degenerate
+polygons, and declines polygons with slanted edges.
+"""
+
+import random
+
+import gdspy
+import numpy as np
+import pytest
+
+from HFSSdrawpy.interfaces.gds_modeler import manhattan_boolean
+
+from gds_helpers import PRECISION, same_geometry
+
+OPERATIONS = ['or', 'and', 'not']
+
+def rect(x0, y0, x1, y1, clockwise=False):
+    points = np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+    return points[::-1] if clockwise else points
+
+def l_shape(x, y, size, clockwise=False):
+    points = np.array([[x, y], [x+2*size, y], [x+2*size, y+size],
+                       [x+size, y+size], [x+size, y+2*size], [x, y+2*size]])
+    return points[::-1] if clockwise else points
+
+def with_hole(x, y, size):
+    # outline and hole joined by a cut, as the polygons of gdspy booleans
+    return np.array([[x, y], [x+3*size, y], [x+3*size, y+3*size],
+                     [x+2*size, y+3*size], [x+2*size, y+2*size],
+                     [x+2*size, y+size], [x+size, y+size], [x+size, y+2*size],
+                     [x+2*size, y+2*size], [x+2*size, y+3*size],
+                     [x, y+3*size]])
+
+def random_polygons(rng, count):
+    polygons = []
+    for _ in range(count):
+        x, y = rng.randrange(100)*1e-6, rng.randrange(100)*1e-6
+        size = rng.randrange(1, 30)*1e-6
+        clockwise = rng.random() < 0.5
+        kind = rng.random()
+        if kind < 0.6:
+            polygons.append(rect(x, y, x+size, y+rng.randrange(1, 30)*1e-6,
+                                 clockwise))
+        elif kind < 0.9:
+            polygons.append(l_shape(x, y, size, clockwise))
+        else:
+            polygons.append(with_hole(x, y, size))
+    return polygons
+
+def check(polygons1, polygons2, operation):
+    rects = manhattan_boolean(polygons1, polygons2, operation)
+    assert rects is not None
+    reference = gdspy.boolean(polygons1, polygons2, operation,
+                              precision=PRECISION)
+    if reference is None:
+        assert rects == []
+    else:
+        assert rects
+        assert same_geometry(rects, reference)
+        assert gdspy.PolygonSet(rects).area() == \
+            pytest.approx(reference.area(), rel=1e-12)
+    return rects
+
+#%% against gdspy.boolean
+
+@pytest.mark.parametrize('operation', OPERATIONS)
+@pytest.mark.parametrize('seed', range(5))
+def test_random(operation, seed):
+    rng = random.Random(seed)
+    check(random_polygons(rng, 20), random_polygons(rng, 20), operation)
+
+@pytest.mark.parametrize('operation', OPERATIONS)
+def test_blocks(operation):
+    # enough edges for the scanline to go through several blocks of slabs
+    rng = random.Random(5)
+    check(random_polygons(rng, 400), random_polygons(rng, 400), operation)
+
+@pytest.mark.parametrize('operation', OPERATIONS)
+def test_hole(operation):
+    polygons1 = [with_hole(0, 0, 1e-5)]
+    # inside the hole, across its edge and covering it
+    for polygon in [rect(1.2e-5, 1.2e-5, 1.8e-5, 1.8e-5),
+                    rect(1.5e-5, 1.5e-5, 2.5e-5, 1.7e-5),
+                    rect(0.5e-5, 0.5e-5, 2.5e-5, 2.5e-5)]:
+        check(polygons1, [polygon], operation)
+    rects = manhattan_boolean(polygons1, [], 'or')
+    assert gdspy.PolygonSet(rects).area() == pytest.approx(8e-10)
+
+@pytest.mark.parametrize('operation', OPERATIONS)
+def test_overlapping_operand(operation):
+    # polygons of the same operand overlapping, with opposite orientations
+    polygons1 = [rect(0, 0, 2e-5, 2e-5), rect(1e-5, 1e-5, 3e-5, 3e-5, True)]
+    check(polygons1, [rect(1.5e-5, 0, 2.5e-5, 4e-5)], operation)
+
+#%% edge cases
+
+def test_empty():
+    polygons = [rect(0, 0, 1e-5, 1e-5)]
+    assert manhattan_boolean([], [], 'or') == []
+    assert manhattan_boolean([], polygons, 'not') == []
+    assert manhattan_boolean(polygons, [], 'and') == []
+    check(polygons, [], 'or')
+    check(polygons, [], 'not')
+    check([], polygons, 'or')
+    # disjoint or touching operands
+    assert manhattan_boolean(polygons, [rect(1e-5, 0, 2e-5, 1e-5)],
+                             'and') == []
+    assert manhattan_boolean(polygons, polygons, 'not') == []
+
+def test_degenerate():
+    square = rect(0, 0, 1e-5, 1e-5)
+    flat = rect(0, 5e-6, 2e-5, 5e-6)  # zero height
+    point = np.array([[3e-6, 3e-6]]*4)
+    repeated = np.array([[0, 0], [0, 0], [1e-5, 0], [1e-5, 0], [1e-5, 1e-5],
+                         [0, 1e-5]])
+    for operation in OPERATIONS:
+        for polygons in [[flat], [point], [flat, point]]:
+            assert manhattan_boolean(polygons, [], operation) == []
+            check([square], polygons, operation)
+        check([repeated], [flat], operation)
+    # below the database unit
+    assert manhattan_boolean([rect(0, 0, 1e-5, 1e-10)], [], 'or') == []
+
+def test_merged_rectangles():
+    # the same interval in consecutive slabs gives a single rectangle
+    rects = manhattan_boolean([rect(0, 0, 1e-5, 1e-5)],
+                              [rect(1e-5, 0, 2e-5, 1e-5),
+                               rect(5e-6, 1e-5, 6e-6, 2e-5)], 'or')
+    boxes = sorted(tuple(points.min(axis=0))+tuple(points.max(axis=0))
+                   for points in rects)
+    assert np.allclose(boxes, [(0, 0, 5e-6, 1e-5), (5e-6, 0, 6e-6, 2e-5),
+                               (6e-6, 0, 2e-5, 1e-5)], rtol=0, atol=1e-15)
+
+def test_not_manhattan():
+    triangle = np.array([[0, 0], [1e-5, 0], [0, 1e-5]])
+    square = rect(0, 0, 1e-5, 1e-5)
+    for operation in OPERATIONS:
+        assert manhattan_boolean([triangle], [square], operation) is None
+        assert manhattan_boolean([square], [triangle], operation) is None
+    # slanted by less than the database unit
+    almost = np.array([[0, 0], [1e-5, 1e-10], [1e-5, 1e-5], [0, 1e-5]])
+    assert manhattan_boolean([almost], [], 'or') is not None
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Move stack of the `with body(...)` blocks: objects are kept in creation
+order in the frame of the innermost block, copies are inserted next to their
+original, and the frame of an exiting block joins the enclosing one. Checked
+against nested lists, as the stack was implemented before.
+"""
+
+import random
+
+import pytest
+
+from HFSSdrawpy.utils import MoveFrame, MoveStack
+
+#%% MoveFrame
+
+def test_frame():
+    frame = MoveFrame()
+    assert len(frame) == 0 and list(frame) == []
+    for elt in 'abc':
+        frame.append(elt)
+    frame.insert_after('a', 'x')
+    frame.insert_after('c', 'y')
+    assert list(frame) == ['a', 'x', 'b', 'c', 'y']
+    frame.remove('a')
+    frame.remove('y')
+    assert list(frame) == ['x', 'b', 'c'] and len(frame) == 3
+    assert 'b' in frame and 'a' not in frame
+    for elt in 'xbc':
+        frame.remove(elt)
+    assert list(frame) == []
+    frame.append('z')
+    assert list(frame) == ['z']
+    with pytest.raises(KeyError):
+        frame.remove('a')
+
+#%% MoveStack
+
+def test_empty_stack():
+    stack = MoveStack()
+    assert not stack
+    # outside of any block nothing is recorded
+    stack.add('a')
+    stack.add_after('a', 'b')
+    stack.remove('a')
+    assert not stack.frame_of
+    stack.push()
+    assert stack and list(stack.current()) == []
+    assert list(stack.pop()) == [] and not stack
+    with pytest.raises(IndexError):
+        stack.pop()
+
+def test_nested():
+    stack = MoveStack()
+    stack.push()
+    stack.add('a')
+    stack.push()
+    stack.add('b')
+    stack.add('c')
+    stack.add_after('b', 'b_copy')
+    stack.remove('c')
+    assert list(stack.current()) == ['b', 'b_copy']
+    assert list(stack.pop()) == ['b', 'b_copy']
+    # the objects of the inner block are now moved with the outer one
+    assert list(stack.current()) == ['a', 'b', 'b_copy']
+    assert stack.frame_of['b'] is stack.current()
+    stack.add_after('a', 'a_copy')
+    assert list(stack.pop()) == ['a', 'a_copy', 'b', 'b_copy']
+    assert not stack and not stack.frame_of
+
+def test_random():
+    # random operations compared with a stack of lists
+    rng = random.Random(0)
+    stack, reference = MoveStack(), []
+    count = 0
+    for _ in range(5000):
+        recorded = [elt for frame in reference for elt in frame]
+        action = rng.random()
+        if action < 0.15 or not reference:
+            stack.push()
+            reference.append([])
+        elif action < 0.3:
+            frame = reference.pop()
+            assert list(stack.pop()) == frame
+            if reference:
+                reference[-1].extend(frame)
+        elif action < 0.6:
+            stack.add(count)
+            reference[-1].append(count)
+            count += 1
+        elif action < 0.8 and recorded:
+            elt = rng.choice(recorded)
+            stack.add_after(elt, count)
+            for frame in reference:
+                if elt in frame:
+                    frame.insert(frame.index(elt)+1, count)
+            count += 1
+        elif recorded:
+            elt = rng.choice(recorded)
+            stack.remove(elt)
+            for frame in reference:
+                if elt in frame:
+                    frame.remove(elt)
+        assert [list(frame) for frame in stack.frames] == reference
+        assert set(stack.frame_of) == {elt for frame in reference
+                                       for elt in frame}
+        for frame in stack.frames:
+            assert all(stack.frame_of[elt] is frame for elt in frame)
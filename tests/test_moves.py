@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Deferred moves of the entities created in nested `with body(pos, ori):`
+blocks: the composed transform gives the same geometry as moving the entities
+at each block exit, including when the entities are deleted, copied or used
+in a boolean before the outermost block exits. Ports are moved at each exit.
+"""
+
+import numpy as np
+import pytest
+
+from HFSSdrawpy import Body
+
+from gds_helpers import new_chip, polygons
+
+FRAMES = [
+    [(['1mm', '0.5mm'], [0, 1]), (['0.2mm', '0mm'], [-1, 0])],
+    [(['1mm', '0.5mm'], [1, 0]), (['0.2mm', '0.1mm'], [0, -1]),
+     (['-0.3mm', '0.1mm'], [0, 1])],
+    [(['1mm', '0.5mm'], [1, 1]), (['0.2mm', '0.1mm'], [3, -4]),
+     (['0mm', '0.1mm'], [0, 1])],
+    ]
+# vertices are snapped to the 1nm grid after each move, hence the result of
+# successive rotations of any angle can differ by one grid step
+ATOL = 1.5e-9
+
+def points(pm, entity):
+    entity_polygons = polygons(pm, entity)
+    assert len(entity_polygons) == 1
+    return entity_polygons[0]
+
+def move_back(chip, entities, frames):
+    # the moves of the blocks applied at each exit, innermost first
+    for pos, ori in reversed(frames):
+        chip.rotate(entities, ori)
+        chip.translate(entities, pos)
+
+def rect_size(pm):
+    if pm.symbolic:
+        return [pm.set_variable('50um', name='width'), '20um']
+    return ['50um', '20um']
+
+#%% composed moves
+
+@pytest.mark.parametrize('frames', FRAMES)
+@pytest.mark.parametrize('symbolic', [False, True])
+def test_nested(frames, symbolic):
+    pm, chip = new_chip(symbolic)
+    # one rect per depth, all moved when the outermost block exits
+    rects = []
+    def draw(depth):
+        rects.append(chip.rect(['10um', '5um'], rect_size(pm)))
+        if depth < len(frames):
+            with chip(*frames[depth]):
+                draw(depth+1)
+    draw(0)
+    assert not chip.pending_moves
+    pm_each, chip_each = new_chip(symbolic)
+    for depth, rect in enumerate(rects):
+        rect_each = chip_each.rect(['10um', '5um'], rect_size(pm_each))
+        move_back(chip_each, [rect_each], frames[:depth])
+        assert np.allclose(points(pm, rect), points(pm_each, rect_each),
+                           rtol=0, atol=ATOL)
+
+def test_ports():
+    pm, chip = new_chip()
+    frames = FRAMES[2]
+    with chip(*frames[0]):
+        with chip(*frames[1]):
+            with chip(*frames[2]):
+                port, = chip.port(widths=['10um'], name='port')
+            # ports are already moved when the inner block exits
+            rect = chip.rect(port.pos[:2], ['1um', '1um'])
+    rect_each = chip.rect([0, 0], ['1um', '1um'])
+    move_back(chip, [rect_each], frames)
+    assert np.allclose(points(pm, rect)[0], points(pm, rect_each)[0],
+                       rtol=0, atol=ATOL)
+
+#%% entities used before the outermost block exits
+
+@pytest.mark.parametrize('frames', FRAMES)
+def test_delete(frames):
+    pm, chip = new_chip()
+    with chip(*frames[0]):
+        with chip(*frames[1]):
+            kept = chip.rect([0, 0], ['50um', '20um'])
+            deleted = chip.rect([0, 0], ['50um', '20um'])
+        assert deleted in chip.pending_moves
+        deleted.delete()
+        assert deleted not in chip.pending_moves
+    assert deleted.name not in pm.entity_instances
+    assert list(pm.entity_instances) == [kept.name]
+    assert not chip.pending_moves
+
+@pytest.mark.parametrize('frames', FRAMES)
+def test_copy(frames):
+    pm, chip = new_chip()
+    with chip(*frames[0]):
+        with chip(*frames[1]):
+            rect = chip.rect(['10um', 0], ['50um', '20um'])
+        copied = rect.copy()
+    pm_each, chip_each = new_chip()
+    rect_each = chip_each.rect(['10um', 0], ['50um', '20um'])
+    move_back(chip_each, [rect_each], frames[:2])
+    for entity in [rect, copied]:
+        assert np.allclose(points(pm, entity), points(pm_each, rect_each),
+                           rtol=0, atol=ATOL)
+
+@pytest.mark.parametrize('frames', FRAMES)
+def test_boolean(frames):
+    pm, chip = new_chip()
+    with chip(*frames[0]):
+        with chip(*frames[1]):
+            rect = chip.rect([0, 0], ['50um', '20um'])
+        hole = chip.rect(['-10um', '-10um'], ['20um', '20um'])
+        rect.subtract([hole])
+    pm_each, chip_each = new_chip()
+    rect_each = chip_each.rect([0, 0], ['50um', '20um'])
+    move_back(chip_each, [rect_each], frames[1:2])
+    hole_each = chip_each.rect(['-10um', '-10um'], ['20um', '20um'])
+    rect_each.subtract([hole_each])
+    move_back(chip_each, [rect_each], frames[:1])
+    polygon, polygon_each = points(pm, rect), points(pm_each, rect_each)
+    assert len(polygon) == len(polygon_each)
+    for point in polygon_each:
+        assert np.isclose(polygon, point, rtol=0,
+                          atol=ATOL).all(axis=1).any()
+
+def test_coordinate_system():
+    # the moves of a body are applied in its coordinate system, and the
+    # active coordinate system is restored afterwards
+    pm, chip = new_chip()
+    other = Body(pm, 'other')
+    applied_in = []
+    rotate = pm.interface.rotate
+    def recording_rotate(entities, angle):
+        applied_in.append(pm.interface.get_coor_sys())
+        rotate(entities, angle)
+    pm.interface.rotate = recording_rotate
+    with chip(['1mm', 0], [0, 1]):
+        with chip(['1mm', 0], [0, 1]):
+            rect = chip.rect([0, 0], ['50um', '20um'])
+        other.rect([0, 0], ['10um', '10um'])
+        assert pm.interface.get_coor_sys() == 'other'
+        rect.copy()
+        assert applied_in == ['chip']
+        assert pm.interface.get_coor_sys() == 'other'
+        other_rect = other.rect([0, 0], ['10um', '10um'])
+    assert other_rect.body is other
+    assert pm.interface.gds_object_instances[other_rect.name] in \
+        pm.interface.gds_cells['other'].polygons
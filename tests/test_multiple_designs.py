@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Several designs built in the same process: each Modeler has its own bodies,
+entities, ports and gds cells, and building designs in a loop does not make
+the memory grow. Variables belong to the Modeler that defines them, so
+designs may use the same variable names with different values, also from
+different threads.
+"""
+
+import gc
+import threading
+import tracemalloc
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.parameters import GAP, TRACK
+import HFSSdrawpy.libraries.example_elements as elt
+
+N_DESIGNS = 50
+
+def draw_design(pm, track='20um'):
+    track = pm.set_variable(track, name='track')
+    gap = pm.set_variable('10um', name='gap')
+    chip = Body(pm, 'chip')
+    with chip(['0.5mm', '0.5mm'], [1, 0]):
+        con1, = elt.draw_connector(chip, track, gap, '100um', name='con1')
+    with chip(['3mm', '2mm'], [-1, 0]):
+        con2, = elt.draw_connector(chip, track, gap, '100um', name='con2')
+    chip.draw_cable(con1, con2, fillet='100um', is_bond=True,
+                    to_meander=[0, 1, 0], meander_length='1mm', name='cable')
+    for jj in range(20):
+        chip.rect([jj*track, -gap], [track, track+2*gap], layer=GAP)
+    ground = chip.rect(['-1mm', '-1mm'], ['5mm', '5mm'], layer=TRACK)
+    ground.subtract(chip.entities[GAP])
+    return chip
+
+#%% two designs side by side use the same names independently
+
+def test_side_by_side():
+    pm1 = Modeler('gds')
+    pm2 = Modeler('gds')
+    chip1 = draw_design(pm1)
+    chip2 = draw_design(pm2)
+    assert set(pm1.entity_instances) == set(pm2.entity_instances)
+    assert set(pm1.port_instances) == set(pm2.port_instances)
+    assert pm1.body_instances['chip'] is chip1
+    assert pm2.body_instances['chip'] is chip2
+    assert pm1.interface.gds_cells['chip'] is not \
+        pm2.interface.gds_cells['chip']
+    chip2.rect(['5mm', '5mm'], ['1mm', '1mm'], layer=GAP)
+    bbox1 = pm1.interface.gds_cells['chip'].get_bounding_box()
+    bbox2 = pm2.interface.gds_cells['chip'].get_bounding_box()
+    assert bbox1[1][0] < bbox2[1][0]
+
+#%% same variable name, different values
+
+def rect_width(pm, name):
+    bbox = pm.interface.get_bounding_boxes([pm.entity_instances[name]])[0]
+    return bbox[1][0]-bbox[0][0]
+
+def variable(pm, name):
+    # symbol of the variable name defined in pm
+    symbol, = [symbol for symbol in pm.variables.values if str(symbol) == name]
+    return symbol
+
+def test_variables_per_design():
+    pm1 = Modeler('gds')
+    pm2 = Modeler('gds')
+    chip1 = draw_design(pm1, '20um')
+    chip2 = draw_design(pm2, '50um')
+    # pm2 defined its track after pm1, pm1 still draws with its own value
+    track1, track2 = variable(pm1, 'track'), variable(pm2, 'track')
+    assert track1 == track2
+    chip1.rect(['0mm', '0mm'], [2*track1, '1mm'], name='probe')
+    chip2.rect(['0mm', '0mm'], [2*track2, '1mm'], name='probe')
+    assert abs(pm1.variables.values[track1]-20e-6) < 1e-12
+    assert abs(pm2.variables.values[track2]-50e-6) < 1e-12
+    assert abs(rect_width(pm1, 'probe')-40e-6) < 1e-12
+    assert abs(rect_width(pm2, 'probe')-100e-6) < 1e-12
+
+def test_variables_in_thread():
+    pm1 = Modeler('gds')
+    chip1 = draw_design(pm1, '20um')
+    widths = {}
+    def worker():
+        pm2 = Modeler('gds')
+        chip2 = draw_design(pm2, '50um')
+        # interleave with the main thread drawing in pm1
+        started.set()
+        resumed.wait(10)
+        chip2.rect(['0mm', '0mm'], [2*variable(pm2, 'track'), '1mm'],
+                   name='probe')
+        widths['pm2'] = rect_width(pm2, 'probe')
+    started = threading.Event()
+    resumed = threading.Event()
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait(10)
+    chip1.rect(['0mm', '0mm'], [2*variable(pm1, 'track'), '1mm'],
+               name='probe')
+    resumed.set()
+    thread.join()
+    assert abs(rect_width(pm1, 'probe')-40e-6) < 1e-12
+    assert abs(widths['pm2']-100e-6) < 1e-12
+
+#%% reset frees the design and the Modeler can be used again
+
+def test_reset():
+    pm = Modeler('gds')
+    draw_design(pm)
+    entities = set(pm.entity_instances)
+    pm.reset()
+    assert not pm.entity_instances and not pm.port_instances
+    assert not pm.bodies and not pm.interface.gds_cells
+    assert abs(pm.variables.values[variable(pm, 'track')]-20e-6) < 1e-12
+    draw_design(pm)
+    assert set(pm.entity_instances) == entities
+
+#%% building designs in a loop keeps the memory flat
+
+def memory_after_designs(n_designs):
+    sizes = []
+    for ii in range(n_designs):
+        pm = Modeler('gds')
+        draw_design(pm)
+        del pm
+        gc.collect()
+        sizes.append(tracemalloc.get_traced_memory()[0])
+    return sizes
+
+def test_memory():
+    tracemalloc.start()
+    try:
+        sizes = memory_after_designs(N_DESIGNS)
+    finally:
+        tracemalloc.stop()
+    growth = sizes[-1]-sizes[N_DESIGNS//5]
+    print('memory growth over %d designs: %d kB'%(N_DESIGNS-N_DESIGNS//5-1,
+                                                  growth//1000))
+    # one design takes several MB, only caches may grow a little
+    assert growth < 200e3
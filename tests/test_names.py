@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Unique names of entities and ports: NameAllocator increments the trailing
+number of names in use, gives released names again and stays linear when
+objects are created and deleted in a loop.
+"""
+
+import time
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.utils import NameAllocator, split_name
+
+def new_allocator():
+    return NameAllocator({}, 'Entity', silent=True)
+
+def create(names, name):
+    name = names.allocate(name)
+    names.instances[name] = None
+    return name
+
+def delete(names, name):
+    names.instances.pop(name)
+    names.release(name)
+
+#%% allocation
+
+def test_split_name():
+    assert split_name('rect_12') == ('rect_', 12)
+    assert split_name('rect') == ('rect', 0)
+    assert split_name('12') == ('', 12)
+    assert split_name('') == ('', 0)
+
+def test_free_name_is_kept():
+    names = new_allocator()
+    assert create(names, 'rect_5') == 'rect_5'
+    assert create(names, 'rect') == 'rect'
+
+def test_numbering():
+    names = new_allocator()
+    assert [create(names, 'rect_0') for ii in range(4)] == \
+        ['rect_0', 'rect_1', 'rect_2', 'rect_3']
+    assert create(names, 'rect') == 'rect'
+    assert create(names, 'rect') == 'rect1'
+    # a name given explicitly inside a run is skipped
+    create(names, 'port_3')
+    assert [create(names, 'port_0') for ii in range(5)] == \
+        ['port_0', 'port_1', 'port_2', 'port_4', 'port_5']
+
+#%% deletion
+
+def test_release():
+    names = new_allocator()
+    created = [create(names, 'rect_0') for ii in range(10)]
+    delete(names, 'rect_3')
+    delete(names, 'rect_7')
+    assert create(names, 'rect_0') == 'rect_3'
+    assert create(names, 'rect_0') == 'rect_7'
+    assert create(names, 'rect_0') == 'rect_10'
+    # a released name taken again explicitly is not given twice
+    delete(names, 'rect_4')
+    create(names, 'rect_4')
+    assert create(names, 'rect_0') == 'rect_11'
+    # only numbers after the requested one are given
+    delete(names, 'rect_1')
+    assert create(names, 'rect_5') == 'rect_12'
+    assert create(names, 'rect_0') == 'rect_1'
+    assert len(names.instances) == len(created)+3
+
+def test_reset():
+    names = new_allocator()
+    for ii in range(5):
+        create(names, 'rect_0')
+    names.reset({})
+    assert create(names, 'rect_0') == 'rect_0'
+    assert create(names, 'rect_0') == 'rect_1'
+
+def test_entities():
+    pm = Modeler('gds')
+    pm.entity_names.silent = True
+    chip = Body(pm, 'chip')
+    rects = [chip.rect([0, 0], [1e-6, 1e-6], name='rect_0') for ii in range(5)]
+    rects[2].delete()
+    rects[3].rename('other')
+    assert chip.rect([0, 0], [1e-6, 1e-6], name='rect_0').name == 'rect_2'
+    assert chip.rect([0, 0], [1e-6, 1e-6], name='rect_0').name == 'rect_3'
+    assert chip.rect([0, 0], [1e-6, 1e-6], name='rect_0').name == 'rect_5'
+
+#%% creating and deleting objects in a loop is linear
+
+def create_delete(n_objects):
+    names = new_allocator()
+    for ii in range(n_objects):
+        create(names, 'rect_0')
+    start = time.perf_counter()
+    for ii in range(n_objects):
+        delete(names, create(names, 'rect_0'))
+        delete(names, 'rect_%d'%ii)
+        create(names, 'rect_0')
+    return time.perf_counter()-start
+
+def test_create_delete_scaling():
+    n_objects = 5000
+    create_delete(n_objects)  # warm up
+    small = min(create_delete(n_objects) for ii in range(3))
+    large = min(create_delete(4*n_objects) for ii in range(3))
+    # linear: 4 times longer, quadratic: 16 times
+    assert large < 8*small, (small, large)
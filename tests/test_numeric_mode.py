@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Non-symbolic gds mode: variables are plain floats, no symbolic expression is
+built, and the drawing is the same as in symbolic mode.
+"""
+
+import numpy as np
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.parameters import GAP, TRACK
+from HFSSdrawpy.utils import val, Vector, _NUMBERS, use_variables
+import HFSSdrawpy.libraries.example_elements as elt
+
+def draw(symbolic):
+    pm = Modeler('gds', symbolic=symbolic)
+    pm.entity_names.silent = True
+    pm.port_names.silent = True
+    track = pm.set_variable('20um', name='track')
+    gap = pm.set_variable('10um', name='gap')
+    length = pm.set_variable(2*track+gap, name='length')
+    chip = Body(pm, 'chip')
+    with chip(['0.5mm', '0.5mm'], [1, 0]):
+        con1, = elt.draw_connector(chip, track, gap, '100um', name='con1')
+    with chip(['3mm', '2mm'], [0, -1]):
+        with chip([length, 0], [-1, 0]):
+            con2, = elt.draw_connector(chip, track, gap, '100um',
+                                       name='con2')
+    chip.draw_cable(con1, con2, fillet='100um', name='cable')
+    for ii in range(5):
+        chip.rect([ii*length, -gap], [track, track+2*gap], layer=GAP)
+    ground = chip.rect(['-1mm', '-1mm'], ['5mm', '5mm'], layer=TRACK)
+    ground.subtract(chip.entities[GAP])
+    chip.apply_moves()
+    return pm, (track, gap, length), (con1, con2)
+
+def geometry(pm):
+    names = sorted(pm.entity_instances)
+    return names, np.array(pm.interface.get_bounding_boxes(
+        [pm.entity_instances[name] for name in names]))
+
+def test_variables_are_floats():
+    pm, variables, ports = draw(False)
+    assert all(type(variable) is float for variable in variables)
+    track, gap, length = variables
+    assert length == 2*track+gap
+    assert not pm.variables.values
+    for port in ports:
+        assert Vector(port.pos).is_numeric()
+        assert all(isinstance(width, _NUMBERS) for width in port.widths)
+
+def test_same_drawing():
+    pm_symbolic, _, ports_symbolic = draw(True)
+    pm_numeric, _, ports_numeric = draw(False)
+    names_symbolic, boxes_symbolic = geometry(pm_symbolic)
+    names_numeric, boxes_numeric = geometry(pm_numeric)
+    assert names_symbolic == names_numeric
+    assert np.allclose(boxes_symbolic, boxes_numeric, rtol=0, atol=1e-12)
+    with use_variables(pm_symbolic.variables):
+        for port_symbolic, port_numeric in zip(ports_symbolic, ports_numeric):
+            assert np.allclose(val(port_symbolic.pos), port_numeric.pos,
+                               rtol=0, atol=1e-12)
+            assert np.allclose(port_symbolic.ori, port_numeric.ori)
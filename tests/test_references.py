@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Entities placing a cell by reference, arrays and memoized components, in
+gds booleans: they are flattened when used as tools and rejected with a
+TypeError naming them when used as blanks.
+"""
+
+import gdspy
+import pytest
+
+from HFSSdrawpy import component
+from HFSSdrawpy.parameters import GAP, TRACK
+import HFSSdrawpy.libraries.example_elements as elt
+
+from gds_helpers import new_chip, polygons, same_geometry
+
+def draw_holes(chip, array):
+    # 3x2 holes in a ground plane, as an array or as separate rects
+    ground = chip.rect([0, 0], [1e-3, 1e-3], layer=TRACK, name='ground')
+    if array:
+        holes = [chip.rect([1e-4, 1e-4], [1e-5, 2e-5], layer=GAP,
+                           name='holes')]
+        chip.array(holes[0], 3, 2, [2e-4, 3e-4])
+    else:
+        holes = [chip.rect([1e-4+ii*2e-4, 1e-4+jj*3e-4], [1e-5, 2e-5],
+                           layer=GAP)
+                 for ii in range(3) for jj in range(2)]
+    return ground, holes
+
+#%% references as tools
+
+@pytest.mark.parametrize('operation', ['subtract', 'unite'])
+def test_tool(operation):
+    pm_array, chip_array = new_chip()
+    ground_array, holes_array = draw_holes(chip_array, True)
+    pm_rects, chip_rects = new_chip()
+    ground_rects, holes_rects = draw_holes(chip_rects, False)
+    getattr(ground_array, operation)(holes_array)
+    getattr(ground_rects, operation)(holes_rects)
+    assert same_geometry(polygons(pm_array, ground_array),
+                         polygons(pm_rects, ground_rects))
+
+#%% references as blanks
+
+def test_array_blank():
+    pm, chip = new_chip()
+    ground, (holes,) = draw_holes(chip, True)
+    before = polygons(pm, ground)
+    with pytest.raises(TypeError, match="'holes'"):
+        holes.subtract([ground])
+    with pytest.raises(TypeError, match="'holes'"):
+        holes.unite([ground])
+    with pytest.raises(TypeError, match="'holes'"):
+        pm.subtract([ground, holes], [chip.rect([0, 0], [1e-5, 1e-5])])
+    # nothing changed
+    assert 'ground' in pm.entity_instances and 'holes' in pm.entity_instances
+    assert same_geometry(polygons(pm, ground), before)
+    assert len(chip.entities[TRACK]) == 1
+
+def test_component_blank():
+    pm, chip = new_chip()
+    connector = component(elt.draw_connector)
+    with chip(['0.5mm', '0.5mm'], [1, 0]):
+        connector(chip, 2e-5, 1e-5, 1e-4, name='con')
+    ground = chip.rect([0, 0], [1e-3, 1e-3], layer=TRACK, name='ground')
+    reference = pm.entity_instances['con']
+    with pytest.raises(TypeError, match="'con'"):
+        reference.subtract([ground], keep_originals=True)
+    # the reference is flattened as a tool
+    ground.subtract([reference])
+    assert gdspy.PolygonSet(polygons(pm, ground)).area() < 1e-6-1e-10
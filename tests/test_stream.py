@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming of the bodies to gds files with flush_on_exit: only the entities
+created in the exiting outermost block are flushed, the entities drawn
+before it can still be used, and any use of a flushed entity raises.
+"""
+
+import os
+
+import gdspy
+import pytest
+
+from HFSSdrawpy.parameters import GAP
+
+from gds_helpers import PRECISION, new_chip, polygons, same_geometry
+
+def streamed_polygons(folder, body_name):
+    library = gdspy.GdsLibrary(infile=os.path.join(folder, 'out_%s.gds'
+                                                   %body_name))
+    return library.cells[body_name].get_polygons()
+
+def test_flush_on_exit(tmp_path):
+    pm, chip = new_chip()
+    pm.stream_gds(str(tmp_path), 'out', flush_on_exit=True)
+    ground = chip.rect([0, 0], ['1mm', '1mm'], name='ground')
+    with chip(['0.5mm', '0.5mm'], [1, 0]):
+        chip.rect([0, 0], ['10um', '100um'], name='trace')
+        gap = chip.rect([0, 0], ['30um', '100um'], layer=GAP, name='gap')
+    assert gap.flushed and not ground.flushed
+    assert gap in chip.entities[GAP]
+    assert list(pm.entity_instances) == ['ground']
+    # the gaps are written, they cannot be subtracted from the ground anymore
+    with pytest.raises(ValueError, match='gap was flushed'):
+        ground.subtract(chip.entities[GAP])
+    for use in [gap.copy, gap.delete, gap.find_vertex,
+                lambda: gap.rename('other'),
+                lambda: chip.translate([gap], ['1um', 0])]:
+        with pytest.raises(ValueError):
+            use()
+    assert gap in chip.entities[GAP]
+    # the ground is kept and can still be modified before its own flush
+    hole = chip.rect(['0.1mm', '0.1mm'], ['0.1mm', '0.1mm'])
+    ground.subtract([hole])
+    expected = polygons(pm, ground)
+    pm.close_gds_stream()
+    written = streamed_polygons(str(tmp_path), 'chip')
+    trace = gdspy.Rectangle((5e-4, 5e-4), (5.1e-4, 6e-4)).polygons
+    gap = gdspy.Rectangle((5e-4, 5e-4), (5.3e-4, 6e-4)).polygons
+    # the flushed block first, then the ground
+    assert len(written) == 2+len(expected)
+    assert same_geometry(written[:1], trace)
+    assert same_geometry(written[1:2], gap)
+    assert same_geometry(written[2:], expected)
+
+def test_flush(tmp_path):
+    # without argument, all the entities of the body are flushed
+    pm, chip = new_chip()
+    pm.stream_gds(str(tmp_path), 'out')
+    with chip(['1mm', 0], [0, 1]):
+        rect = chip.rect([0, 0], ['10um', '20um'])
+    other = chip.rect([0, 0], ['10um', '10um'])
+    chip.flush()
+    assert rect.flushed and other.flushed and not pm.entity_instances
+    chip.flush()
+    with pytest.raises(ValueError):
+        chip.flush([rect])
+    pm.close_gds_stream()
+    assert len(streamed_polygons(str(tmp_path), 'chip')) == 2
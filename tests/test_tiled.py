@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled booleans: the result covers the same area as a single gdspy.boolean,
+curved and axis-aligned operands above SCANLINE_VERTICES are cut along the
+tiles, small axis-aligned operands are computed at once.
+"""
+
+import gdspy
+import numpy as np
+import pytest
+
+import HFSSdrawpy.interfaces.gds_modeler as gds_modeler
+from HFSSdrawpy.interfaces.gds_modeler import tiled_boolean
+
+from gds_helpers import PRECISION, same_geometry
+
+TILE = 1e-4
+
+def ground_and_gaps(curved=False):
+    # 300um ground plane with a grid of gaps across the tile boundaries
+    ground = [gdspy.Rectangle((0, 0), (3e-4, 3e-4)).polygons[0]]
+    if curved:
+        gaps = [gdspy.Round(((ii+0.5)*3e-5, (jj+0.5)*3e-5), 1e-5,
+                            tolerance=1e-7).polygons[0]
+                for ii in range(10) for jj in range(10)]
+    else:
+        gaps = [gdspy.Rectangle((ii*3e-5+5e-6, jj*3e-5+5e-6),
+                                (ii*3e-5+2.5e-5, jj*3e-5+1e-5)).polygons[0]
+                for ii in range(10) for jj in range(10)]
+    return ground, gaps
+
+def cut_along_tiles(polygons):
+    # no polygon crosses a tile boundary
+    for points in polygons:
+        (xmin, ymin), (xmax, ymax) = points.min(axis=0), points.max(axis=0)
+        for low, high in [(xmin, xmax), (ymin, ymax)]:
+            if np.floor(low/TILE+1e-6) != np.floor(high/TILE-1e-6):
+                return False
+    return True
+
+@pytest.mark.parametrize('operation', ['or', 'not'])
+@pytest.mark.parametrize('curved', [False, True])
+def test_tiled(operation, curved, monkeypatch):
+    monkeypatch.setattr(gds_modeler, 'SCANLINE_VERTICES', 100)
+    ground, gaps = ground_and_gaps(curved)
+    polygons = tiled_boolean(ground, gaps, operation, TILE, processes=1)
+    reference = gdspy.boolean(ground, gaps, operation, precision=PRECISION)
+    if curved:
+        # the vertices of the arcs are snapped to the 1nm grid, slivers
+        # below it remain
+        assert gdspy.PolygonSet(polygons).area() == \
+            pytest.approx(reference.area(), rel=1e-4)
+    else:
+        assert same_geometry(polygons, reference)
+    assert cut_along_tiles(polygons)
+
+def test_small():
+    # below SCANLINE_VERTICES, the scanline runs once on the whole operands
+    ground, gaps = ground_and_gaps()
+    polygons = tiled_boolean(ground, gaps, 'not', TILE, processes=1)
+    assert same_geometry(polygons, gdspy.boolean(ground, gaps, 'not',
+                                                 precision=PRECISION))
+    assert not cut_along_tiles(polygons)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing and evaluation of entries: parse_entry converts lengths given with
+units to meters, val evaluates symbolic entries and val_array does both at
+once on a list of points.
+"""
+
+import numpy as np
+import pytest
+import sympy
+
+from HFSSdrawpy.utils import parse_entry, val, val_array, Variables, \
+                             use_variables
+
+@pytest.fixture
+def track():
+    variables = Variables()
+    symbol = sympy.symbols('track')
+    with use_variables(variables):
+        variables.store(symbol, '20um')
+        yield symbol
+
+#%% parse_entry
+
+def test_parse_entry():
+    assert parse_entry('1mm') == pytest.approx(1e-3)
+    assert parse_entry('20um') == pytest.approx(20e-6)
+    assert parse_entry('2.5 nm') == pytest.approx(2.5e-9)
+    assert parse_entry(3) == 3 and parse_entry(1e-3) == 1e-3
+    assert parse_entry('1mm', '2mm') == pytest.approx([1e-3, 2e-3])
+    assert parse_entry(['1mm', ('2mm', 3)]) == [pytest.approx(1e-3),
+                                                 (pytest.approx(2e-3), 3)]
+    assert parse_entry('name') == 'name'
+    assert parse_entry([]) == []
+
+def test_parse_symbolic(track):
+    assert parse_entry(track) is track
+    assert parse_entry([track, '1mm']) == [track, pytest.approx(1e-3)]
+
+#%% val
+
+def test_val(track):
+    assert val(2*track) == pytest.approx(40e-6)
+    assert val(3) == 3
+    assert val([track, (track, 1.)]) == [pytest.approx(20e-6),
+                                          (pytest.approx(20e-6), 1.)]
+    assert val([]) == []
+    with pytest.raises(TypeError):
+        val(sympy.symbols('undefined'))
+
+#%% val_array
+
+def test_val_array_numbers():
+    points = [(ii*1e-6, -ii*1e-6) for ii in range(5)]
+    result = val_array(points)
+    assert result.dtype == float and result.shape == (5, 2)
+    assert (result == np.array(points)).all()
+    assert (val_array(np.arange(6).reshape(3, 2)) == [[0, 1], [2, 3],
+                                                      [4, 5]]).all()
+
+def test_val_array_mixed(track):
+    points = [(0, '1mm'), (track/2, 1e-3), ['2um', track, 1e-6]]
+    result = val_array(points)
+    assert result.shape == (3, 3)
+    assert np.allclose(result, [[0, 1e-3, 0], [10e-6, 1e-3, 0],
+                                [2e-6, 20e-6, 1e-6]], rtol=0, atol=1e-15)
+    assert np.allclose(result, [list(val(parse_entry(list(point))))
+                                +[0]*(3-len(point)) for point in points],
+                       rtol=0, atol=1e-15)
+
+def test_val_array_empty():
+    assert val_array([]).shape == (0, 2)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Design variables: setting a variable again re-evaluates what depends on it,
+variables defined from other variables follow their changes and circular
+definitions are rejected without changing anything.
+"""
+
+import gdspy
+import pytest
+
+from HFSSdrawpy import Modeler, Body
+from HFSSdrawpy.utils import val, COMPILE_AFTER
+import HFSSdrawpy.libraries.example_elements as elt
+
+from gds_helpers import polygons, same_geometry
+
+#%% values derived from a variable follow its changes
+
+@pytest.mark.parametrize('engine', ['sympy', 'native'])
+def test_update(engine):
+    pm = Modeler('gds', engine=engine)
+    track = pm.set_variable('20um', name='track')
+    gap = pm.set_variable('10um', name='gap')
+    width = track+2*gap
+    assert abs(val(width)-40e-6) < 1e-15
+    pm.set_variable('30um', name='track')
+    assert abs(val(width)-50e-6) < 1e-15
+    assert abs(val(gap)-10e-6) < 1e-15
+
+@pytest.mark.parametrize('engine', ['sympy', 'native'])
+def test_compiled(engine):
+    # expressions are compiled after COMPILE_AFTER changes, with the same
+    # values before and after
+    pm = Modeler('gds', engine=engine)
+    track = pm.set_variable('20um', name='track')
+    width = 3*track+1e-6
+    for ii in range(COMPILE_AFTER+2):
+        pm.set_variable('%dum'%(20+ii), name='track')
+        assert abs(val(width)-(3*(20+ii)+1)*1e-6) < 1e-15
+        assert (width in pm.variables._compiled) == (ii >= COMPILE_AFTER)
+
+def test_derived_variables():
+    pm = Modeler('gds')
+    track = pm.set_variable('20um', name='track')
+    width = pm.set_variable(2*track, name='width')
+    length = pm.set_variable(width+1e-3, name='length')
+    pm.set_variable('30um', name='track')
+    assert abs(val(width)-60e-6) < 1e-15
+    assert abs(val(length)-1.06e-3) < 1e-15
+    # a variable defined again by a value no longer follows the others
+    pm.set_variable('1um', name='width')
+    pm.set_variable('40um', name='track')
+    assert abs(val(width)-1e-6) < 1e-15
+    assert abs(val(length)-1.001e-3) < 1e-15
+
+def test_ports_follow_variables():
+    pm = Modeler('gds')
+    track = pm.set_variable('20um', name='track')
+    gap = pm.set_variable('10um', name='gap')
+    x_pos = pm.set_variable('3mm', name='x_pos')
+    chip = Body(pm, 'chip')
+    with chip([x_pos, '2mm'], [-1, 0]):
+        port, = elt.draw_connector(chip, track, gap, '100um', name='con')
+    x_before = val(port.pos)[0]
+    pm.set_variable('4mm', name='x_pos')
+    assert abs(val(port.pos)[0]-x_before-1e-3) < 1e-12
+    pm.set_variable('30um', name='track')
+    assert abs(val(port.widths)[0]-30e-6) < 1e-15
+
+#%% circular definitions
+
+def test_direct_cycle():
+    pm = Modeler('gds')
+    track = pm.set_variable('20um', name='track')
+    with pytest.raises(ValueError):
+        pm.set_variable(track+1e-6, name='track')
+    assert abs(val(track)-20e-6) < 1e-15
+
+def test_indirect_cycle():
+    pm = Modeler('gds')
+    track = pm.set_variable('20um', name='track')
+    width = pm.set_variable(2*track, name='width')
+    length = pm.set_variable(width+1e-3, name='length')
+    with pytest.raises(ValueError, match='width'):
+        pm.set_variable(width/2+1e-6, name='track')
+    with pytest.raises(ValueError, match='length'):
+        pm.set_variable(length, name='track')
+    # nothing changed and the variables still follow track
+    assert abs(val(track)-20e-6) < 1e-15
+    pm.set_variable('30um', name='track')
+    assert abs(val(width)-60e-6) < 1e-15
+    assert abs(val(length)-1.06e-3) < 1e-15
+
+#%% gds geometry redrawn
+
+def draw_redrawn(pm, values):
+    # entities using the variables through each recorded drawing step
+    track = pm.set_variable(values['track'], name='track')
+    gap = pm.set_variable(values['gap'], name='gap')
+    x_pos = pm.set_variable(values['x_pos'], name='x_pos')
+    width = pm.set_variable(track+2*gap, name='width')
+    chip = Body(pm, 'chip')
+    ground = chip.rect([0, 0], ['5mm', '5mm'], name='ground')
+    with chip([x_pos, '2mm'], [0, 1]):
+        line = chip.rect([0, -track/2], ['1mm', track], name='line')
+        cutout = chip.rect([0, -width/2], ['1mm', width], name='cutout')
+        chip.disk([0, '1mm'], width, 'Z', name='pad')
+    chip.polyline([[0, 0], [track, 0], [0, x_pos/10]], name='triangle')
+    copied = line.copy()
+    copied.translate([gap, 0, 0])
+    bent = chip.rect([0, 0], [width, '0.1mm'], name='bent')
+    bent.fillet(track)
+    ground.subtract([cutout])
+    line.unite([copied])
+    chip.rect(['4mm', '4mm'], ['10um', '10um'], name='fixed')
+    return chip
+
+def drawn_polygons(pm):
+    return {name: polygons(pm, entity)
+            for name, entity in pm.entity_instances.items()}
+
+@pytest.mark.parametrize('engine', ['sympy', 'native'])
+def test_redraw(engine, capsys):
+    pm = Modeler('gds', engine=engine)
+    pm.entity_names.silent = True
+    draw_redrawn(pm, {'track': '20um', 'gap': '10um', 'x_pos': '3mm'})
+    fixed = pm.interface.gds_object_instances['fixed']
+    pm.set_variable('30um', name='track')
+    pm.set_variable('4mm', name='x_pos')
+    assert 'not redrawn' not in capsys.readouterr().out
+    # only the entities using the variables are redrawn
+    assert pm.interface.gds_object_instances['fixed'] is fixed
+    pm_new = Modeler('gds', engine=engine)
+    pm_new.entity_names.silent = True
+    draw_redrawn(pm_new, {'track': '30um', 'gap': '10um', 'x_pos': '4mm'})
+    redrawn, expected = drawn_polygons(pm), drawn_polygons(pm_new)
+    assert sorted(redrawn) == sorted(expected)
+    for name in expected:
+        assert same_geometry(redrawn[name], expected[name]), name
+    # the cell holds the redrawn polygons only
+    assert len(pm.interface.gds_cells['chip'].polygons) == len(expected)
+
+def test_fully_subtracted(capsys):
+    pm = Modeler('gds')
+    pm.entity_names.silent = True
+    size = pm.set_variable('20um', name='size')
+    chip = Body(pm, 'chip')
+    rect = chip.rect([0, 0], ['50um', '50um'], name='rect')
+    rect.subtract([chip.rect([0, 0], [size, size])])
+    pm.set_variable('60um', name='size')
+    assert 'rect was fully subtracted' in capsys.readouterr().out
+    assert polygons(pm, rect) == []
+    # kept empty, and drawn again by the next change
+    pm.set_variable('30um', name='size')
+    assert gdspy.PolygonSet(polygons(pm, rect)).area() == \
+        pytest.approx(50e-6**2-30e-6**2)
+
+def test_not_redrawn(capsys):
+    pm = Modeler('gds')
+    pm.entity_names.silent = True
+    track = pm.set_variable('20um', name='track')
+    chip = Body(pm, 'chip')
+    rect = chip.rect([0, 0], [track, track], name='rect')
+    chip.array(rect, 2, 2, ['0.1mm', '0.1mm'])
+    pm.set_variable('30um', name='track')
+    assert 'are not redrawn, e.g. rect' in capsys.readouterr().out
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Vector operations: the fast paths taken when all components are numbers give
+the same results as the general computations, on objects or on symbolic
+components evaluated afterwards.
+"""
+
+import numpy as np
+import pytest
+import sympy
+
+from HFSSdrawpy.utils import Vector, Variables, use_variables, val
+
+VECTORS = [(1., 0., 0.), (0., -1., 0.), (3., 4., 0.), (-2., 5., 1.5),
+           (1e-6, -2e-6, 0.), (0, 2, 0)]
+AXES = [(1, 0), (0, 1), (-1, 0), (0, -1), (3., 4.)]
+
+def general(vec):
+    # same values, stored as objects so that the fast paths are not taken
+    return Vector(np.array(vec, dtype=object))
+
+def check(result, expected):
+    assert isinstance(result, Vector)
+    assert np.allclose(np.array(val(result), dtype=float),
+                       np.array(val(Vector(expected)), dtype=float),
+                       rtol=1e-12, atol=1e-18)
+
+@pytest.fixture
+def track():
+    variables = Variables()
+    symbol = sympy.symbols('track')
+    with use_variables(variables):
+        variables.store(symbol, '20um')
+        yield symbol
+
+#%% numeric vectors
+
+def test_is_numeric(track):
+    assert Vector(1, 2).is_numeric() and Vector([1., 2., 3.]).is_numeric()
+    assert not general((1, 2, 0)).is_numeric()
+    assert not Vector([track, 0]).is_numeric()
+    assert Vector(1, 2).shape == (3,) and Vector(1, 2)[2] == 0
+
+@pytest.mark.parametrize('vec', VECTORS)
+@pytest.mark.parametrize('other', VECTORS)
+def test_cross(vec, other):
+    check(Vector(vec).cross(Vector(other)),
+          general(vec).cross(general(other)))
+    check(Vector(vec).cross(Vector(other)), np.cross(vec, other))
+
+@pytest.mark.parametrize('vec', VECTORS)
+@pytest.mark.parametrize('axis', AXES)
+def test_rot(vec, axis):
+    check(Vector(vec).rot(Vector(axis)), general(vec).rot(general(axis)))
+    # back to the original coordinates, in the plane orthogonal to z
+    check(Vector(vec).rot(Vector(axis)).rot(Vector(axis).refx()),
+          vec[:2])
+
+@pytest.mark.parametrize('vec', VECTORS)
+def test_single(vec):
+    check(Vector(vec).orth(), general(vec).orth())
+    check(Vector(vec).unit(), general(vec).unit())
+    check(Vector(vec).abs(), general(vec).abs())
+    assert Vector(vec).norm() == pytest.approx(np.linalg.norm(vec))
+    assert Vector(vec).unit().norm() == pytest.approx(1)
+    for name in ['refx', 'refy', 'refz']:
+        for offset in [0, 1e-6]:
+            check(getattr(Vector(vec), name)(offset),
+                  getattr(general(vec), name)(offset))
+
+def test_eq_index():
+    assert Vector(1, 2) == Vector(1., 2., 0.)
+    assert Vector(1, 2) == general((1, 2, 0))
+    assert not Vector(1, 2) == Vector(1, 2, 1)
+    assert Vector(1e-6, 0) == Vector(1e-6+1e-15, 0)
+    assert Vector(0, 3, 5).index(3) == 1
+    assert Vector(0, 3, 5).index(4) == -1
+
+#%% symbolic vectors
+
+def test_symbolic(track):
+    vec = Vector([track, 2*track, 0])
+    value = val(vec)
+    assert value.is_numeric()
+    check(vec.cross(Vector(0, 0, 1)), Vector(value).cross(Vector(0, 0, 1)))
+    check(vec.rot(Vector(0, 1)), Vector(value).rot(Vector(0, 1)))
+    check(Vector(1, 0).rot(Vector([track, track])),
+          Vector(1, 0).rot(Vector(1, 1)))
+    check(vec.orth(), Vector(value).orth())
+    check(vec.refx(track), Vector(value).refx(20e-6))
+    assert val(vec.norm()) == pytest.approx(value.norm())
+    assert vec == value and value == vec
+    assert vec.index(2*track) == 1